@@ -1,14 +1,19 @@
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI
 from contextlib import asynccontextmanager
-from src import LOGGER
+from src import LOGGER, fire_utils, llm
+from src.app_utils import api_key_required
 from routers import fake, chat, matches, profile
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     LOGGER.info("Starting up!")
+    # Start building the eligibility index /matches/create reads in the background
+    fire_utils.refresh_eligibility_buckets()
     yield
-    LOGGER.info("Shutting down!")
+    LOGGER.info(f"Shutting down! LLM usage {llm.USAGE.stats}")
+    # The pooled OpenAI clients are created on first use and live until shutdown
+    await llm.close_clients()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -21,3 +26,9 @@ app.include_router(profile.router)
 @app.get("/")
 def healthcheck():
     return {"Hello": "World"}
+
+
+@app.get("/usage", dependencies=[Depends(api_key_required)])
+def get_llm_usage():
+    """Token usage, prompt cache hits and latency of this process's LLM calls per label."""
+    return llm.USAGE.stats
@@ -0,0 +1,95 @@
+"""Compare group ranking with pairwise ranking on the planned pairs of a few matchees.
+
+Both modes rank the same pairs with the ranking cache off, and the script
+prints the estimated prompt tokens per ranked pair, the prompt tokens the API
+reported and how many of them were cached, and how well the group scores
+agree with the pairwise ones, e.g.
+
+    RANKING_CACHE= python benchmark_ranking.py 10 5
+
+ranks the pairs of 10 matchees one by one and then in groups of 5.
+"""
+
+import sys
+import dotenv
+
+dotenv.load_dotenv()
+
+import numpy as np  # noqa
+from src import ai, algo, cache, llm, ratelimit  # noqa
+from src.models import GroupMatchResult, compute_ages  # noqa
+
+num_matchees = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+group_size = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+if cache.get_ranking_cache():
+    sys.exit("Unset RANKING_CACHE, so both modes call the LLM for every pair")
+
+source = algo.get_job_source()
+profiles = source.get_compact_profiles()
+compute_ages(profiles)
+personas = source.get_all_personas()
+# Read the stored embeddings only, a benchmark must not write to Firestore
+persona_vectors, persona_index = (
+    algo.embed_personas(personas, embed_stale=False)
+    if algo.EMBEDDING_PRERANK
+    else (None, None)
+)
+matchees = [p for p in profiles if p.user_id in personas][:num_matchees]
+planned_pairs = algo.plan_match_pairs(
+    matchees,
+    profiles,
+    set(),
+    persona_vectors,
+    persona_index,
+    algo.get_profile_columns(source),
+)
+
+calls = []  # (estimated prompt tokens, was a group call) per LLM call
+generator = ai.GENERATOR
+
+
+def counting_generator(messages, *args, **kwargs):
+    calls.append(
+        (
+            ratelimit.estimate_tokens(messages) - ratelimit.COMPLETION_TOKENS_ESTIMATE,
+            kwargs.get("response_format") is GroupMatchResult,
+        )
+    )
+    return generator(messages, *args, **kwargs)
+
+
+ai.GENERATOR = counting_generator
+ranked = {}
+for mode, size in (("pairwise", 1), ("group", group_size)):
+    calls.clear()
+    llm.USAGE.reset()
+    ai.RANKING_GROUP_SIZE = size
+    ranked[mode] = algo.rank_planned_pairs(planned_pairs, personas)
+    tokens = sum(t for t, _ in calls)
+    num_group_calls = sum(is_group for _, is_group in calls)
+    print(
+        f"{mode}: {len(ranked[mode])} pairs ranked in {len(calls)} calls "
+        f"({num_group_calls} group calls, {len(calls) - num_group_calls} single), "
+        f"{tokens / max(1, len(ranked[mode])):.0f} prompt tokens per pair"
+    )
+    for label, usage in llm.USAGE.stats.items():
+        print(
+            f"  {label}: {usage['prompt_tokens']} prompt tokens reported, "
+            f"{usage['cached_share']:.0%} cached, mean latency "
+            f"{usage['mean_cached_latency_s']}s with a cache hit and "
+            f"{usage['mean_uncached_latency_s']}s without"
+        )
+
+match_ids = sorted(set(ranked["pairwise"]) & set(ranked["group"]))
+if not match_ids:
+    sys.exit("No pairs were ranked by both modes")
+pairwise = np.array([ranked["pairwise"][m][2].compatibility_rating for m in match_ids])
+group = np.array([ranked["group"][m][2].compatibility_rating for m in match_ids])
+ranks = [np.argsort(np.argsort(scores)) for scores in (pairwise, group)]
+print(
+    f"agreement over {len(match_ids)} pairs: "
+    f"mean absolute difference {np.abs(pairwise - group).mean():.2f}, "
+    f"within 1 point {(np.abs(pairwise - group) <= 1).mean():.0%}, "
+    f"same side of MIN_SCORE {((pairwise >= algo.MIN_SCORE) == (group >= algo.MIN_SCORE)).mean():.0%}, "
+    f"rank correlation {np.corrcoef(*ranks)[0, 1]:.2f}"
+)
@@ -0,0 +1,67 @@
+import json
+import os
+import tempfile
+
+# src connects to Firestore on import, so point it at an emulator address with
+# placeholder credentials; tests replace every call that would reach it
+_credentials = os.path.join(tempfile.mkdtemp(), "credentials.json")
+with open(_credentials, "w") as f:
+    json.dump(
+        {
+            "type": "authorized_user",
+            "client_id": "test",
+            "client_secret": "test",
+            "refresh_token": "test",
+        },
+        f,
+    )
+os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = _credentials
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import random  # noqa: E402
+import pytest  # noqa: E402
+from src.models import Location, Profile  # noqa: E402
+
+
+GENDERS = ["male", "female", "non-binary"]
+CITIES = [(51.5, -0.12), (53.48, -2.24), (55.95, -3.19)]
+
+
+def make_profiles(seed: int, num_profiles: int = 200) -> list[Profile]:
+    """Profiles clustered around a few cities, covering every preference combination."""
+    rng = random.Random(seed)
+    profiles = []
+    for i in range(num_profiles):
+        latitude, longitude = rng.choice(CITIES)
+        age = rng.choice([rng.randint(14, 20), rng.randint(18, 70)])
+        low = rng.randint(18, 50)
+        profiles.append(
+            Profile(
+                user_id=f"user{i}",
+                dob=f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/{2026 - age}",
+                gender=rng.choice(GENDERS + [None]),
+                orientation=rng.choice(
+                    [None, rng.sample(GENDERS, rng.randint(1, len(GENDERS)))]
+                ),
+                age_range=rng.choice([None, (low, low + rng.randint(0, 20))]),
+                location=rng.choice(
+                    [
+                        None,
+                        Location(
+                            latitude=latitude + rng.gauss(0, 0.5),
+                            longitude=longitude + rng.gauss(0, 0.5),
+                            consent=True,
+                        ),
+                    ]
+                ),
+                distance_range_km=rng.choice([None, 10, 50, 200]),
+            )
+        )
+    return profiles
+
+
+@pytest.fixture(params=range(3))
+def profiles(request) -> list[Profile]:
+    return make_profiles(request.param)
@@ -2,13 +2,38 @@
 
 # Set environment variables
 import dotenv
+import os
 
 dotenv.load_dotenv()
 
 # Import and run the matchmaking function
 from src.algo import matchmaking  # noqa
+from src.sharding import prepare_shards, reduce_shards, run_shard  # noqa
+from src.snapshot import refresh_snapshot  # noqa
+from src.fire_utils import backfill_match_pairs  # noqa
 
-response = matchmaking()
+# MATCHMAKING_MODE=incremental only re-evaluates new or changed users
+incremental = os.getenv("MATCHMAKING_MODE") == "incremental"
+
+# MATCHMAKING_STEP=prepare embeds changed personas once for a sharded run,
+# MATCHMAKING_STEP=shard then ranks this Cloud Run task's shard of pairs, and
+# MATCHMAKING_STEP=reduce allocates and saves matches from every shard, all
+# with the same MATCHMAKING_RUN_ID.
+# MATCHMAKING_STEP=snapshot refreshes the MATCHMAKING_SNAPSHOT the job reads,
+# and MATCHMAKING_STEP=pairs backfills match pair records from existing matches
+step = os.getenv("MATCHMAKING_STEP", "")
+if step == "snapshot":
+    response = refresh_snapshot()
+elif step == "pairs":
+    response = backfill_match_pairs()
+elif step == "prepare":
+    response = prepare_shards(incremental=incremental)
+elif step == "shard":
+    response = run_shard(incremental=incremental)
+elif step == "reduce":
+    response = reduce_shards(incremental=incremental)
+else:
+    response = matchmaking(incremental=incremental)
 
 # Print the response
 print(response)
@@ -1,9 +1,10 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, BackgroundTasks, Depends
 from typing import Literal
-from src import ai, prompts, fire_utils, themes
+from src import afire_utils, ai, embeddings, prompts, themes
 from src.app_utils import api_key_required
-from src.models import Message, Conversation, Persona, MessageResponse
+from src.models import MatchPair, Message, Conversation, Persona, MessageResponse
 from src import LOGGER
+import asyncio
 import random
 import json
 
@@ -11,20 +12,30 @@ router = APIRouter(prefix="/chat")
 LEARN_SCALE = 0.20
 MIN_LEARN = 5
 
-def get_seen_matches(user_id: str, name: str) -> str:
+
+async def get_seen_matches(user_id: str, name: str) -> str:
     initial_msg = ""
     added_matches = False
-    stored_matches = fire_utils.get_matches(user_id)
+    stored_matches = await afire_utils.get_matches(user_id)
     if stored_matches.matches:
         LOGGER.debug(f"Adding past matches to initial message for user {user_id}")
         initial_msg += f"\n\n{prompts.PAST_MATCHES}\n"
+        match_user_ids = [match.user_id for match in stored_matches.matches]
+        match_pairs, matched_profiles = await asyncio.gather(
+            afire_utils.get_match_pairs(user_id, match_user_ids),
+            afire_utils.get_profiles(match_user_ids),
+        )
         for match in stored_matches.matches:
-            if match.you_showed_interest:
-                matched_profile = fire_utils.get_profile(match.user_id)
+            # fall back to the match's own flags until its pair record is backfilled
+            pair = MatchPair.from_recorded(user_id, match)
+            if match.user_id in match_pairs:
+                pair.interest.update(match_pairs[match.user_id].interest)
+            if pair.of(user_id).showed_interest:
+                matched_profile = matched_profiles.get(match.user_id)
                 if matched_profile:
                     interest = (
                         "likes them"
-                        if match.you_showed_interest
+                        if pair.of(user_id).showed_interest
                         else "does not like them"
                     )
                     initial_msg += f"- {matched_profile.name} ({name} {interest}):\n{match.rationale}\n"
@@ -48,14 +59,15 @@ def get_weakest_themes(
 @router.get(
     "/opening", response_model=Message, dependencies=[Depends(api_key_required)]
 )
-def get_opening_prompt(user_id: str, chat_mode: Literal["discover"]):
+async def get_opening_prompt(user_id: str, chat_mode: Literal["discover"]):
     LOGGER.info(f"Initialising chat for user:{user_id}")
-    profile = fire_utils.get_profile(user_id)
-    persona = fire_utils.get_persona(user_id)
+    profile, persona = await asyncio.gather(
+        afire_utils.get_profile(user_id), afire_utils.get_persona(user_id)
+    )
 
     profile_description = profile.to_string() if profile else ""
     persona_description = persona.description if persona else "No persona found"
-    match_str = get_seen_matches(user_id, profile.name)
+    match_str = await get_seen_matches(user_id, profile.name)
 
     if chat_mode == "discover":
         if persona and persona.profile_category_scores:
@@ -65,6 +77,7 @@ def get_opening_prompt(user_id: str, chat_mode: Literal["discover"]):
         else:
             weakest_themes = dict(random.sample(themes.DATING_THEMES.items(), k=2))
         initial_msg = prompts.PERSONA_DISCOVERY.format(
+            date=prompts.get_pretty_date(),
             profile=profile_description,
             persona=persona_description,
             themes=themes.make_str_from_themes(weakest_themes),
@@ -81,13 +94,14 @@ def get_opening_prompt(user_id: str, chat_mode: Literal["discover"]):
 @router.post(
     "/response", response_model=Message, dependencies=[Depends(api_key_required)]
 )
-def chat_response(conversation: Conversation):
+async def chat_response(conversation: Conversation):
     # get previous messages (currently sent over api),
     ## NOTE this would need to be scalable + persistent (store messages) in future
     LOGGER.info(f"Responding to {conversation.user_id=}: {conversation.messages[-1]}")
-    msg_response = ai.GENERATOR(
+    msg_response = await ai.AGENERATOR(
         messages=[x.to_dict() for x in conversation.messages],
         response_format=MessageResponse,
+        label="persona_discovery",
     )
     LOGGER.debug(f"Returning response for user:{conversation.user_id} {msg_response=}")
     return Message(
@@ -97,29 +111,44 @@ def chat_response(conversation: Conversation):
     )
 
 
+def refresh_persona_embedding(persona: Persona):
+    try:
+        embeddings.update_persona_embedding(persona)
+    except Exception as e:
+        LOGGER.error(f"Failed to update persona embedding for {persona.user_id=}: {e}")
+
+
 @router.post("/persona", dependencies=[Depends(api_key_required)])
-def save_persona(persona: Persona):
+async def save_persona(persona: Persona, background_tasks: BackgroundTasks):
     LOGGER.info(f"Saving persona for user:{persona.user_id}")
-    fire_utils.save_persona(persona.user_id, persona.description)
+    await afire_utils.save_persona(persona.user_id, persona.description)
+    background_tasks.add_task(refresh_persona_embedding, persona)
     return {"message": f"Successfully saved the persona for {persona.user_id}"}
 
 
 @router.post("/distil", dependencies=[Depends(api_key_required)])
-def distil_persona(conversation: Conversation):
+async def distil_persona(conversation: Conversation, background_tasks: BackgroundTasks):
     # Persona distillation
     LOGGER.info(f"Distilling persona for user:{conversation.user_id}")
-    profile = fire_utils.get_profile(conversation.user_id)
-    persona = fire_utils.get_persona(conversation.user_id)
+    profile, persona = await asyncio.gather(
+        afire_utils.get_profile(conversation.user_id),
+        afire_utils.get_persona(conversation.user_id),
+    )
 
     profile_details = profile.to_string() if profile else ""
     transcript = "\n".join(
         [f"{msg.role}: {msg.content}" for msg in conversation.messages]
     )
     core_prompt = prompts.PERSONA_DISTILLATION.format(
-        profile=profile_details, transcript=transcript, persona=persona
+        date=prompts.get_pretty_date(),
+        profile=profile_details,
+        transcript=transcript,
+        persona=persona,
     )
 
-    response = ai.GENERATOR([{"role": "assistant", "content": core_prompt}])
+    response = await ai.AGENERATOR(
+        [{"role": "assistant", "content": core_prompt}], label="persona_distillation"
+    )
     LOGGER.info(f"Distilled persona for user:{conversation.user_id}")
     LOGGER.debug(f"Distilled persona for user {conversation.user_id}: {response}")
 
@@ -127,8 +156,14 @@ def distil_persona(conversation: Conversation):
     score_prompt = prompts.PROFILE_COMPLETENESS.format(
         persona=response, themes=themes.make_str_from_themes(themes.DATING_THEMES)
     )
-    updated_scores = ai.GENERATOR([{"role": "assistant", "content": score_prompt}])
-    current_scores = persona.profile_category_scores if persona and persona.profile_category_scores else {}
+    updated_scores = await ai.AGENERATOR(
+        [{"role": "assistant", "content": score_prompt}], label="profile_completeness"
+    )
+    current_scores = (
+        persona.profile_category_scores
+        if persona and persona.profile_category_scores
+        else {}
+    )
     if not current_scores:
         current_scores = {theme: 0 for theme in themes.DATING_THEMES}
     new_scores = {}
@@ -143,16 +178,20 @@ def distil_persona(conversation: Conversation):
     except Exception as e:
         new_scores = current_scores
         LOGGER.error(f"Error parsing scores: {e}")
-    fire_utils.save_persona(conversation.user_id, response, new_scores)
+    await afire_utils.save_persona(conversation.user_id, response, new_scores)
+    background_tasks.add_task(
+        refresh_persona_embedding,
+        Persona(user_id=conversation.user_id, description=response),
+    )
     return {"message": f"Successfully distilled the persona for {conversation.user_id}"}
 
 
 @router.get(
     "/persona", response_model=Persona, dependencies=[Depends(api_key_required)]
 )
-def get_persona(user_id: str):
+async def get_persona(user_id: str):
     LOGGER.info(f"Getting persona for user:{user_id}")
-    persona = fire_utils.get_persona(user_id)
+    persona = await afire_utils.get_persona(user_id)
     if not persona:
         persona = Persona(user_id=user_id, description="n/a")
     return persona
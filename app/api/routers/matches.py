@@ -1,12 +1,19 @@
+import asyncio
 from fastapi import APIRouter, Depends
-from src import fire_utils, LOGGER
+from src import afire_utils, LOGGER
 from src.app_utils import api_key_required
-from src.models import DisplayMatch, MatchResponse, MatchUpdate, MatchmakingStatus
+from src.models import (
+    DisplayMatch,
+    MatchResponse,
+    MatchUpdate,
+    MatchmakingStatus,
+)
 from src.algo import matchmaking
 
 router = APIRouter(prefix="/matches")
 
 
+# matchmaking is blocking, long running work, so FastAPI runs it in its threadpool
 @router.post("/create", dependencies=[Depends(api_key_required)])
 def generate_matches(user_id: str):
     return matchmaking(user_id)
@@ -15,29 +22,52 @@ def generate_matches(user_id: str):
 @router.get(
     "/get", response_model=MatchResponse, dependencies=[Depends(api_key_required)]
 )
-def get_matches(user_id: str):
+async def get_matches(user_id: str):
     # get the user's current matches
-    stored_matches = fire_utils.get_matches(user_id)
-    match_profiles = [
-        fire_utils.get_profile(match.user_id) for match in stored_matches.matches
-    ]
+    stored_matches = await afire_utils.get_matches(user_id)
+    match_user_ids = [match.user_id for match in stored_matches.matches]
 
     display_matches = []
     if not stored_matches.matches:
         LOGGER.info(f"No matches found for {user_id=}")
     else:
-        for match, profile in zip(stored_matches.matches, match_profiles):
+        # fetch every counterpart's profile and the pair records holding both
+        # users' interest in two concurrent batched reads
+        match_profiles, match_pairs = await asyncio.gather(
+            afire_utils.get_profiles(match_user_ids),
+            afire_utils.get_match_pairs(user_id, match_user_ids),
+        )
+        # matches made before pair records existed keep their interest in the
+        # RecordedMatch flags until backfill_match_pairs has run
+        legacy = [
+            m
+            for m in stored_matches.matches
+            if m.user_id not in match_pairs
+            or not match_pairs[m.user_id].interest.keys() >= {user_id, m.user_id}
+        ]
+        if legacy:
+            LOGGER.warning(
+                f"Reading recorded interest for {len(legacy)} matches of {user_id=}"
+            )
+            for other_id, recorded in (
+                await afire_utils.get_recorded_match_pairs(user_id, legacy)
+            ).items():
+                if other_id in match_pairs:
+                    recorded.interest.update(match_pairs[other_id].interest)
+                match_pairs[other_id] = recorded
+
+        for match in stored_matches.matches:
+            profile = match_profiles.get(match.user_id)
             if profile:
-                stored_matches = fire_utils.get_matches(match.user_id)
-                filtered_matches = [
-                    m for m in stored_matches.matches if m.user_id == user_id
-                ]
-                if not filtered_matches:
+                pair = match_pairs[match.user_id]
+                # pair records are written for both users of a new match, so a
+                # counterpart missing from it was never given the reverse match
+                if match.user_id not in pair.interest:
                     LOGGER.warning(
                         f"Corresponding {match=} not found for user {match.user_id}"
                     )
                     continue
-                their_match = filtered_matches[0]
+                your_interest, their_interest = pair.of(user_id), pair.of(match.user_id)
                 display_match = DisplayMatch(
                     name=profile.name,
                     matched_user_id=match.user_id,
@@ -45,10 +75,10 @@ def get_matches(user_id: str):
                     date_matched=match.date_matched,
                     rationale=match.rationale,
                     highlighted_themes=match.highlighted_themes,
-                    you_showed_interest=match.you_showed_interest,
-                    your_interested=match.your_interested,
-                    they_showed_interest=their_match.you_showed_interest,
-                    they_interested=their_match.your_interested,
+                    you_showed_interest=your_interest.showed_interest,
+                    your_interested=your_interest.interested,
+                    they_showed_interest=their_interest.showed_interest,
+                    they_interested=their_interest.interested,
                     phone_number=profile.phone_number.full_number,
                     age=profile.age,
                     gender=profile.gender,
@@ -69,19 +99,13 @@ def get_matches(user_id: str):
     response_model=MatchmakingStatus,
     dependencies=[Depends(api_key_required)],
 )
-def return_matchmaking_status():
-    return fire_utils.get_matchmaking_status()
+async def return_matchmaking_status():
+    return await afire_utils.get_matchmaking_status()
 
 
 @router.post("/update", dependencies=[Depends(api_key_required)])
-def update_match(match_update: MatchUpdate):
-    # get the user's current matches
-    stored_matches = fire_utils.get_matches(match_update.user_id)
-    # update the match
-    for match in stored_matches.matches:
-        if match.user_id == match_update.matched_user_id:
-            match.your_interested = match_update.show_interest
-            match.you_showed_interest = True
-            break
-    fire_utils.save_matches(match_update.user_id, stored_matches.matches)
+async def update_match(match_update: MatchUpdate):
+    await afire_utils.save_match_interest(
+        match_update.user_id, match_update.matched_user_id, match_update.show_interest
+    )
     return {"message": f"Successfully updated match for {match_update.user_id}"}
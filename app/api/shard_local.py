@@ -0,0 +1,41 @@
+"""Run the sharded matchmaking job locally, prepare, one process per shard, then reduce.
+
+Point it at the Firestore emulator and keep checkpoints on disk, e.g.
+
+    FIRESTORE_EMULATOR_HOST=localhost:8080 GOOGLE_CLOUD_PROJECT=demo-ume \
+    MATCHMAKING_CHECKPOINT=/tmp/ume-checkpoints python shard_local.py 4
+
+Rerun with the printed MATCHMAKING_RUN_ID to resume after a failure.
+"""
+
+import os
+import subprocess
+import sys
+import uuid
+
+num_shards = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+run_id = os.getenv("MATCHMAKING_RUN_ID", f"local-{uuid.uuid4().hex[:8]}")
+env = {
+    **os.environ,
+    "MATCHMAKING_RUN_ID": run_id,
+    "CLOUD_RUN_TASK_COUNT": str(num_shards),
+}
+print(f"Running {num_shards} shards with MATCHMAKING_RUN_ID={run_id}")
+
+subprocess.run(
+    [sys.executable, "job.py"], env={**env, "MATCHMAKING_STEP": "prepare"}, check=True
+)
+workers = [
+    subprocess.Popen(
+        [sys.executable, "job.py"],
+        env={**env, "MATCHMAKING_STEP": "shard", "CLOUD_RUN_TASK_INDEX": str(i)},
+    )
+    for i in range(num_shards)
+]
+failed = [i for i, worker in enumerate(workers) if worker.wait() != 0]
+if failed:
+    sys.exit(f"Shards {failed} failed, rerun with MATCHMAKING_RUN_ID={run_id}")
+
+subprocess.run(
+    [sys.executable, "job.py"], env={**env, "MATCHMAKING_STEP": "reduce"}, check=True
+)
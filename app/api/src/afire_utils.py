@@ -0,0 +1,180 @@
+"""Async versions of the `fire_utils` reads and writes the API routes make.
+
+They use Firestore's async client, so a route awaiting Firestore frees the
+event loop for other requests instead of holding a threadpool worker.
+"""
+
+import asyncio
+import datetime
+import pytz
+from firebase_admin import firestore_async
+from src import LOGGER, fire_utils
+from src.models import (
+    MatchmakingStatus,
+    MatchPair,
+    Persona,
+    Profile,
+    RecordedMatch,
+    StoredMatches,
+    create_canonical_match_id,
+)
+
+# fire_utils initialises the firebase app this client shares
+afdb = firestore_async.client()
+
+
+async def get_documents(collection: str, user_ids: list[str]) -> list:
+    """Fetch the given documents with batched `get_all` calls, issued concurrently."""
+    user_ids = list(dict.fromkeys(user_ids))
+
+    async def get_chunk(chunk: list[str]) -> list:
+        refs = [afdb.collection(collection).document(user_id) for user_id in chunk]
+        return [doc async for doc in afdb.get_all(refs) if doc.exists]
+
+    chunks = await asyncio.gather(
+        *(
+            get_chunk(user_ids[i : i + fire_utils.GET_ALL_CHUNK_SIZE])
+            for i in range(0, len(user_ids), fire_utils.GET_ALL_CHUNK_SIZE)
+        )
+    )
+    return [doc for chunk in chunks for doc in chunk]
+
+
+async def create_feedback(user_id: str, text: str, category: str):
+    feedback_ref = afdb.collection("feedback").document(user_id)
+    feedback_doc = await feedback_ref.get()
+
+    feedback_data = []
+    if feedback_doc.exists:
+        feedback_data = feedback_doc.to_dict().get("user_feedbacks", [])
+
+    feedback_data.append(
+        {
+            "text": text,
+            "timestamp": datetime.datetime.now(pytz.utc).isoformat(),
+            "category": category,
+        }
+    )
+    await feedback_ref.set({"user_feedbacks": feedback_data})
+    LOGGER.info(f"Feedback successfully saved for {user_id=}")
+
+
+async def delete_all(user_id: str):
+    await asyncio.to_thread(fire_utils.auth.delete_user, user_id)
+    await asyncio.gather(
+        *(
+            afdb.collection(collection).document(user_id).delete()
+            for collection in fire_utils.USER_COLLECTIONS
+        )
+    )
+    pair_refs = [
+        doc.reference
+        for query in fire_utils.user_pair_queries(afdb, user_id)
+        async for doc in query.stream()
+    ]
+    await asyncio.gather(*(ref.delete() for ref in pair_refs))
+    fire_utils.discard_eligible(user_id)
+    LOGGER.info(f"Deleted all data for {user_id=}")
+
+
+async def get_profile(user_id: str) -> Profile | None:
+    profile_doc = await afdb.collection("profile").document(user_id).get()
+
+    if not profile_doc.exists:
+        LOGGER.warning(f"No profile found for {user_id=}")
+        return None
+
+    profile_data = profile_doc.to_dict()
+    LOGGER.info(f"Found profile for {user_id=}")
+    LOGGER.debug(f"Profile for {user_id=}: {profile_data}")
+    return Profile(**profile_data)
+
+
+async def get_profiles(user_ids: list[str]) -> dict[str, Profile]:
+    return {
+        doc.id: Profile(**doc.to_dict())
+        for doc in await get_documents("profile", user_ids)
+    }
+
+
+async def get_matches(user_id: str) -> StoredMatches:
+    matches_doc = await afdb.collection("matches").document(user_id).get()
+
+    if not matches_doc.exists:
+        LOGGER.debug(f"No matches found for {user_id=}")
+        return StoredMatches(matches=[])
+
+    return fire_utils.stored_matches_from_dict(matches_doc.to_dict())
+
+
+async def get_match_pairs(
+    user_id: str, matched_user_ids: list[str]
+) -> dict[str, MatchPair]:
+    other_user_ids = {
+        create_canonical_match_id(user_id, other): other for other in matched_user_ids
+    }
+    return {
+        other_user_ids[doc.id]: MatchPair(**doc.to_dict())
+        for doc in await get_documents("match_pair", list(other_user_ids))
+    }
+
+
+async def get_recorded_match_pairs(
+    user_id: str, matches: list[RecordedMatch]
+) -> dict[str, MatchPair]:
+    """Pairs built from both users' RecordedMatch flags, for matches not yet backfilled."""
+    their_matches = {
+        doc.id: fire_utils.stored_matches_from_dict(doc.to_dict())
+        for doc in await get_documents("matches", [m.user_id for m in matches])
+    }
+    pairs = {}
+    for match in matches:
+        stored = their_matches.get(match.user_id, StoredMatches(matches=[]))
+        their_match = next((m for m in stored.matches if m.user_id == user_id), None)
+        pairs[match.user_id] = MatchPair.from_recorded(user_id, match, their_match)
+    return pairs
+
+
+async def save_match_interest(user_id: str, matched_user_id: str, show_interest: bool):
+    match_id = create_canonical_match_id(user_id, matched_user_id)
+    interest = {user_id: {"showed_interest": True, "interested": show_interest}}
+    await (
+        afdb.collection("match_pair")
+        .document(match_id)
+        .set({"interest": interest}, merge=True)
+    )
+    LOGGER.info(f"Saved interest of {user_id=} in match {match_id}")
+
+
+async def get_matchmaking_status() -> MatchmakingStatus:
+    status_doc = await afdb.collection("status").document("matchmaking").get()
+
+    if not status_doc.exists:
+        LOGGER.warning("No matchmaking status found")
+        return MatchmakingStatus()
+
+    return MatchmakingStatus(**status_doc.to_dict())
+
+
+async def get_persona(user_id: str) -> Persona | None:
+    persona_doc = await afdb.collection("persona").document(user_id).get()
+
+    if not persona_doc.exists:
+        LOGGER.warning(f"No persona found for {user_id=}")
+        return None
+
+    return Persona(**persona_doc.to_dict(), user_id=user_id)
+
+
+async def save_persona(
+    user_id: str, persona_description: str, new_scores: dict[str, int] | None = None
+):
+    update_props = {"description": persona_description}
+    if new_scores:
+        update_props["profile_category_scores"] = new_scores
+    marker_ref = afdb.collection("change_marker").document(user_id)
+    await asyncio.gather(
+        afdb.collection("persona").document(user_id).set(update_props, merge=True),
+        marker_ref.set(fire_utils.change_marker()),
+    )
+    LOGGER.info(f"Persona successfully saved/updated for {user_id=}")
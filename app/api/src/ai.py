@@ -1,17 +1,31 @@
 import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from src import LOGGER
-from openai import OpenAI
-from src import fire_utils, prompts, themes
-from src.models import Profile, MatchResult
+from src import cache, fire_utils, llm, prompts, ratelimit, themes
+from src.models import GroupMatchResult, Profile, MatchResult, Persona
 
 MODEL_NAME = os.getenv("MODEL_NAME")
+MAX_CONCURRENT_RANKINGS = int(os.getenv("MAX_CONCURRENT_RANKINGS", 8))
+RANKING_TIMEOUT_S = float(os.getenv("RANKING_TIMEOUT_S", 60))
+# prospects ranked per call for a matchee, 1 ranks every pair on its own
+RANKING_GROUP_SIZE = int(os.getenv("RANKING_GROUP_SIZE", 1))
 
 
-def get_gpt_response(messages: list[dict], response_format=None) -> str:
+def get_gpt_response(
+    messages: list[dict],
+    response_format=None,
+    timeout: float | None = None,
+    label: str = "other",
+) -> str:
+    """Complete `messages`, recording the call's token usage under `label` in `llm.USAGE`."""
     assert MODEL_NAME, "OpenAI model name not found"
     assert "OPENAI_API_KEY" in os.environ, "OpenAI API key not found"
 
-    CLIENT = OpenAI()
+    CLIENT = llm.get_client()
+    if timeout:
+        CLIENT = CLIENT.with_options(timeout=timeout, max_retries=0)
+    start = time.monotonic()
     if response_format:
         completion = CLIENT.beta.chat.completions.parse(
             model=MODEL_NAME, messages=messages, response_format=response_format
@@ -20,34 +34,91 @@ def get_gpt_response(messages: list[dict], response_format=None) -> str:
     else:
         completion = CLIENT.chat.completions.create(model=MODEL_NAME, messages=messages)
         response = completion.choices[0].message.content
+    llm.USAGE.record(label, completion.usage, time.monotonic() - start)
     return response
 
 
-GENERATOR = get_gpt_response
+async def aget_gpt_response(
+    messages: list[dict],
+    response_format=None,
+    timeout: float | None = None,
+    label: str = "other",
+) -> str:
+    """The async counterpart of `get_gpt_response`, for the API routes."""
+    assert MODEL_NAME, "OpenAI model name not found"
+    assert "OPENAI_API_KEY" in os.environ, "OpenAI API key not found"
+
+    CLIENT = llm.get_async_client()
+    if timeout:
+        CLIENT = CLIENT.with_options(timeout=timeout, max_retries=0)
+    start = time.monotonic()
+    if response_format:
+        completion = await CLIENT.beta.chat.completions.parse(
+            model=MODEL_NAME, messages=messages, response_format=response_format
+        )
+        response = completion.choices[0].message.parsed
+    else:
+        completion = await CLIENT.chat.completions.create(
+            model=MODEL_NAME, messages=messages
+        )
+        response = completion.choices[0].message.content
+    llm.USAGE.record(label, completion.usage, time.monotonic() - start)
+    return response
+
+
+GENERATOR = ratelimit.rate_limited(get_gpt_response)
+AGENERATOR = ratelimit.rate_limited(aget_gpt_response)
+
+
+def ranking_prompt(
+    user_profile: Profile, other_profile: Profile, persona1: Persona, persona2: Persona
+) -> str:
+    return prompts.MATCH_RANKING.format(
+        profile1=user_profile.to_string(),
+        profile2=other_profile.to_string(),
+        persona1=persona1,
+        persona2=persona2,
+        themes=themes.make_str_from_themes(themes.DATING_THEMES),
+    )
 
 
-def rank_match(user_profile: Profile, other_profile: Profile) -> MatchResult:
-    persona1 = fire_utils.get_persona(user_profile.user_id)
-    persona2 = fire_utils.get_persona(other_profile.user_id)
+def rank_match(
+    user_profile: Profile,
+    other_profile: Profile,
+    personas: dict[str, Persona] | None = None,
+) -> MatchResult:
+    if personas is not None:
+        persona1 = personas.get(user_profile.user_id)
+        persona2 = personas.get(other_profile.user_id)
+    else:
+        persona1 = fire_utils.get_persona(user_profile.user_id)
+        persona2 = fire_utils.get_persona(other_profile.user_id)
 
     no_data = "Not enough information to consider match"
     result = MatchResult(
         compatibility_rating=0.0, rationale1=no_data, rationale2=no_data
     )
     if persona1 and persona2:
-        prompt = prompts.MATCH_RANKING.format(
-            profile1=user_profile.to_string(),
-            profile2=other_profile.to_string(),
-            persona1=persona1,
-            persona2=persona2,
-            themes=themes.make_str_from_themes(themes.DATING_THEMES)
-        )
+        ranking_cache = cache.get_ranking_cache()
+        if ranking_cache:
+            cached = ranking_cache.get(user_profile, persona1, other_profile, persona2)
+            if cached:
+                return cached
+        prompt = ranking_prompt(user_profile, other_profile, persona1, persona2)
+        # Errors left after the rate limiter's retries propagate, so the pair
+        # is left out and ranked again by the next run instead of scoring 0
         try:
             result = GENERATOR(
-                [{"role": "system", "content": prompt}], response_format=MatchResult
+                [{"role": "system", "content": prompt}],
+                response_format=MatchResult,
+                timeout=RANKING_TIMEOUT_S,
+                label="match_ranking",
             )
         except Exception as e:
             LOGGER.error(f"Error while ranking match with {prompt=}\n {e}")
+            raise
+        if ranking_cache:
+            ranking_cache.put(user_profile, persona1, other_profile, persona2, result)
     else:
         LOGGER.warning(
             f"Not enough information to consider match between {user_profile=} and {other_profile=}"
@@ -55,22 +126,220 @@ def rank_match(user_profile: Profile, other_profile: Profile) -> MatchResult:
     return result
 
 
-def parallel_matching(
-    user_profile: Profile, potential_matches: list[Profile]
+def group_ranking_prompt(
+    user_profile: Profile,
+    persona: Persona,
+    others: list[tuple[Profile, Persona]],
+) -> str:
+    candidates = "\n\n".join(
+        f"Candidate {i}\nProfile: {profile.to_string()}\nPersona: {other_persona}"
+        for i, (profile, other_persona) in enumerate(others, start=1)
+    )
+    return prompts.GROUP_MATCH_RANKING.format(
+        profile=user_profile.to_string(),
+        persona=persona,
+        candidates=candidates,
+        themes=themes.make_str_from_themes(themes.DATING_THEMES),
+    )
+
+
+def rank_group(
+    user_profile: Profile,
+    other_profiles: list[Profile],
+    personas: dict[str, Persona] | None = None,
 ) -> dict[str, MatchResult]:
-    match_results = {}
+    """Rank a user against several prospects in one call, sharing the prompt's common context.
+
+    Prospects that are cached or missing a persona are resolved as in
+    `rank_match`. Any prospect the group response does not score exactly once
+    with a valid rating, or all of them if the call fails, is ranked on its own.
+    A prospect whose own ranking fails is logged and left out of the results.
+    """
+    if personas is None:
+        personas = fire_utils.get_all_personas(
+            [user_profile.user_id] + [p.user_id for p in other_profiles]
+        )
+    persona = personas.get(user_profile.user_id)
+    ranking_cache = cache.get_ranking_cache()
+    results, group = {}, []
+    for other_profile in other_profiles:
+        other_persona = personas.get(other_profile.user_id)
+        cached = (
+            ranking_cache.get(user_profile, persona, other_profile, other_persona)
+            if ranking_cache and persona and other_persona
+            else None
+        )
+        if cached:
+            results[other_profile.user_id] = cached
+        elif persona and other_persona:
+            group.append((other_profile, other_persona))
+        else:
+            results[other_profile.user_id] = rank_match(
+                user_profile, other_profile, personas
+            )
+    if len(group) == 1:
+        _rank_each(user_profile, [group[0][0]], personas, results)
+        return results
+    if not group:
+        return results
+
     try:
-        for p in potential_matches:
+        response = GENERATOR(
+            [
+                {
+                    "role": "system",
+                    "content": group_ranking_prompt(user_profile, persona, group),
+                }
+            ],
+            response_format=GroupMatchResult,
+            # the response holds a result per prospect
+            timeout=RANKING_TIMEOUT_S * len(group),
+            label="group_match_ranking",
+        )
+        scored = [r.candidate for r in response.results]
+        for r in response.results:
+            if (
+                scored.count(r.candidate) == 1
+                and 1 <= r.candidate <= len(group)
+                and 1 <= r.compatibility_rating <= 10
+            ):
+                other_profile, other_persona = group[r.candidate - 1]
+                result = MatchResult(**r.dict(exclude={"candidate"}))
+                results[other_profile.user_id] = result
+                if ranking_cache:
+                    ranking_cache.put(
+                        user_profile, persona, other_profile, other_persona, result
+                    )
+    except Exception as e:
+        LOGGER.error(
+            f"Error while group ranking {user_profile.user_id=}, ranking each pair: {e}"
+        )
+
+    missing = [p for p, _ in group if p.user_id not in results]
+    if missing:
+        LOGGER.warning(
+            f"Group ranking for {user_profile.user_id=} missed {len(missing)} of {len(group)} prospects, ranking them one by one"
+        )
+    _rank_each(user_profile, missing, personas, results)
+    return results
+
+
+def _rank_each(
+    user_profile: Profile,
+    other_profiles: list[Profile],
+    personas: dict[str, Persona],
+    results: dict[str, MatchResult],
+):
+    """Rank prospects one by one into `results`, leaving out any whose ranking fails."""
+    for other_profile in other_profiles:
+        try:
+            results[other_profile.user_id] = rank_match(
+                user_profile, other_profile, personas
+            )
+        except Exception as e:
+            LOGGER.error(
+                f"Match ranking {(other_profile.user_id, user_profile.user_id)} generated exception: {e}"
+            )
+
+
+class RankingScheduler:
+    """A work queue feeding (matchee, prospect) pairs through one shared worker pool.
+
+    Pairs are keyed by a caller supplied ID (e.g. the canonical match ID), so a
+    pair that is submitted more than once is only ranked the first time.
+    Preloaded `personas` are used instead of fetching them for every pair.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = MAX_CONCURRENT_RANKINGS,
+        personas: dict[str, Persona] | None = None,
+    ):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        self._personas = personas
+        self._tasks: dict[str, tuple[str, str, Future]] = {}
+
+    def __enter__(self) -> "RankingScheduler":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._executor.shutdown(wait=exc_type is None, cancel_futures=True)
+
+    def __contains__(self, task_id: str) -> bool:
+        return task_id in self._tasks
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def submit(
+        self, task_id: str, user_profile: Profile, other_profile: Profile
+    ) -> bool:
+        if task_id in self._tasks:
+            return False
+        future = self._executor.submit(
+            rank_match, user_profile, other_profile, self._personas
+        )
+        self._tasks[task_id] = (user_profile.user_id, other_profile.user_id, future)
+        return True
+
+    def submit_group(
+        self,
+        task_ids: list[str],
+        user_profile: Profile,
+        other_profiles: list[Profile],
+    ) -> int:
+        """Rank a user against several prospects in one `rank_group` call.
+
+        Each prospect keeps its own task, so `results` is the same as if the
+        pairs were submitted one by one. Returns the number of new tasks.
+        """
+        new = [
+            (task_id, other)
+            for task_id, other in zip(task_ids, other_profiles)
+            if task_id not in self._tasks
+        ]
+        if not new:
+            return 0
+        group_future = self._executor.submit(
+            rank_group, user_profile, [other for _, other in new], self._personas
+        )
+        pair_futures = {}
+        for task_id, other in new:
+            pair_futures[other.user_id] = Future()
+            self._tasks[task_id] = (
+                user_profile.user_id,
+                other.user_id,
+                pair_futures[other.user_id],
+            )
+
+        def resolve(future: Future):
             try:
-                match = rank_match(user_profile, p)
-                LOGGER.debug(
-                    f"Match between {user_profile.user_id=} and {p.user_id=}: {match=}"
-                )
-                match_results[p.user_id] = match
+                ranked = future.result()
             except Exception as e:
-                LOGGER.error(
-                    f"Match ranking {(p.user_id, user_profile.user_id)} generated exception: {e}"
-                )
-    except Exception as e:
-        LOGGER.error(f"Error while matching: {e}")
-    return match_results
+                for pair_future in pair_futures.values():
+                    pair_future.set_exception(e)
+                return
+            for other_id, pair_future in pair_futures.items():
+                if other_id in ranked:
+                    pair_future.set_result(ranked[other_id])
+                else:
+                    pair_future.set_exception(
+                        RuntimeError(
+                            f"Could not rank {other_id} for {user_profile.user_id}"
+                        )
+                    )
+
+        group_future.add_done_callback(resolve)
+        return len(new)
+
+    def results(self) -> dict[str, tuple[str, str, MatchResult]]:
+        """Wait for every submitted pair, dropping (and logging) any that failed."""
+        ranked = {}
+        for task_id, (user1, user2, future) in self._tasks.items():
+            try:
+                match = future.result()
+                LOGGER.debug(f"Match between {user1=} and {user2=}: {match=}")
+                ranked[task_id] = (user1, user2, match)
+            except Exception as e:
+                LOGGER.error(f"Match ranking {(user2, user1)} generated exception: {e}")
+        return ranked
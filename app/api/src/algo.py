@@ -1,74 +1,206 @@
-from src import ai, LOGGER, fire_utils
+from src import (
+    ai,
+    allocation,
+    ann,
+    batch,
+    cache,
+    embeddings,
+    LOGGER,
+    fire_utils,
+    llm,
+    ratelimit,
+    snapshot,
+)
 from src.models import (
     RecordedMatch,
     Profile,
+    Persona,
     MatchResult,
+    StoredMatches,
+    compute_ages,
+    create_canonical_match_id,
 )
+from src.buckets import EligibilityBuckets
+from src.columnar import ProfileTable
+from src.geo import SpatialIndex
+from src.incremental import find_changed_users, mark_evaluated, user_fingerprints
+import numpy as np
 import datetime
 import pytz
+import os
 
 N_SUBSET = 20
 MIN_SCORE = 8
 MAX_MATCHES_PER_USER = 3
-
-
-def create_canonical_match_id(user1: str, user2: str) -> str:
-    """Create a consistent match ID regardless of user order."""
-    return "_".join(sorted([user1, user2]))
-
-
-def find_new_prospects(
-    profile: Profile, all_user_profiles: list[Profile], existing_match_ids: set[str]
-) -> dict[str, MatchResult]:
-    """Find new prospects, filtering out any existing matches using canonical IDs."""
-    valid_new_prospects = fire_utils.apply_preference_filters(
-        profile, all_user_profiles
-    )
-    if not valid_new_prospects:
-        LOGGER.warning(
-            f"No valid prospects for {profile.user_id=}. Returning empty results."
+# Pre-ranking is for the cron job, /matches/create takes candidates in stream
+# order rather than reading and embedding every candidate's persona in the request
+EMBEDDING_PRERANK = os.getenv("EMBEDDING_PRERANK", "true").lower() == "true"
+
+
+_JOB_SOURCE: snapshot.Snapshot | None = None
+
+
+def get_job_source():
+    """Return where the cron job reads its inputs, the MATCHMAKING_SNAPSHOT if set or Firestore."""
+    global _JOB_SOURCE
+    if not snapshot.MATCHMAKING_SNAPSHOT:
+        return fire_utils
+    if _JOB_SOURCE is None:
+        _JOB_SOURCE = snapshot.load_snapshot()
+    return _JOB_SOURCE
+
+
+def get_profile_columns(source) -> dict[str, np.ndarray] | None:
+    """Return the profile columns stored in a snapshot source, or None to encode them from the profiles."""
+    if isinstance(source, snapshot.Snapshot):
+        return source.get_profile_columns()
+    return None
+
+
+def select_prospects(
+    profile: Profile,
+    all_user_profiles: list[Profile],
+    existing_match_ids: set[str],
+    profile_table: ProfileTable | None = None,
+    persona_vectors: dict[str, np.ndarray] | None = None,
+    persona_index: ann.IVFIndex | None = None,
+) -> list[Profile]:
+    """Select the prospects to rank for a user, filtering out any existing matches using canonical IDs.
+
+    With `persona_vectors` the N_SUBSET prospects sent to the LLM are the most
+    similar personas rather than the first in Firestore order.
+    """
+    if profile_table and profile.user_id in profile_table.index_of:
+        valid_new_prospects = profile_table.filter(profile, all_user_profiles)
+    else:
+        valid_new_prospects = fire_utils.apply_preference_filters(
+            profile, all_user_profiles
         )
-        return {}
+    if not valid_new_prospects:
+        LOGGER.warning(f"No valid prospects for {profile.user_id=}.")
+        return []
     LOGGER.debug(
         f"Found {len(valid_new_prospects)} profiles after preference filtering for {profile.user_id=}"
     )
 
     # Filter out prospects that would create duplicate matches
-    filtered_prospects = []
-    for prospect in valid_new_prospects[:N_SUBSET]:
-        match_id = create_canonical_match_id(profile.user_id, prospect.user_id)
-        if match_id not in existing_match_ids:
-            filtered_prospects.append(prospect)
+    if persona_vectors is not None:
+        new_prospects = {
+            p.user_id: p
+            for p in valid_new_prospects
+            if create_canonical_match_id(profile.user_id, p.user_id)
+            not in existing_match_ids
+        }
+        top_ids = embeddings.top_k_similar(
+            profile.user_id,
+            list(new_prospects),
+            persona_vectors,
+            N_SUBSET,
+            persona_index,
+        )
+        filtered_prospects = [new_prospects[i] for i in top_ids]
+    else:
+        filtered_prospects = []
+        for prospect in valid_new_prospects[:N_SUBSET]:
+            match_id = create_canonical_match_id(profile.user_id, prospect.user_id)
+            if match_id not in existing_match_ids:
+                filtered_prospects.append(prospect)
 
     if not filtered_prospects:
         LOGGER.warning(
-            f"No valid prospects after duplicate filtering for {profile.user_id=}. Returning empty results."
+            f"No valid prospects after duplicate filtering for {profile.user_id=}."
         )
-        return {}
+        return []
 
     LOGGER.debug(
         f"Found {len(filtered_prospects)} profiles after reducing search space and duplicate filtering for {profile.user_id=}"
     )
+    return filtered_prospects
+
+
+def plan_match_pairs(
+    matchee_profiles: list[Profile],
+    all_user_profiles: list[Profile],
+    existing_match_ids: set[str],
+    persona_vectors: dict[str, np.ndarray] | None = None,
+    persona_index: ann.IVFIndex | None = None,
+    profile_columns: dict[str, np.ndarray] | None = None,
+) -> dict[str, tuple[Profile, Profile]]:
+    """Run every matchee's preference filter up front and return each unique canonical pair once.
+
+    When two users surface each other the pair is planned for whichever is seen
+    first, so it is ranked once and both sides share that single MatchResult.
+    """
+    planned_pairs: dict[str, tuple[Profile, Profile]] = {}
+    num_mutual = 0
+    # Build the columnar table once so each user's filter is a few vectorized
+    # masks over the candidates in compatible eligibility buckets, with distance
+    # limited users only scanning nearby profiles
+    profile_table = ProfileTable(
+        all_user_profiles,
+        spatial_index=SpatialIndex(all_user_profiles),
+        columns=profile_columns,
+    )
+    eligibility_buckets = EligibilityBuckets(all_user_profiles)
+    for profile in matchee_profiles:
+        candidates = eligibility_buckets.candidates(profile)
+        for prospect in select_prospects(
+            profile,
+            candidates,
+            existing_match_ids,
+            profile_table,
+            persona_vectors,
+            persona_index,
+        ):
+            match_id = create_canonical_match_id(profile.user_id, prospect.user_id)
+            if match_id in planned_pairs:
+                num_mutual += 1
+                continue
+            planned_pairs[match_id] = (profile, prospect)
 
-    match_results = ai.parallel_matching(profile, filtered_prospects)
-    top_ranked_matches = {
-        k: v
-        for k, v in sorted(
-            match_results.items(),
-            key=lambda item: item[1].compatibility_rating,
-            reverse=True,
-        )
-        if v.compatibility_rating >= MIN_SCORE
-    }
-
-    if not top_ranked_matches:
-        LOGGER.warning(f"No matches found for {profile.user_id=}.")
-        return {}
-
-    LOGGER.debug(
-        f"Found {len(top_ranked_matches)} top ranked matches for {profile.user_id=}"
+    LOGGER.info(
+        f"Planned {len(planned_pairs)} unique match pairs ({num_mutual} mutual duplicates skipped)"
+    )
+    return planned_pairs
+
+
+def rank_planned_pairs(
+    planned_pairs: dict[str, tuple[Profile, Profile]],
+    personas: dict[str, Persona] | None = None,
+    offline: bool = False,
+    batch_ids=None,
+) -> dict[str, tuple[str, str, MatchResult]]:
+    """Rank each planned pair exactly once on the shared worker pool.
+
+    `offline` runs (the cron job) go through the RANKING_BACKEND batch backend
+    instead, unless it is "online", keeping the batch IDs in `batch_ids`.
+    """
+    if offline and batch.RANKING_BACKEND != "online":
+        return batch.rank_pairs(planned_pairs, personas, batch_ids)
+    with ai.RankingScheduler(personas=personas) as scheduler:
+        if ai.RANKING_GROUP_SIZE > 1:
+            # Rank each matchee against groups of their prospects
+            by_matchee: dict[str, list[tuple[str, Profile, Profile]]] = {}
+            for match_id, (profile, prospect) in planned_pairs.items():
+                by_matchee.setdefault(profile.user_id, []).append(
+                    (match_id, profile, prospect)
+                )
+            for pairs in by_matchee.values():
+                for i in range(0, len(pairs), ai.RANKING_GROUP_SIZE):
+                    group = pairs[i : i + ai.RANKING_GROUP_SIZE]
+                    scheduler.submit_group(
+                        [match_id for match_id, _, _ in group],
+                        group[0][1],
+                        [prospect for _, _, prospect in group],
+                    )
+        else:
+            for match_id, (profile, prospect) in planned_pairs.items():
+                scheduler.submit(match_id, profile, prospect)
+        ranked_pairs = scheduler.results()
+    LOGGER.info(
+        f"Ranked {len(ranked_pairs)} of {len(planned_pairs)} pairs, LLM rate limiter {ratelimit.LIMITER.stats}, LLM usage {llm.USAGE.stats}"
     )
-    return top_ranked_matches
+    return ranked_pairs
 
 
 def get_existing_match_ids(
@@ -83,73 +215,91 @@ def get_existing_match_ids(
     return existing_ids
 
 
-def matchmaking(user_id: str | None = None):
-    # Initialize matchmaking status
-    current_status = fire_utils.get_matchmaking_status()
-    if user_id:
-        LOGGER.info(f"Generating matches for {user_id=}")
-        matchee_profiles = [fire_utils.get_profile(user_id)]
-    else:
-        current_status.start()  # only start for daily cron job
-        fire_utils.save_matchmaking_status(current_status)
-        LOGGER.info("Generating matches for all users")
-        matchee_profiles = fire_utils.get_all_profiles()
+def current_valid_matches(stored_matches: StoredMatches) -> list[RecordedMatch]:
+    return [
+        r
+        for r in stored_matches.matches
+        if (datetime.datetime.now(pytz.utc) - r.date_matched).days < 7
+    ]
 
-    all_user_profiles = fire_utils.get_all_profiles()
 
-    # Get all existing matches and create canonical IDs
-    user_current_valid_matches: dict[str, list[RecordedMatch]] = {}
-    for profile in matchee_profiles:
-        stored_matches = fire_utils.get_matches(profile.user_id)
-        user_current_valid_matches[profile.user_id] = [
-            r
-            for r in stored_matches.matches
-            if (datetime.datetime.now(pytz.utc) - r.date_matched).days < 7
-        ]
+def embed_personas(
+    personas: dict[str, Persona], sync_index: bool = False, embed_stale: bool = True
+) -> tuple[dict[str, np.ndarray] | None, ann.IVFIndex | None]:
+    """Embed personas for pre-ranking, with the saved ANN index either synced or read only.
 
-    existing_match_ids = get_existing_match_ids(user_current_valid_matches)
-    LOGGER.debug(f"Found {len(existing_match_ids)} existing match IDs")
-
-    # Store prospective matches using canonical IDs
-    all_match_prospects: dict[str, tuple[str, str, MatchResult]] = {}
-
-    for profile in matchee_profiles:
-        LOGGER.info(f"Generating matches for {profile.user_id=}")
-
-        # Get potential profiles excluding already matched users
-        all_potential_profiles = [
-            p for p in all_user_profiles if p.user_id != profile.user_id
-        ]
-
-        LOGGER.debug(
-            f"Found {len(all_potential_profiles)} potential match profiles for {profile.user_id=}"
+    Without `embed_stale` only the stored embeddings are read. Returns
+    (None, None) on failure, so prospects fall back to stream order.
+    """
+    try:
+        persona_vectors = embeddings.load_persona_vectors(
+            personas, embed_stale=embed_stale
         )
-
-        # Find new prospects
-        top_ranked_matches = find_new_prospects(
-            profile, all_potential_profiles, existing_match_ids
+        persona_index = (
+            ann.sync_persona_index(persona_vectors)
+            if sync_index
+            else ann.get_persona_index()
         )
+        return persona_vectors, persona_index
+    except Exception as e:
+        LOGGER.error(f"Error while embedding personas, using stream order: {e}")
+        return None, None
+
+
+def drop_deleted_users(
+    ranked_pairs: dict[str, tuple[str, str, MatchResult]], source=fire_utils
+) -> dict[str, tuple[str, str, MatchResult]]:
+    """Drop the pairs of users whose profile was deleted since `source` was read.
+
+    A snapshot can be a day old, so before allocating from one its users
+    are checked against the live profile IDs.
+    """
+    if not isinstance(source, snapshot.Snapshot):
+        return ranked_pairs
+    live_user_ids = fire_utils.get_profile_ids()
+    kept = {
+        match_id: pair
+        for match_id, pair in ranked_pairs.items()
+        if pair[0] in live_user_ids and pair[1] in live_user_ids
+    }
+    if len(kept) < len(ranked_pairs):
+        LOGGER.info(
+            f"Dropped {len(ranked_pairs) - len(kept)} ranked pairs of users deleted since the snapshot"
+        )
+    return kept
+
+
+def allocate_matches(
+    ranked_pairs: dict[str, tuple[str, str, MatchResult]],
+    user_current_valid_matches: dict[str, list[RecordedMatch]],
+    stored_matches: dict[str, StoredMatches] | None = None,
+    source=fire_utils,
+) -> int:
+    """Record the best allocation of ranked pairs, at most MAX_MATCHES_PER_USER new matches per user.
+
+    New matches are appended to `user_current_valid_matches`, which is filled in
+    with the current matches of any partner not already in it, and their stored
+    matches are added to `stored_matches`, loaded from `source`. Returns the
+    number of new matches.
+    """
+    # Store prospective matches using canonical IDs
+    all_match_prospects: dict[str, tuple[str, str, MatchResult]] = {
+        match_id: ranked
+        for match_id, ranked in ranked_pairs.items()
+        if ranked[2].compatibility_rating >= MIN_SCORE
+    }
 
-        # Store matches using canonical IDs
-        for matched_user_id, match_result in top_ranked_matches.items():
-            match_id = create_canonical_match_id(profile.user_id, matched_user_id)
-            if match_id not in all_match_prospects:
-                all_match_prospects[match_id] = (
-                    profile.user_id,
-                    matched_user_id,
-                    match_result,
-                )
-
-    # Process and save matches
-    sorted_prospects = sorted(
-        all_match_prospects.values(),
-        key=lambda x: x[2].compatibility_rating,
-        reverse=True,
-    )
-
+    # Process and save matches, breaking ties by match ID so a sharded run,
+    # whose pairs arrive in checkpoint order, allocates as a single run does
+    sorted_prospects = [
+        all_match_prospects[match_id]
+        for match_id in sorted(
+            all_match_prospects,
+            key=lambda m: (-all_match_prospects[m][2].compatibility_rating, m),
+        )
+    ]
     if not sorted_prospects:
-        LOGGER.info("No matches found, exiting")
-        return {"message": "No matches found"}
+        return 0
 
     _max, _min = (
         sorted_prospects[0][2].compatibility_rating,
@@ -159,21 +309,29 @@ def matchmaking(user_id: str | None = None):
         f"Found {len(sorted_prospects)} total prospective matches, score range max={_max}, min={_min}"
     )
 
-    # Track matches per user and save new matches
-    num_new_matches = 0
-    count_matches_per_user: dict[str, int] = {}
-
-    for user1, user2, match_result in sorted_prospects:
-        user1_count = count_matches_per_user.get(user1, 0)
-        user2_count = count_matches_per_user.get(user2, 0)
-
-        if user1_count >= MAX_MATCHES_PER_USER or user2_count >= MAX_MATCHES_PER_USER:
-            LOGGER.debug(
-                f"Skipping match {user1=} - {user2=}, score={match_result.compatibility_rating}"
+    # Users who were only ever prospects keep their other current matches when
+    # their match documents are rewritten
+    partner_ids = {uid for u1, u2, _ in sorted_prospects for uid in (u1, u2)} - set(
+        user_current_valid_matches
+    )
+    if partner_ids:
+        partner_stored_matches = source.get_all_matches(list(partner_ids))
+        for partner_id, partner_matches in partner_stored_matches.items():
+            user_current_valid_matches[partner_id] = current_valid_matches(
+                partner_matches
             )
-            continue
+        if stored_matches is not None:
+            stored_matches.update(partner_stored_matches)
+
+    # Choose the matches to make across every user at once
+    edges = [(u1, u2, r.compatibility_rating) for u1, u2, r in sorted_prospects]
+    chosen, _ = allocation.allocate(edges, MAX_MATCHES_PER_USER)
+    if allocation.ALLOCATION_COMPARE:
+        allocation.compare_strategies(edges, MAX_MATCHES_PER_USER)  # logs each report
 
-        # Create and save matches for both users
+    num_new_matches = 0
+    for i in sorted(chosen):
+        user1, user2, match_result = sorted_prospects[i]
         user1_match, user2_match = RecordedMatch.from_match_result(
             user1, user2, match_result
         )
@@ -186,15 +344,121 @@ def matchmaking(user_id: str | None = None):
             f"Saved match {user1=} - {user2=}, score={match_result.compatibility_rating}"
         )
 
-        # Update match counts
-        count_matches_per_user[user1] = user1_count + 1
-        count_matches_per_user[user2] = user2_count + 1
+    return num_new_matches
+
+
+def matchmaking(user_id: str | None = None, incremental: bool = False):
+    """Create new matches for one user, or for everyone in the daily cron job.
+
+    In `incremental` mode the cron job only evaluates users who are new or
+    changed since their last evaluation, against all of their candidates.
+    """
+    # Initialize matchmaking status
+    current_status = fire_utils.get_matchmaking_status()
+    source = fire_utils if user_id else get_job_source()
+    batch_ids = None
+    if user_id:
+        LOGGER.info(f"Generating matches for {user_id=}")
+        matchee_profiles = [fire_utils.get_profile(user_id)]
+        # Only profiles in compatible buckets of the cached index can match
+        all_user_profiles = fire_utils.get_eligibility_buckets().candidates(
+            matchee_profiles[0]
+        )
+    else:
+        # A run left IN_PROGRESS died, so resume the batches it submitted
+        interrupted = (
+            current_status.last_started
+            if current_status.status == "IN_PROGRESS"
+            else None
+        )
+        current_status.start()  # only start for daily cron job
+        batch_ids = batch.RunBatchIds(interrupted or current_status.last_started)
+        fire_utils.save_matchmaking_status(current_status)
+        LOGGER.info("Generating matches for all users")
+        all_user_profiles = source.get_compact_profiles()
+        matchee_profiles = list(all_user_profiles)
+        # Ages are read for every candidate pair, so parse them once per run
+        compute_ages(all_user_profiles)
+
+    personas = None
+    if incremental and not user_id:
+        personas = source.get_all_personas()
+        matchee_profiles = find_changed_users(matchee_profiles, personas)
+
+    # Get all existing matches in one pass and create canonical IDs
+    all_stored_matches = source.get_all_matches(
+        [profile.user_id for profile in matchee_profiles]
+        if user_id or incremental
+        else None
+    )
+    user_current_valid_matches: dict[str, list[RecordedMatch]] = {}
+    for profile in matchee_profiles:
+        stored_matches = all_stored_matches.get(
+            profile.user_id, StoredMatches(matches=[])
+        )
+        user_current_valid_matches[profile.user_id] = current_valid_matches(
+            stored_matches
+        )
+
+    existing_match_ids = get_existing_match_ids(user_current_valid_matches)
+    LOGGER.debug(f"Found {len(existing_match_ids)} existing match IDs")
+
+    # Load every persona once, rather than per pair, and embed them so the
+    # job's LLM calls are spent on the most similar candidates, keeping the
+    # saved ANN index in line with every persona
+    persona_vectors, persona_index = None, None
+    if EMBEDDING_PRERANK and not user_id:
+        if personas is None:
+            personas = source.get_all_personas()
+        persona_vectors, persona_index = embed_personas(personas, sync_index=True)
+
+    # Plan the unique canonical pairs across all users, then rank each once
+    planned_pairs = plan_match_pairs(
+        matchee_profiles,
+        all_user_profiles,
+        existing_match_ids,
+        persona_vectors,
+        persona_index,
+        None if user_id else get_profile_columns(source),
+    )
+    if personas is None:
+        personas = source.get_all_personas(
+            [p.user_id for pair in planned_pairs.values() for p in pair]
+            if user_id
+            else None
+        )
+    ranked_pairs = rank_planned_pairs(
+        planned_pairs, personas, offline=not user_id, batch_ids=batch_ids
+    )
+
+    ranking_cache = cache.get_ranking_cache()
+    if ranking_cache:
+        LOGGER.info(f"Ranking cache {ranking_cache.stats}")
+        if not user_id:
+            LOGGER.info(f"Evicted {ranking_cache.store.evict()} ranking cache entries")
+
+    ranked_pairs = drop_deleted_users(ranked_pairs, source)
+    num_new_matches = allocate_matches(
+        ranked_pairs, user_current_valid_matches, all_stored_matches, source
+    )
+    if not num_new_matches:
+        if incremental and not user_id:
+            mark_evaluated(user_fingerprints(matchee_profiles, personas))
+        if not user_id:
+            batch_ids.release()
+            current_status.stop()
+            fire_utils.save_matchmaking_status(current_status)
+        LOGGER.info("No matches found, exiting")
+        return {"message": "No matches found"}
 
     # Save results
     LOGGER.info(f"Saving {num_new_matches} new matches")
-    fire_utils.batch_save_matches(user_current_valid_matches)
+    fire_utils.batch_save_matches(user_current_valid_matches, all_stored_matches)
+    if incremental and not user_id:
+        mark_evaluated(user_fingerprints(matchee_profiles, personas))
 
     if not user_id:
+        batch_ids.release()
         current_status.stop()
         fire_utils.save_matchmaking_status(current_status)
 
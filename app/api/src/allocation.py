@@ -0,0 +1,186 @@
+import os
+import time
+from collections import defaultdict
+from pydantic import BaseModel
+from src import LOGGER
+
+ALLOCATION_STRATEGY = os.getenv("ALLOCATION_STRATEGY", "bmatching")  # or "greedy"
+ALLOCATION_COMPARE = os.getenv("ALLOCATION_COMPARE", "false").lower() == "true"
+ALLOCATION_TIME_LIMIT_S = float(os.getenv("ALLOCATION_TIME_LIMIT_S", 120))
+LOCAL_SEARCH_PASSES = 20
+
+# (user1, user2, score) for each candidate match
+Edge = tuple[str, str, int]
+
+
+class AllocationReport(BaseModel):
+    strategy: str
+    total_score: int
+    num_matches: int
+    coverage: float  # fraction of users in the candidate graph given a match
+    runtime_s: float
+
+
+def greedy(edges: list[Edge], capacity: int) -> list[int]:
+    """Take edges best first while both users are under `capacity`, the original baseline."""
+    order = sorted(range(len(edges)), key=lambda i: -edges[i][2])
+    degree: dict[str, int] = defaultdict(int)
+    chosen = []
+    for i in order:
+        u, v, _ = edges[i]
+        if degree[u] < capacity and degree[v] < capacity:
+            chosen.append(i)
+            degree[u] += 1
+            degree[v] += 1
+    return chosen
+
+
+def bmatching(edges: list[Edge], capacity: int) -> list[int]:
+    """Approximate a maximum weight b-matching by improving the greedy solution with local search.
+
+    Each move adds an unchosen edge, drops the weakest chosen edge at any user
+    it would push over `capacity`, and refills the users those dropped edges
+    free up with their best remaining edge. A move is kept if it raises the
+    total score, or keeps it and matches more users. This finds the short
+    augmenting paths greedy misses, in near-linear time per pass. The search
+    stops after ALLOCATION_TIME_LIMIT_S, keeping the best allocation so far.
+    """
+    deadline = time.perf_counter() + ALLOCATION_TIME_LIMIT_S
+    selected = set(greedy(edges, capacity))
+    order = sorted(range(len(edges)), key=lambda i: -edges[i][2])
+    at: dict[str, set[int]] = defaultdict(set)
+    # each user's (edge, other user) pairs, best first
+    adjacent: dict[str, list[tuple[int, str]]] = defaultdict(list)
+    edge_between: dict[tuple[str, str], int] = {}
+    for i in order:
+        u, v, _ = edges[i]
+        adjacent[u].append((i, v))
+        adjacent[v].append((i, u))
+        edge_between[(u, v)] = edge_between[(v, u)] = i
+    for i in selected:
+        u, v, _ = edges[i]
+        at[u].add(i)
+        at[v].add(i)
+    # how many of each user's candidates have room for another match
+    room_nearby: dict[str, int] = defaultdict(int)
+    spare = {x for x in adjacent if len(at[x]) < capacity}
+    for x in spare:
+        for _, y in adjacent[x]:
+            room_nearby[y] += 1
+
+    def best_refill(y: str, delta: dict[str, int], added: list[int]) -> int | None:
+        """Return the best unchosen edge from `y` to a user with room after the move."""
+
+        def has_room(f: int | None, z: str) -> bool:
+            return (
+                f is not None
+                and f not in selected
+                and f not in added
+                and len(at[z]) + delta.get(z, 0) < capacity
+            )
+
+        # users in the move are the only ones whose room changes
+        options = [
+            f
+            for f, z in ((edge_between.get((y, z)), z) for z in delta)
+            if has_room(f, z)
+        ]
+        if room_nearby[y]:
+            # the first option is the best, as candidates are best first
+            options += [next((f for f, z in adjacent[y] if has_room(f, z)), None)]
+        options = [f for f in options if f is not None]
+        return min(options, key=lambda f: (-edges[f][2], f)) if options else None
+
+    def try_move(e: int) -> set[str]:
+        u, v, _ = edges[e]
+        full = [x for x in (u, v) if len(at[x]) >= capacity]
+        removed = [min(at[x], key=lambda i: edges[i][2]) for x in full]
+        delta: dict[str, int] = defaultdict(int)
+        for x in (u, v):
+            delta[x] += 1
+        for r in removed:
+            for x in edges[r][:2]:
+                delta[x] -= 1
+        added = [e]
+        for r, x in zip(removed, full):
+            y = edges[r][1] if edges[r][0] == x else edges[r][0]
+            if len(at[y]) + delta[y] >= capacity:
+                continue
+            f = best_refill(y, delta, added)
+            if f is not None:
+                added.append(f)
+                for z in edges[f][:2]:
+                    delta[z] += 1
+
+        gain = sum(edges[i][2] for i in added) - sum(edges[i][2] for i in removed)
+        covered = sum((len(at[x]) + d > 0) - (len(at[x]) > 0) for x, d in delta.items())
+        if gain < 0 or (gain == 0 and covered <= 0):
+            return set()
+        for r in removed:
+            selected.discard(r)
+            for x in edges[r][:2]:
+                at[x].discard(r)
+        for i in added:
+            selected.add(i)
+            for x in edges[i][:2]:
+                at[x].add(i)
+        for x in delta:
+            now_spare = len(at[x]) < capacity
+            if now_spare != (x in spare):
+                (spare.add if now_spare else spare.discard)(x)
+                for _, y in adjacent[x]:
+                    room_nearby[y] += 1 if now_spare else -1
+        return set(delta)
+
+    # After the first pass only edges near users whose matches changed can
+    # have a better move
+    pending = order
+    for _ in range(LOCAL_SEARCH_PASSES):
+        touched = set()
+        for e in pending:
+            if e not in selected:
+                touched |= try_move(e)
+            if time.perf_counter() > deadline:
+                LOGGER.warning("Stopping b-matching local search at its time limit")
+                return sorted(selected, key=lambda i: -edges[i][2])
+        if not touched:
+            break
+        nearby = touched | {x for t in touched for i in at[t] for x in edges[i][:2]}
+        pending = sorted(
+            {i for x in nearby for i, _ in adjacent[x]},
+            key=lambda i: (-edges[i][2], i),
+        )
+    return sorted(selected, key=lambda i: -edges[i][2])
+
+
+STRATEGIES = {"greedy": greedy, "bmatching": bmatching}
+
+
+def _report(
+    strategy: str, edges: list[Edge], chosen: list[int], runtime_s: float
+) -> AllocationReport:
+    users = {x for u, v, _ in edges for x in (u, v)}
+    matched = {x for i in chosen for x in edges[i][:2]}
+    return AllocationReport(
+        strategy=strategy,
+        total_score=sum(edges[i][2] for i in chosen),
+        num_matches=len(chosen),
+        coverage=len(matched) / len(users) if users else 0.0,
+        runtime_s=runtime_s,
+    )
+
+
+def allocate(
+    edges: list[Edge], capacity: int, strategy: str = ALLOCATION_STRATEGY
+) -> tuple[list[int], AllocationReport]:
+    """Choose the edges to turn into matches, at most `capacity` per user, best first."""
+    start = time.perf_counter()
+    chosen = STRATEGIES[strategy](edges, capacity)
+    report = _report(strategy, edges, chosen, time.perf_counter() - start)
+    LOGGER.info(f"Allocated matches {report.dict()}")
+    return chosen, report
+
+
+def compare_strategies(edges: list[Edge], capacity: int) -> list[AllocationReport]:
+    """Run every strategy on the same candidate graph, to pick one by data size."""
+    return [allocate(edges, capacity, strategy)[1] for strategy in STRATEGIES]
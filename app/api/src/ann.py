@@ -0,0 +1,328 @@
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from collections import defaultdict
+import numpy as np
+from google.cloud import storage
+from src import LOGGER
+
+PERSONA_INDEX_PATH = os.getenv("PERSONA_INDEX_PATH", "")
+# gs://bucket/prefix the index is saved to, so every container of the job
+# (e.g. the shards after prepare) loads the same one
+PERSONA_INDEX_URI = os.getenv("PERSONA_INDEX_URI", "")
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", 8))
+INDEX_FILES = ("centroids.npy", "vectors.npy", "assignment.npy", "ids.txt")
+KMEANS_ITERATIONS = 10
+ASSIGN_CHUNK_SIZE = 4096
+
+
+def _nearest_centroids(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    assignment = np.empty(len(vectors), dtype=np.int32)
+    for i in range(0, len(vectors), ASSIGN_CHUNK_SIZE):
+        chunk = np.asarray(vectors[i : i + ASSIGN_CHUNK_SIZE])
+        assignment[i : i + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignment
+
+
+class IVFIndex:
+    """An inverted file index over unit vectors for approximate cosine similarity search.
+
+    Vectors are clustered with spherical k-means and a query only scores the
+    vectors in its `nprobe` closest clusters. Inserts and deletes are applied
+    in place without re-clustering. A saved index is memory-mapped on load, and
+    vectors inserted afterwards are held in memory until the next save.
+    """
+
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        ids: list[str],
+        vectors: np.ndarray,
+        assignment: np.ndarray,
+        alive: np.ndarray,
+    ):
+        self.centroids = centroids
+        self._ids = list(ids)
+        self._base = vectors
+        self._extra: list[np.ndarray] = []
+        self._assignment = list(assignment)
+        self._alive = list(alive)
+        self._row_of = {
+            uid: row for row, uid in enumerate(self._ids) if self._alive[row]
+        }
+        self._lists: dict[int, set[int]] = {c: set() for c in range(len(centroids))}
+        self._lock = threading.Lock()
+        for row, (cluster, is_alive) in enumerate(zip(self._assignment, self._alive)):
+            if is_alive:
+                self._lists[int(cluster)].add(row)
+
+    def __len__(self) -> int:
+        return len(self._row_of)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._row_of
+
+    @property
+    def dim(self) -> int:
+        return self.centroids.shape[1]
+
+    @property
+    def user_ids(self) -> list[str]:
+        return list(self._row_of)
+
+    def get_vector(self, user_id: str) -> np.ndarray | None:
+        row = self._row_of.get(user_id)
+        if row is None:
+            return None
+        return self._vectors(np.array([row]))[0]
+
+    @classmethod
+    def build(
+        cls,
+        ids: list[str],
+        vectors: np.ndarray,
+        nlist: int | None = None,
+        seed: int = 0,
+    ) -> "IVFIndex":
+        vectors = np.asarray(vectors, dtype=np.float32)
+        nlist = max(1, min(nlist or int(np.sqrt(len(vectors))), len(vectors)))
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+        for _ in range(KMEANS_ITERATIONS):
+            assignment = _nearest_centroids(vectors, centroids)
+            for c in range(nlist):
+                members = vectors[assignment == c]
+                if len(members):
+                    mean = members.mean(axis=0)
+                    centroids[c] = mean / (np.linalg.norm(mean) or 1.0)
+        assignment = _nearest_centroids(vectors, centroids)
+        return cls(centroids, ids, vectors, assignment, np.ones(len(ids), dtype=bool))
+
+    def _vectors(self, rows: np.ndarray) -> np.ndarray:
+        num_base = len(self._base)
+        base_rows = rows[rows < num_base]
+        extra_rows = rows[rows >= num_base] - num_base
+        parts = [np.asarray(self._base[base_rows])]
+        if len(extra_rows):
+            parts.append(np.stack([self._extra[i] for i in extra_rows]))
+        return np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+    def insert(self, user_id: str, vector: np.ndarray):
+        vector = np.asarray(vector, dtype=np.float32)
+        cluster = int(np.argmax(self.centroids @ vector))
+        with self._lock:
+            self._discard(user_id)
+            row = len(self._ids)
+            self._ids.append(user_id)
+            self._extra.append(vector)
+            self._assignment.append(cluster)
+            self._alive.append(True)
+            self._row_of[user_id] = row
+            self._lists[cluster].add(row)
+
+    def delete(self, user_id: str):
+        with self._lock:
+            self._discard(user_id)
+
+    def _discard(self, user_id: str):
+        row = self._row_of.pop(user_id, None)
+        if row is not None:
+            self._alive[row] = False
+            self._lists[int(self._assignment[row])].discard(row)
+
+    def search(
+        self,
+        vector: np.ndarray,
+        k: int,
+        nprobe: int = ANN_NPROBE,
+        exclude: set[str] = frozenset(),
+        allowed: list[str] | None = None,
+    ) -> list[tuple[str, float]]:
+        """Return up to `k` (user_id, similarity) pairs, most similar first.
+
+        With `allowed`, only those users are scored, and lists past the first
+        `nprobe` are probed, closest first, until they hold `k` of them.
+        """
+        probes = np.argsort(-(self.centroids @ vector))
+        with self._lock:
+            if allowed is None:
+                rows = [row for c in probes[:nprobe] for row in self._lists[int(c)]]
+            else:
+                allowed_by_list: dict[int, list[int]] = defaultdict(list)
+                for user_id in allowed:
+                    row = self._row_of.get(user_id)
+                    if row is not None and user_id not in exclude:
+                        allowed_by_list[int(self._assignment[row])].append(row)
+                rows = []
+                for i, c in enumerate(probes):
+                    if i >= nprobe and len(rows) >= k:
+                        break
+                    rows.extend(allowed_by_list.get(int(c), ()))
+            rows = np.array(sorted(rows), dtype=np.int64)
+            if not len(rows):
+                return []
+            scores = self._vectors(rows) @ vector
+        results = []
+        for i in np.argsort(-scores, kind="stable"):
+            user_id = self._ids[rows[i]]
+            if user_id not in exclude:
+                results.append((user_id, float(scores[i])))
+                if len(results) == k:
+                    break
+        return results
+
+    def save(self, path: str):
+        """Write a compacted copy of the index, atomically replacing any at `path`."""
+        rows = np.array(sorted(self._row_of.values()), dtype=np.int64)
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, "centroids.npy"), self.centroids)
+        if len(rows):
+            # stream the vectors out in chunks rather than materialising them
+            vectors = np.lib.format.open_memmap(
+                os.path.join(tmp_path, "vectors.npy"),
+                mode="w+",
+                dtype=np.float32,
+                shape=(len(rows), self.dim),
+            )
+            for i in range(0, len(rows), ASSIGN_CHUNK_SIZE):
+                vectors[i : i + ASSIGN_CHUNK_SIZE] = self._vectors(
+                    rows[i : i + ASSIGN_CHUNK_SIZE]
+                )
+            vectors.flush()
+            del vectors
+        else:
+            np.save(
+                os.path.join(tmp_path, "vectors.npy"),
+                np.empty((0, self.dim), dtype=np.float32),
+            )
+        np.save(
+            os.path.join(tmp_path, "assignment.npy"),
+            np.array([self._assignment[r] for r in rows], dtype=np.int32),
+        )
+        with open(os.path.join(tmp_path, "ids.txt"), "w") as f:
+            f.write("\n".join(self._ids[r] for r in rows))
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+        LOGGER.info(f"Saved persona index with {len(rows)} vectors to {path}")
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        with open(os.path.join(path, "ids.txt")) as f:
+            ids = f.read().split("\n") if os.path.getsize(f.name) else []
+        vectors = np.load(
+            os.path.join(path, "vectors.npy"), mmap_mode="r" if ids else None
+        )
+        return cls(
+            np.load(os.path.join(path, "centroids.npy")),
+            ids,
+            vectors,
+            np.load(os.path.join(path, "assignment.npy")),
+            np.ones(len(ids), dtype=bool),
+        )
+
+
+def _gcs_location(uri: str) -> tuple[storage.Bucket, str]:
+    bucket, _, prefix = uri.removeprefix("gs://").partition("/")
+    return storage.Client().bucket(bucket), prefix.rstrip("/")
+
+
+def upload_index(path: str, uri: str):
+    """Upload a saved index to `uri` as a new version, then point `LATEST` at it.
+
+    Readers follow `LATEST`, so they never see a partly uploaded index. The
+    previous version is deleted once it is no longer the latest.
+    """
+    bucket, prefix = _gcs_location(uri)
+    version = uuid.uuid4().hex
+    for name in INDEX_FILES:
+        bucket.blob(f"{prefix}/{version}/{name}").upload_from_filename(
+            os.path.join(path, name)
+        )
+    latest = bucket.blob(f"{prefix}/LATEST")
+    previous = latest.download_as_text().strip() if latest.exists() else None
+    latest.upload_from_string(version)
+    if previous:
+        for blob in bucket.list_blobs(prefix=f"{prefix}/{previous}/"):
+            blob.delete()
+    LOGGER.info(f"Uploaded persona index version {version} to {uri}")
+
+
+def download_index(uri: str, path: str) -> bool:
+    """Replace the index at `path` with the latest one uploaded to `uri`, if there is one."""
+    bucket, prefix = _gcs_location(uri)
+    latest = bucket.blob(f"{prefix}/LATEST")
+    if not latest.exists():
+        return False
+    version = latest.download_as_text().strip()
+    tmp_path = f"{path}.download"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name in INDEX_FILES:
+        bucket.blob(f"{prefix}/{version}/{name}").download_to_filename(
+            os.path.join(tmp_path, name)
+        )
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+    LOGGER.info(f"Downloaded persona index version {version} from {uri}")
+    return True
+
+
+def _index_path() -> str:
+    """Where the index is memory-mapped from, by default a local copy of PERSONA_INDEX_URI."""
+    if PERSONA_INDEX_PATH or not PERSONA_INDEX_URI:
+        return PERSONA_INDEX_PATH
+    return os.path.join(tempfile.gettempdir(), "persona_index")
+
+
+_PERSONA_INDEX: IVFIndex | None = None
+
+
+def get_persona_index() -> IVFIndex | None:
+    """Return the process-wide persona index, loaded from PERSONA_INDEX_URI or PERSONA_INDEX_PATH."""
+    global _PERSONA_INDEX
+    path = _index_path()
+    if _PERSONA_INDEX is None and path:
+        if PERSONA_INDEX_URI:
+            download_index(PERSONA_INDEX_URI, path)
+        if os.path.exists(os.path.join(path, "ids.txt")):
+            _PERSONA_INDEX = IVFIndex.load(path)
+            LOGGER.info(f"Loaded persona index with {len(_PERSONA_INDEX)} vectors")
+    return _PERSONA_INDEX
+
+
+def sync_persona_index(vectors: dict[str, np.ndarray]) -> IVFIndex | None:
+    """Bring the saved persona index in line with `vectors`, building it if missing or stale.
+
+    Only new, changed and removed personas are touched, and the index is saved
+    back to PERSONA_INDEX_PATH and PERSONA_INDEX_URI for the next run.
+    """
+    global _PERSONA_INDEX
+    if not vectors:
+        return None
+    index = get_persona_index()
+    dim = len(next(iter(vectors.values())))
+    if index is None or index.dim != dim:
+        index = IVFIndex.build(list(vectors), np.stack(list(vectors.values())))
+        LOGGER.info(f"Built persona index with {len(index)} vectors")
+    else:
+        num_changes = 0
+        for user_id in [uid for uid in index.user_ids if uid not in vectors]:
+            index.delete(user_id)
+            num_changes += 1
+        for user_id, vector in vectors.items():
+            current = index.get_vector(user_id)
+            if current is None or not np.allclose(current, vector, atol=1e-6):
+                index.insert(user_id, vector)
+                num_changes += 1
+        LOGGER.info(f"Applied {num_changes} updates to the persona index")
+    path = _index_path()
+    if path:
+        index.save(path)
+        if PERSONA_INDEX_URI:
+            upload_index(path, PERSONA_INDEX_URI)
+    _PERSONA_INDEX = index
+    return index
@@ -0,0 +1,366 @@
+import hashlib
+import json
+import os
+import time
+import uuid
+from datetime import datetime
+from src import LOGGER, ai, cache, fire_utils, llm
+from src.models import MatchResult, Persona, Profile
+
+# "online" ranks each pair with a chat completion, "batch" submits the job's
+# pairs to the OpenAI Batch API and "local" completes batch files in process
+RANKING_BACKEND = os.getenv("RANKING_BACKEND", "online")
+RANKING_BATCH_DIR = os.getenv("RANKING_BATCH_DIR", "/tmp/ranking_batches")
+# Where a run keeps its batch IDs until its matches are saved, so a rerun
+# resumes them, "" (firestore, which outlives the job's container) or a directory
+RANKING_BATCH_IDS = os.getenv("RANKING_BATCH_IDS", "")
+RANKING_BATCH_POLL_S = float(os.getenv("RANKING_BATCH_POLL_S", 60))
+BATCH_MAX_REQUESTS = 50_000  # Batch API limits per input file
+BATCH_MAX_BYTES = 190 * 1024 * 1024  # under the 200 MB file size limit
+BATCH_ENDPOINT = "/v1/chat/completions"
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class OpenAIBatchBackend:
+    def __init__(self):
+        self.client = llm.get_client().with_options(max_retries=2)
+
+    def submit(self, path: str) -> str:
+        with open(path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window="24h",
+        )
+        return batch.id
+
+    def status(self, batch_id: str) -> str:
+        return self.client.batches.retrieve(batch_id).status
+
+    def output(self, batch_id: str) -> list[str]:
+        """Return the result lines of a finished batch, including those of failed requests."""
+        batch = self.client.batches.retrieve(batch_id)
+        lines = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                lines += self.client.files.content(file_id).text.splitlines()
+        return lines
+
+
+class LocalBatchBackend:
+    """A stand-in for the Batch API that completes each batch file through ai.GENERATOR on submit.
+
+    Output files are written in the Batch API's format under `root`, so a
+    run is parsed the same way as with OpenAIBatchBackend.
+    """
+
+    def __init__(self, root: str = RANKING_BATCH_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _output_path(self, batch_id: str) -> str:
+        return os.path.join(self.root, f"{batch_id}.output.jsonl")
+
+    def submit(self, path: str) -> str:
+        batch_id = f"local-{uuid.uuid4().hex}"
+        with open(path) as f, open(self._output_path(batch_id), "w") as out:
+            for line in f:
+                request = json.loads(line)
+                result = {
+                    "custom_id": request["custom_id"],
+                    "response": None,
+                    "error": None,
+                }
+                try:
+                    match_result = ai.GENERATOR(
+                        request["body"]["messages"],
+                        response_format=MatchResult,
+                        label="batch_match_ranking",
+                    )
+                    result["response"] = {
+                        "status_code": 200,
+                        "body": {
+                            "choices": [
+                                {
+                                    "message": {
+                                        "content": json.dumps(match_result.dict())
+                                    }
+                                }
+                            ]
+                        },
+                    }
+                except Exception as e:
+                    result["error"] = {"code": type(e).__name__, "message": str(e)}
+                out.write(json.dumps(result) + "\n")
+        return batch_id
+
+    def status(self, batch_id: str) -> str:
+        return "completed" if os.path.exists(self._output_path(batch_id)) else "failed"
+
+    def output(self, batch_id: str) -> list[str]:
+        with open(self._output_path(batch_id)) as f:
+            return f.read().splitlines()
+
+
+BatchBackend = OpenAIBatchBackend | LocalBatchBackend
+
+
+def get_batch_backend() -> BatchBackend:
+    return LocalBatchBackend() if RANKING_BACKEND == "local" else OpenAIBatchBackend()
+
+
+class FileBatchIds:
+    """Batch IDs saved as files under a local directory, for local runs."""
+
+    def __init__(self, root: str = RANKING_BATCH_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, f"{name}.batch_id")
+
+    def get(self, name: str) -> str | None:
+        if not os.path.exists(self._path(name)):
+            return None
+        with open(self._path(name)) as f:
+            return f.read().strip()
+
+    def put(self, name: str, batch_id: str):
+        with open(self._path(name), "w") as f:
+            f.write(batch_id)
+
+    def delete(self, name: str):
+        os.remove(self._path(name))
+
+
+class FirestoreBatchIds:
+    """Batch IDs in the `ranking_batch` collection."""
+
+    def __init__(self):
+        self._collection = fire_utils.fdb.collection("ranking_batch")
+
+    def get(self, name: str) -> str | None:
+        doc = self._collection.document(name).get()
+        return doc.to_dict()["batch_id"] if doc.exists else None
+
+    def put(self, name: str, batch_id: str):
+        self._collection.document(name).set({"batch_id": batch_id})
+
+    def delete(self, name: str):
+        self._collection.document(name).delete()
+
+
+def get_batch_ids() -> FileBatchIds | FirestoreBatchIds:
+    if RANKING_BATCH_IDS:
+        return FileBatchIds(RANKING_BATCH_IDS)
+    return FirestoreBatchIds()
+
+
+class RunBatchIds:
+    """Batch IDs of one matchmaking run in the RANKING_BATCH_IDS store, for `rank_pairs`.
+
+    IDs are named by the run's start, so a rerun of a run that died resumes
+    its batches whatever pairs are left to rank. A batch whose results were
+    read is only deleted by `release`, once the run has saved its matches.
+    """
+
+    def __init__(self, started: datetime, store=None):
+        self.run = f"run-{started:%Y%m%d%H%M%S}"
+        self.store = store or get_batch_ids()
+        self._finished: list[str] = []
+
+    def get(self, name: str) -> str | None:
+        return self.store.get(f"{self.run}-{name}")
+
+    def put(self, name: str, batch_id: str):
+        self.store.put(f"{self.run}-{name}", batch_id)
+
+    def delete(self, name: str):
+        self._finished.append(name)
+
+    def release(self):
+        """Delete the IDs of the finished batches, once their results are saved."""
+        for name in self._finished:
+            self.store.delete(f"{self.run}-{name}")
+        self._finished.clear()
+
+
+def _request_line(match_id: str, prompt: str) -> str:
+    return json.dumps(
+        {
+            "custom_id": match_id,
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": {
+                "model": ai.MODEL_NAME,
+                "messages": [{"role": "system", "content": prompt}],
+                "response_format": {
+                    "type": "json_schema",
+                    "json_schema": {
+                        "name": "MatchResult",
+                        "schema": MatchResult.model_json_schema(),
+                    },
+                },
+            },
+        }
+    )
+
+
+def chunk_requests(lines: list[str]) -> list[list[str]]:
+    """Split request lines into batch input files under both BATCH_MAX_REQUESTS and BATCH_MAX_BYTES."""
+    chunks, chunk, chunk_bytes = [], [], 0
+    for line in lines:
+        line_bytes = len(line.encode()) + 1  # and its newline
+        if chunk and (
+            len(chunk) == BATCH_MAX_REQUESTS
+            or chunk_bytes + line_bytes > BATCH_MAX_BYTES
+        ):
+            chunks.append(chunk)
+            chunk, chunk_bytes = [], 0
+        chunk.append(line)
+        chunk_bytes += line_bytes
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _parse_line(line: str) -> tuple[str, MatchResult | None]:
+    result = json.loads(line)
+    response = result.get("response") or {}
+    if result.get("error") or response.get("status_code") != 200:
+        LOGGER.error(
+            f"Batch request {result['custom_id']} failed: {result.get('error') or response}"
+        )
+        return result["custom_id"], None
+    llm.USAGE.record("batch_match_ranking", response["body"].get("usage"))
+    content = response["body"]["choices"][0]["message"]["content"]
+    try:
+        return result["custom_id"], MatchResult(**json.loads(content))
+    except Exception as e:
+        LOGGER.error(f"Could not parse batch result {result['custom_id']}: {e}")
+        return result["custom_id"], None
+
+
+def _wait(batch_id: str, backend: BatchBackend):
+    while (status := backend.status(batch_id)) not in TERMINAL_STATUSES:
+        LOGGER.info(
+            f"Batch {batch_id} is {status}, polling again in {RANKING_BATCH_POLL_S}s"
+        )
+        time.sleep(RANKING_BATCH_POLL_S)
+    if status != "completed":
+        LOGGER.error(
+            f"Batch {batch_id} finished as {status}, keeping any partial results"
+        )
+
+
+def run_batch(
+    lines: list[str], backend: BatchBackend, batch_ids, name: str
+) -> dict[str, MatchResult]:
+    """Submit request lines as one batch, wait for it to finish and return the parsed results.
+
+    The batch ID is saved in `batch_ids` under `name` before waiting, so a
+    rerun waits for the batch already submitted instead of paying for a new
+    one. A resumed batch may not match `lines` if the plan changed: results
+    for requests no longer in `lines` are dropped and the requests it lacks
+    are submitted as a new batch.
+    """
+    os.makedirs(RANKING_BATCH_DIR, exist_ok=True)
+    pending = {json.loads(line)["custom_id"]: line for line in lines}
+    results = {}
+    batch_id = batch_ids.get(name)
+    if batch_id:
+        LOGGER.info(f"Resuming batch {batch_id} for {len(lines)} ranking requests")
+    while pending:
+        resumed = batch_id is not None
+        if not resumed:
+            contents = "\n".join(pending.values()) + "\n"
+            digest = hashlib.sha256(contents.encode()).hexdigest()[:16]
+            path = os.path.join(RANKING_BATCH_DIR, f"{digest}.jsonl")
+            with open(path, "w") as f:
+                f.write(contents)
+            batch_id = backend.submit(path)
+            batch_ids.put(name, batch_id)
+            LOGGER.info(
+                f"Submitted batch {batch_id} of {len(pending)} ranking requests"
+            )
+        _wait(batch_id, backend)
+
+        answered = set()
+        for line in backend.output(batch_id):
+            match_id, match_result = _parse_line(line)
+            answered.add(match_id)
+            if match_result and match_id in pending:
+                results[match_id] = match_result
+        pending = {m: line for m, line in pending.items() if m not in answered}
+        # Requests a batch of ours left unanswered are planned again next run
+        if not resumed:
+            break
+        batch_id = None
+    batch_ids.delete(name)
+    LOGGER.info(f"Batch {name} ranked {len(results)} of {len(lines)} pairs")
+    return results
+
+
+def rank_pairs(
+    planned_pairs: dict[str, tuple[Profile, Profile]],
+    personas: dict[str, Persona] | None = None,
+    batch_ids=None,
+) -> dict[str, tuple[str, str, MatchResult]]:
+    """Rank planned pairs through batches, the offline counterpart of `algo.rank_planned_pairs`.
+
+    Cached pairs and pairs missing a persona are resolved as `ai.rank_match`
+    would without an LLM call. Pairs whose request fails are left out, so the
+    next run plans them again. Batch IDs go to `batch_ids`, named by chunk,
+    so a caller scoping them to a run (`RunBatchIds`, or a shard's
+    `sharding.ShardBatchIds`) resumes the same batches even if the pairs left
+    to rank changed.
+    """
+    if personas is None:
+        personas = fire_utils.get_all_personas(
+            [p.user_id for pair in planned_pairs.values() for p in pair]
+        )
+    batch_ids = batch_ids or get_batch_ids()
+    ranking_cache = cache.get_ranking_cache()
+    backend = get_batch_backend()
+
+    ranked, requests = {}, {}
+    for match_id, (profile, prospect) in planned_pairs.items():
+        persona1, persona2 = (
+            personas.get(profile.user_id),
+            personas.get(prospect.user_id),
+        )
+        cached = (
+            ranking_cache.get(profile, persona1, prospect, persona2)
+            if ranking_cache and persona1 and persona2
+            else None
+        )
+        if not (persona1 and persona2) or cached:
+            ranked[match_id] = (
+                profile.user_id,
+                prospect.user_id,
+                cached or ai.rank_match(profile, prospect, personas),
+            )
+        else:
+            requests[match_id] = _request_line(
+                match_id, ai.ranking_prompt(profile, prospect, persona1, persona2)
+            )
+    LOGGER.info(
+        f"Ranking {len(requests)} pairs with the {RANKING_BACKEND} batch backend, {len(ranked)} resolved without it"
+    )
+
+    for i, chunk in enumerate(chunk_requests(list(requests.values()))):
+        results = run_batch(chunk, backend, batch_ids, f"chunk-{i}")
+        for match_id, match_result in results.items():
+            profile, prospect = planned_pairs[match_id]
+            ranked[match_id] = (profile.user_id, prospect.user_id, match_result)
+            if ranking_cache:
+                ranking_cache.put(
+                    profile,
+                    personas[profile.user_id],
+                    prospect,
+                    personas[prospect.user_id],
+                    match_result,
+                )
+    LOGGER.info(f"Batch ranking LLM usage {llm.USAGE.stats}")
+    return ranked
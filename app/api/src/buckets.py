@@ -0,0 +1,112 @@
+import threading
+import time
+from datetime import date, datetime
+from src.models import Profile, age_from_dob
+
+AGE_BAND_YEARS = 5
+ADULT_AGE = 18
+BUCKETS_MAX_AGE_S = 10 * 60
+
+BucketKey = tuple[str | None, frozenset[str], int]
+
+
+def age_band(age: int) -> int:
+    """Bands are aligned on ADULT_AGE, so a band is either all children or all adults."""
+    return (age - ADULT_AGE) // AGE_BAND_YEARS
+
+
+def _band_range(band: int) -> tuple[int, int]:
+    low = ADULT_AGE + band * AGE_BAND_YEARS
+    return low, low + AGE_BAND_YEARS - 1
+
+
+class EligibilityBuckets:
+    """An inverted index of profiles by (gender, genders they are interested in, age band).
+
+    Looking up a user only visits buckets that can be mutually compatible on
+    the child split, orientation in both directions and the user's own age
+    range, so filtering cost scales with the eligible candidates. Candidates
+    still need the exact per-pair checks of `apply_preference_filters`.
+    Profiles without a valid date of birth are not indexed.
+    """
+
+    def __init__(self, profiles: list[Profile] = (), today: datetime | None = None):
+        self.built_on = (today or datetime.today()).date()
+        self.built_at = time.monotonic()
+        self._today = today
+        self._buckets: dict[BucketKey, dict[str, Profile]] = {}
+        self._key_of: dict[str, BucketKey] = {}
+        self._lock = threading.Lock()
+        for profile in profiles:
+            self.add(profile)
+
+    def __len__(self) -> int:
+        return len(self._key_of)
+
+    def is_stale(self, max_age_s: float = BUCKETS_MAX_AGE_S) -> bool:
+        """Ages move on with the calendar, and profiles may be written outside the API."""
+        return (
+            self.built_on != date.today()
+            or time.monotonic() - self.built_at > max_age_s
+        )
+
+    def _key(self, profile: Profile) -> BucketKey | None:
+        try:
+            age = age_from_dob(profile.dob, self._today)
+        except ValueError:
+            return None
+        if age is None:
+            return None
+        return profile.gender, frozenset(profile.orientation or []), age_band(age)
+
+    def add(self, profile: Profile):
+        key = self._key(profile)
+        with self._lock:
+            self._discard(profile.user_id)
+            if key is not None:
+                self._buckets.setdefault(key, {})[profile.user_id] = profile
+                self._key_of[profile.user_id] = key
+
+    def remove(self, user_id: str):
+        with self._lock:
+            self._discard(user_id)
+
+    def _discard(self, user_id: str):
+        key = self._key_of.pop(user_id, None)
+        if key is not None:
+            members = self._buckets[key]
+            members.pop(user_id, None)
+            if not members:
+                del self._buckets[key]
+
+    def _compatible(
+        self, user_key: BucketKey, user_profile: Profile, key: BucketKey
+    ) -> bool:
+        user_gender, user_orientation, user_band = user_key
+        gender, orientation, band = key
+        if (user_band < 0) != (band < 0):
+            return False
+        if user_orientation and gender not in user_orientation:
+            return False
+        if orientation and user_gender not in orientation:
+            return False
+        if user_profile.age_range:
+            low, high = _band_range(band)
+            if high < user_profile.age_range[0] or user_profile.age_range[1] < low:
+                return False
+        return True
+
+    def candidates(self, user_profile: Profile) -> list[Profile]:
+        """Return profiles in compatible buckets, in user ID (Firestore stream) order."""
+        user_key = self._key(user_profile)
+        if user_key is None:
+            return []
+        with self._lock:
+            candidates = [
+                profile
+                for key, members in self._buckets.items()
+                if self._compatible(user_key, user_profile, key)
+                for user_id, profile in members.items()
+                if user_id != user_profile.user_id
+            ]
+        return sorted(candidates, key=lambda p: p.user_id)
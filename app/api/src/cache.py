@@ -0,0 +1,229 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from src import LOGGER, fire_utils
+from src.models import (
+    MatchResult,
+    Persona,
+    Profile,
+    create_canonical_match_id,
+)
+
+# "", "firestore" or a sqlite file path. Incremental runs re-evaluate unchanged
+# users weekly and rely on the cache for their unchanged pairs, so it defaults
+# to Firestore, which outlives the job's container, in that mode
+RANKING_CACHE = os.getenv("RANKING_CACHE") or (
+    "firestore" if os.getenv("MATCHMAKING_MODE") == "incremental" else ""
+)
+RANKING_CACHE_TTL_DAYS = float(os.getenv("RANKING_CACHE_TTL_DAYS", 30))
+RANKING_CACHE_MAX_ENTRIES = int(os.getenv("RANKING_CACHE_MAX_ENTRIES", 100_000))
+
+
+def pair_fingerprint(
+    profile1: Profile, persona1: Persona, profile2: Profile, persona2: Persona
+) -> str:
+    """Hash everything the ranking prompt sees about a pair, in canonical user order."""
+    sides = sorted(
+        [
+            (profile1.user_id, profile1.to_string(), persona1.description),
+            (profile2.user_id, profile2.to_string(), persona2.description),
+        ]
+    )
+    return hashlib.sha256(json.dumps(sides).encode()).hexdigest()
+
+
+def _orient(result: MatchResult, flipped: bool) -> MatchResult:
+    """Swap the rationales when the requested order differs from the canonical one."""
+    if not flipped:
+        return result
+    return MatchResult(
+        compatibility_rating=result.compatibility_rating,
+        rationale1=result.rationale2,
+        rationale2=result.rationale1,
+        highlighted_themes=result.highlighted_themes,
+    )
+
+
+class SqliteRankingStore:
+    """A local on-disk store with TTL expiry and LRU eviction.
+
+    A local file is not reachable when a user is deleted, so `users` is not
+    kept and their entries age out with the TTL.
+    """
+
+    def __init__(self, path: str, ttl_s: float, max_entries: int):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ranking ("
+            "match_id TEXT PRIMARY KEY, fingerprint TEXT, result TEXT, "
+            "created REAL, last_used REAL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ranking_last_used ON ranking (last_used)"
+        )
+        self._conn.commit()
+
+    def get(self, match_id: str, fingerprint: str) -> dict | None:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT fingerprint, result, created FROM ranking WHERE match_id = ?",
+                (match_id,),
+            ).fetchone()
+            if not row or row[0] != fingerprint or now - row[2] > self.ttl_s:
+                return None
+            self._conn.execute(
+                "UPDATE ranking SET last_used = ? WHERE match_id = ?", (now, match_id)
+            )
+            self._conn.commit()
+        return json.loads(row[1])
+
+    def put(self, match_id: str, fingerprint: str, result: dict, users: list[str]):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ranking VALUES (?, ?, ?, ?, ?)",
+                (match_id, fingerprint, json.dumps(result), now, now),
+            )
+            self._conn.commit()
+
+    def evict(self) -> int:
+        with self._lock:
+            expired = self._conn.execute(
+                "DELETE FROM ranking WHERE created < ?", (time.time() - self.ttl_s,)
+            ).rowcount
+            overflow = self._conn.execute(
+                "DELETE FROM ranking WHERE match_id IN ("
+                "SELECT match_id FROM ranking ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+            self._conn.commit()
+        return expired + overflow
+
+
+class FirestoreRankingStore:
+    """A store shared across job runs in the `ranking_cache` collection, with TTL expiry.
+
+    Entries list both `users`, so a deleted user's rankings can be found.
+    """
+
+    def __init__(self, ttl_s: float):
+        self.ttl_s = ttl_s
+        self._collection = fire_utils.fdb.collection("ranking_cache")
+
+    def get(self, match_id: str, fingerprint: str) -> dict | None:
+        doc = self._collection.document(match_id).get()
+        if not doc.exists:
+            return None
+        data = doc.to_dict()
+        if (
+            data.get("fingerprint") != fingerprint
+            or time.time() - data.get("created", 0) > self.ttl_s
+        ):
+            return None
+        return data["result"]
+
+    def put(self, match_id: str, fingerprint: str, result: dict, users: list[str]):
+        self._collection.document(match_id).set(
+            {
+                "fingerprint": fingerprint,
+                "result": result,
+                "created": time.time(),
+                "users": users,
+            }
+        )
+
+    def evict(self) -> int:
+        expired = self._collection.where(
+            "created", "<", time.time() - self.ttl_s
+        ).stream()
+        num_evicted = 0
+        for doc in expired:
+            doc.reference.delete()
+            num_evicted += 1
+        return num_evicted
+
+
+class RankingCache:
+    """Pairwise ranking cache keyed by canonical match ID and a fingerprint of both users' data."""
+
+    def __init__(self, store: SqliteRankingStore | FirestoreRankingStore):
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(
+        self,
+        profile1: Profile,
+        persona1: Persona,
+        profile2: Profile,
+        persona2: Persona,
+    ) -> MatchResult | None:
+        match_id = create_canonical_match_id(profile1.user_id, profile2.user_id)
+        fingerprint = pair_fingerprint(profile1, persona1, profile2, persona2)
+        try:
+            cached = self.store.get(match_id, fingerprint)
+        except Exception as e:
+            LOGGER.error(f"Error reading ranking cache for {match_id=}: {e}")
+            cached = None
+        self._count(cached is not None)
+        if cached is None:
+            return None
+        flipped = profile1.user_id > profile2.user_id
+        return _orient(MatchResult(**cached), flipped)
+
+    def put(
+        self,
+        profile1: Profile,
+        persona1: Persona,
+        profile2: Profile,
+        persona2: Persona,
+        result: MatchResult,
+    ):
+        match_id = create_canonical_match_id(profile1.user_id, profile2.user_id)
+        fingerprint = pair_fingerprint(profile1, persona1, profile2, persona2)
+        flipped = profile1.user_id > profile2.user_id
+        try:
+            self.store.put(
+                match_id,
+                fingerprint,
+                _orient(result, flipped).dict(),
+                sorted([profile1.user_id, profile2.user_id]),
+            )
+        except Exception as e:
+            LOGGER.error(f"Error writing ranking cache for {match_id=}: {e}")
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+_RANKING_CACHE: RankingCache | None = None
+
+
+def get_ranking_cache() -> RankingCache | None:
+    """Return the process-wide ranking cache, or None when RANKING_CACHE is unset."""
+    global _RANKING_CACHE
+    if _RANKING_CACHE is None and RANKING_CACHE:
+        ttl_s = RANKING_CACHE_TTL_DAYS * 24 * 60 * 60
+        if RANKING_CACHE == "firestore":
+            store = FirestoreRankingStore(ttl_s)
+        else:
+            store = SqliteRankingStore(RANKING_CACHE, ttl_s, RANKING_CACHE_MAX_ENTRIES)
+        _RANKING_CACHE = RankingCache(store)
+        LOGGER.info(f"Using ranking cache {RANKING_CACHE=}")
+    return _RANKING_CACHE
@@ -0,0 +1,257 @@
+from datetime import datetime
+import numpy as np
+from src.geo import EARTH_RADIUS_KM, HAVERSINE_ERROR, SpatialIndex, within_km
+from src.models import Profile, parse_dob
+
+
+def profile_columns(profiles: list[Profile]) -> dict[str, np.ndarray]:
+    """Encode the fields preference filtering reads as the columns a ProfileTable is built from.
+
+    Genders are coded as bits so an orientation is a bitmask, dates of birth
+    are split into year, month and day (-1 when missing or invalid), a missing
+    age range is -1, and a missing location or distance limit is NaN. The snapshot stores
+    these columns, so the job can build its table without reading profiles.
+    """
+    genders = sorted(
+        {p.gender for p in profiles if p.gender}
+        | {g for p in profiles for g in p.orientation or []}
+    )
+    assert len(genders) < 63, "Too many distinct genders for an int64 bitmask"
+    gender_bits = {g: 1 << i for i, g in enumerate(genders)}
+
+    births = []
+    for p in profiles:
+        try:
+            birth = parse_dob(p.dob) if p.dob else None
+        except ValueError:
+            birth = None
+        births.append((birth.year, birth.month, birth.day) if birth else (-1, -1, -1))
+    birth_year, birth_month, birth_day = (
+        np.array(births, dtype=np.int16).reshape(-1, 3).T
+    )
+    return {
+        "gender_bit": np.array(
+            [gender_bits.get(p.gender, 0) for p in profiles], dtype=np.int64
+        ),
+        "orientation_mask": np.array(
+            [sum(gender_bits[g] for g in set(p.orientation or [])) for p in profiles],
+            dtype=np.int64,
+        ),
+        "birth_year": birth_year,
+        "birth_month": birth_month,
+        "birth_day": birth_day,
+        "age_min": np.array(
+            [p.age_range[0] if p.age_range else -1 for p in profiles], dtype=np.int32
+        ),
+        "age_max": np.array(
+            [p.age_range[1] if p.age_range else -1 for p in profiles], dtype=np.int32
+        ),
+        "latitude": np.array(
+            [p.location.latitude if p.location else np.nan for p in profiles],
+            dtype=np.float64,
+        ),
+        "longitude": np.array(
+            [p.location.longitude if p.location else np.nan for p in profiles],
+            dtype=np.float64,
+        ),
+        "distance_km": np.array(
+            [
+                np.nan if p.distance_range_km is None else p.distance_range_km
+                for p in profiles
+            ],
+            dtype=np.float64,
+        ),
+    }
+
+
+class ProfileTable:
+    """A columnar view of profiles for vectorized preference filtering.
+
+    Every predicate of `fire_utils.apply_preference_filters` becomes a boolean
+    mask over NumPy columns, so filtering one user against everyone is a few
+    array operations. Genders are coded as bits so an orientation is a bitmask,
+    ages are computed once relative to a single `today`, and only pairs whose
+    haversine distance is near a distance limit fall back to the exact geodesic.
+    The columns are encoded from `profiles` unless given, e.g. by a snapshot.
+    Profiles without a valid date of birth are never eligible.
+    """
+
+    def __init__(
+        self,
+        profiles: list[Profile],
+        today: datetime | None = None,
+        spatial_index: SpatialIndex | None = None,
+        columns: dict[str, np.ndarray] | None = None,
+    ):
+        self.profiles = profiles
+        self.index_of = {p.user_id: i for i, p in enumerate(profiles)}
+        self.spatial_index = spatial_index
+        today = today or datetime.today()
+        columns = profile_columns(profiles) if columns is None else columns
+        assert len(columns["gender_bit"]) == len(profiles), "Columns do not match"
+
+        self.gender_bit = np.asarray(columns["gender_bit"])
+        self.orientation_mask = np.asarray(columns["orientation_mask"])
+        self.has_orientation = self.orientation_mask != 0
+
+        birth_year = np.asarray(columns["birth_year"], dtype=np.int32)
+        birth_month = np.asarray(columns["birth_month"])
+        birth_day = np.asarray(columns["birth_day"])
+        self.has_age = birth_year >= 0
+        before_birthday = (today.month < birth_month) | (
+            (today.month == birth_month) & (today.day < birth_day)
+        )
+        self.age = np.where(
+            self.has_age, today.year - birth_year - before_birthday, -1
+        ).astype(np.int32)
+        self.is_child = self.age < 18
+
+        self.age_min = np.asarray(columns["age_min"], dtype=np.int32)
+        self.age_max = np.asarray(columns["age_max"], dtype=np.int32)
+        self.has_age_range = self.age_min >= 0
+
+        latitude = np.asarray(columns["latitude"])
+        self.has_location = ~np.isnan(latitude)
+        self.lat = np.radians(np.nan_to_num(latitude))
+        self.lon = np.radians(np.nan_to_num(np.asarray(columns["longitude"])))
+        self.distance_km = np.nan_to_num(np.asarray(columns["distance_km"]))
+        self.has_distance = self.has_location & (self.distance_km != 0)
+
+    def __len__(self) -> int:
+        return len(self.profiles)
+
+    def _haversine_km(self, row: int, cols: np.ndarray) -> np.ndarray:
+        dlat = self.lat[cols] - self.lat[row]
+        dlon = self.lon[cols] - self.lon[row]
+        a = (
+            np.sin(dlat / 2) ** 2
+            + np.cos(self.lat[row]) * np.cos(self.lat[cols]) * np.sin(dlon / 2) ** 2
+        )
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+    def _eligible_cols(self, row: int, cols: np.ndarray) -> np.ndarray:
+        """Return the subset of `cols` mutually compatible with `row`, in order."""
+        if not self.has_age[row]:
+            return cols[:0]
+        mask = self.has_age[cols] & (cols != row)
+        mask &= self.is_child[cols] == self.is_child[row]
+        if self.has_orientation[row]:
+            mask &= (self.gender_bit[cols] & self.orientation_mask[row]) != 0
+        mask &= ~self.has_orientation[cols] | (
+            (self.orientation_mask[cols] & self.gender_bit[row]) != 0
+        )
+        mask &= ~self.has_age_range[cols] | (
+            (self.age_min[cols] <= self.age[row])
+            & (self.age[row] <= self.age_max[cols])
+        )
+        if self.has_age_range[row]:
+            mask &= (self.age_min[row] <= self.age[cols]) & (
+                self.age[cols] <= self.age_max[row]
+            )
+        # a distance limit on either side requires both locations
+        needs_distance = self.has_distance[cols] | self.has_distance[row]
+        if not self.has_location[row]:
+            mask &= ~self.has_distance[cols]
+        if self.has_distance[row]:
+            mask &= self.has_location[cols]
+        cols = cols[mask]
+        needs_distance = needs_distance[mask]
+        if not needs_distance.any():
+            return cols
+
+        limit_km = np.where(
+            self.has_distance[cols],
+            self.distance_km[cols],
+            np.inf,
+        )
+        if self.has_distance[row]:
+            limit_km = np.minimum(limit_km, self.distance_km[row])
+        approx_km = self._haversine_km(row, cols)
+        keep = ~needs_distance | (approx_km <= limit_km * (1 - HAVERSINE_ERROR))
+        borderline = (
+            needs_distance & ~keep & (approx_km <= limit_km * (1 + HAVERSINE_ERROR))
+        )
+        for i in np.flatnonzero(borderline):
+            keep[i] = within_km(
+                self.profiles[row].location,
+                self.profiles[cols[i]].location,
+                limit_km[i],
+            )
+        return cols[keep]
+
+    def eligible_indices(self, row: int, cols: np.ndarray | None = None) -> np.ndarray:
+        """Return the sorted table positions compatible with `row`, out of `cols` (default all)."""
+        cols = np.arange(len(self.profiles)) if cols is None else np.asarray(cols)
+        if self.spatial_index and self.has_distance[row]:
+            nearby = self.spatial_index.query_positions(
+                self.profiles[row].location, self.distance_km[row]
+            )
+            cols = np.intersect1d(cols, np.array(nearby, dtype=np.int64))
+        return self._eligible_cols(row, cols)
+
+    def filter(
+        self, user_profile: Profile, candidates: list[Profile] | None = None
+    ) -> list[Profile]:
+        """Vectorized equivalent of `fire_utils.apply_preference_filters` over this table.
+
+        `candidates` (e.g. from an eligibility bucket lookup) restricts the
+        profiles considered, and must be rows of this table.
+        """
+        row = self.index_of[user_profile.user_id]
+        cols = None
+        if candidates is not None:
+            cols = np.sort(
+                np.array([self.index_of[p.user_id] for p in candidates], dtype=np.int64)
+            )
+        return [self.profiles[i] for i in self.eligible_indices(row, cols)]
+
+    def eligibility_matrix(self, rows: np.ndarray | None = None) -> np.ndarray:
+        """Build the boolean eligibility matrix for `rows` (default all) against every profile.
+
+        This allocates len(rows) x len(table) booleans, so large tables should
+        be processed in blocks of rows.
+        """
+        rows = np.arange(len(self.profiles)) if rows is None else np.asarray(rows)
+        all_cols = np.arange(len(self.profiles))
+        r, c = rows[:, None], all_cols[None, :]
+        m = (self.has_age[r] & self.has_age[c]) & (r != c)
+        m &= self.is_child[r] == self.is_child[c]
+        m &= ~self.has_orientation[r] | (
+            (self.gender_bit[c] & self.orientation_mask[r]) != 0
+        )
+        m &= ~self.has_orientation[c] | (
+            (self.orientation_mask[c] & self.gender_bit[r]) != 0
+        )
+        m &= ~self.has_age_range[c] | (
+            (self.age_min[c] <= self.age[r]) & (self.age[r] <= self.age_max[c])
+        )
+        m &= ~self.has_age_range[r] | (
+            (self.age_min[r] <= self.age[c]) & (self.age[c] <= self.age_max[r])
+        )
+        m &= ~self.has_distance[r] | self.has_location[c]
+        m &= ~self.has_distance[c] | self.has_location[r]
+
+        needs_distance = m & (self.has_distance[r] | self.has_distance[c])
+        if needs_distance.any():
+            limit_km = np.minimum(
+                np.where(self.has_distance[r], self.distance_km[r], np.inf),
+                np.where(self.has_distance[c], self.distance_km[c], np.inf),
+            )
+            dlat = self.lat[c] - self.lat[r]
+            dlon = self.lon[c] - self.lon[r]
+            a = (
+                np.sin(dlat / 2) ** 2
+                + np.cos(self.lat[r]) * np.cos(self.lat[c]) * np.sin(dlon / 2) ** 2
+            )
+            approx_km = 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+            borderline = needs_distance & (
+                np.abs(approx_km - limit_km) <= limit_km * HAVERSINE_ERROR
+            )
+            m &= ~needs_distance | (approx_km <= limit_km)
+            for i, j in zip(*np.nonzero(borderline)):
+                m[i, j] = within_km(
+                    self.profiles[rows[i]].location,
+                    self.profiles[j].location,
+                    limit_km[i, j],
+                )
+        return m
@@ -0,0 +1,161 @@
+import hashlib
+import os
+import re
+import numpy as np
+from src import LOGGER, ann, fire_utils, llm
+from src.models import Persona
+
+EMBEDDER = os.getenv("EMBEDDER", "openai")  # "openai" or "hashing" (offline)
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBED_BATCH_SIZE = 256
+
+
+def _normalise(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.where(norms == 0, 1, norms)).astype(np.float32)
+
+
+class HashingEmbedder:
+    """A local, offline embedder hashing word unigrams and bigrams into a fixed size vector."""
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def _bucket(self, token: str) -> tuple[int, float]:
+        digest = hashlib.blake2b(token.encode(), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        return value % self.dim, 1.0 if value >> 63 else -1.0
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            words = re.findall(r"[a-z0-9']+", text.lower())
+            for token in words + [" ".join(b) for b in zip(words, words[1:])]:
+                j, sign = self._bucket(token)
+                vectors[i, j] += sign
+        return _normalise(vectors)
+
+
+class OpenAIEmbedder:
+    def __init__(self, model: str = EMBEDDING_MODEL):
+        self.model = model
+        self.name = model
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        # embeddings are not paced by ratelimit, so keep the client's own retries
+        client = llm.get_client().with_options(max_retries=2)
+        vectors = []
+        for i in range(0, len(texts), EMBED_BATCH_SIZE):
+            response = client.embeddings.create(
+                model=self.model, input=texts[i : i + EMBED_BATCH_SIZE]
+            )
+            vectors.extend(d.embedding for d in response.data)
+        return _normalise(np.array(vectors, dtype=np.float32))
+
+
+Embedder = HashingEmbedder | OpenAIEmbedder
+
+
+def get_embedder() -> Embedder:
+    return HashingEmbedder() if EMBEDDER == "hashing" else OpenAIEmbedder()
+
+
+def persona_fingerprint(persona: Persona, embedder: Embedder) -> str:
+    return hashlib.sha256(
+        f"{embedder.name}\n{persona.description}".encode()
+    ).hexdigest()
+
+
+def load_persona_vectors(
+    personas: dict[str, Persona],
+    embedder: Embedder | None = None,
+    embed_stale: bool = True,
+) -> dict[str, np.ndarray]:
+    """Return a unit vector per persona, only embedding those new or changed since they were stored.
+
+    Without `embed_stale` the stored vectors are only read, and personas
+    without a current one are left out.
+    """
+    embedder = embedder or get_embedder()
+    personas = {k: v for k, v in personas.items() if v.description}
+    stored = fire_utils.get_persona_embeddings(list(personas))
+
+    vectors, stale = {}, {}
+    for user_id, persona in personas.items():
+        fingerprint = persona_fingerprint(persona, embedder)
+        if user_id in stored and stored[user_id]["fingerprint"] == fingerprint:
+            vectors[user_id] = np.array(stored[user_id]["vector"], dtype=np.float32)
+        else:
+            stale[user_id] = fingerprint
+
+    if stale and not embed_stale:
+        LOGGER.warning(f"Skipping {len(stale)} personas without a current embedding")
+    elif stale:
+        LOGGER.info(
+            f"Embedding {len(stale)} new or changed personas with {embedder.name}"
+        )
+        new_vectors = embedder.embed([personas[k].description for k in stale])
+        for user_id, vector in zip(stale, new_vectors):
+            vectors[user_id] = vector
+        fire_utils.save_persona_embeddings(
+            {
+                user_id: {
+                    "fingerprint": fingerprint,
+                    "vector": vectors[user_id].tolist(),
+                }
+                for user_id, fingerprint in stale.items()
+            }
+        )
+    return vectors
+
+
+def update_persona_embedding(persona: Persona, embedder: Embedder | None = None):
+    """Re-embed a single persona after it changes, so the job reads its stored vector.
+
+    The job builds or loads its own ANN index and brings it up to date from
+    the stored vectors, so the API process keeps no index of its own.
+    """
+    if not persona.description:
+        return
+    embedder = embedder or get_embedder()
+    vector = embedder.embed([persona.description])[0]
+    fire_utils.save_persona_embeddings(
+        {
+            persona.user_id: {
+                "fingerprint": persona_fingerprint(persona, embedder),
+                "vector": vector.tolist(),
+            }
+        }
+    )
+
+
+def top_k_similar(
+    user_id: str,
+    candidate_ids: list[str],
+    vectors: dict[str, np.ndarray],
+    k: int,
+    index: ann.IVFIndex | None = None,
+) -> list[str]:
+    """Order candidates by cosine similarity to the user and keep the top `k`.
+
+    With an `index`, the nearest neighbours are searched among the candidates
+    only, scoring those in the lists closest to the user, and just candidates
+    missing from the index are scored by brute force. Candidates without a
+    vector go last, keeping their original order.
+    """
+    if user_id not in vectors:
+        return candidate_ids[:k]
+    scored: list[tuple[str, float]] = []
+    if index is not None:
+        scored = index.search(
+            vectors[user_id], k, exclude={user_id}, allowed=candidate_ids
+        )
+        candidate_ids = [c for c in candidate_ids if c not in index]
+    with_vectors = [c for c in candidate_ids if c in vectors]
+    without_vectors = [c for c in candidate_ids if c not in vectors]
+    if with_vectors:
+        scores = np.stack([vectors[c] for c in with_vectors]) @ vectors[user_id]
+        scored += zip(with_vectors, scores.tolist())
+    ranked = [uid for uid, _ in sorted(scored, key=lambda item: -item[1])]
+    return (ranked + without_vectors)[:k]
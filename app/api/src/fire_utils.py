@@ -2,20 +2,48 @@ import firebase_admin
 from firebase_admin import auth
 from src import LOGGER
 from firebase_admin import firestore
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core import exceptions as gexc
+from google.cloud.firestore_v1.field_path import FieldPath
 import datetime
+import os
 import pytz
+import random
+import threading
+import time
 import geopy.distance as geodist
+from src.buckets import EligibilityBuckets
+from src.geo import SpatialIndex, within_km
+from src.profile_store import CompactProfile
 from src.models import (
+    MatchPair,
+    PairInterest,
     Profile,
     RecordedMatch,
     Location,
     MatchmakingStatus,
     StoredMatches,
     Persona,
+    create_canonical_match_id,
 )
 
 fire_app = firebase_admin.initialize_app()
 fdb = firestore.client()
+_ELIGIBILITY_BUCKETS: EligibilityBuckets | None = None
+# profiles saved or deleted while the index is rebuilt, replayed onto the new one
+_BUCKETS_CHANGES: dict[str, Profile | None] | None = None
+_BUCKETS_THREAD: threading.Thread | None = None
+_BUCKETS_LOCK = threading.Lock()
+# a user's own documents, keyed by their user ID and deleted with their account
+USER_COLLECTIONS = (
+    "profile",
+    "matches",
+    "persona",
+    "persona_embedding",
+    "change_marker",
+    "matchmaking_state",
+)
+
 
 def create_feedback(user_id: str, text: str, category: str):
     feedback_ref = fdb.collection("feedback").document(user_id)
@@ -25,21 +53,57 @@ def create_feedback(user_id: str, text: str, category: str):
     if feedback_doc.exists:
         feedback_data = feedback_doc.to_dict().get("user_feedbacks", [])
 
-    feedback_data.append({"text": text, "timestamp": datetime.datetime.now(pytz.utc).isoformat(), "category": category,})
+    feedback_data.append(
+        {
+            "text": text,
+            "timestamp": datetime.datetime.now(pytz.utc).isoformat(),
+            "category": category,
+        }
+    )
     feedback_ref.set({"user_feedbacks": feedback_data})
     LOGGER.info(f"Feedback successfully saved for {user_id=}")
 
+
 def delete_all(user_id: str):
     _ = auth.delete_user(user_id)
-    profile_ref = fdb.collection("profile").document(user_id)
-    profile_ref.delete()
-    matches_ref = fdb.collection("matches").document(user_id)
-    matches_ref.delete()
-    persona_ref = fdb.collection("persona").document(user_id)
-    persona_ref.delete()
+    for collection in USER_COLLECTIONS:
+        fdb.collection(collection).document(user_id).delete()
+    for query in user_pair_queries(fdb, user_id):
+        for doc in query.stream():
+            doc.reference.delete()
+    discard_eligible(user_id)
     LOGGER.info(f"Deleted all data for {user_id=}")
 
 
+def user_pair_queries(db, user_id: str) -> list:
+    """Query the pair documents naming a user, with the sync or async client `db`.
+
+    Every match_pair record holds each user's interest under their ID, and
+    ranking_cache entries list both users.
+    """
+    interest = FieldPath("interest", user_id, "showed_interest").to_api_repr()
+    return [
+        db.collection("match_pair").where(interest, "in", [True, False]),
+        db.collection("ranking_cache").where("users", "array_contains", user_id),
+    ]
+
+
+def discard_eligible(user_id: str):
+    """Drop a deleted user from the cached eligibility index, if it is built."""
+    _update_eligible(user_id, None)
+
+
+def _update_eligible(user_id: str, profile: Profile | None):
+    with _BUCKETS_LOCK:
+        if _BUCKETS_CHANGES is not None:
+            _BUCKETS_CHANGES[user_id] = profile
+        if _ELIGIBILITY_BUCKETS is not None:
+            if profile:
+                _ELIGIBILITY_BUCKETS.add(profile)
+            else:
+                _ELIGIBILITY_BUCKETS.remove(user_id)
+
+
 def get_profile(user_id: str) -> Profile | None:
     profile_ref = fdb.collection("profile").document(user_id)
     profile_doc = profile_ref.get()
@@ -59,11 +123,94 @@ def get_all_profiles() -> list[Profile]:
     return [Profile(**profile.to_dict()) for profile in profiles]
 
 
+def get_profiles(user_ids: list[str]) -> dict[str, Profile]:
+    """Load the given users' profiles with batched `get_all` calls, skipping missing ones."""
+    return {
+        doc.id: Profile(**doc.to_dict()) for doc in get_documents("profile", user_ids)
+    }
+
+
+def get_profile_ids() -> set[str]:
+    """List the IDs of every profile without reading their contents."""
+    return {doc.id for doc in fdb.collection("profile").select(["__name__"]).stream()}
+
+
+def get_compact_profiles() -> list[CompactProfile]:
+    """Load every profile for a job run without validating the fields matchmaking never reads."""
+    profiles = [
+        CompactProfile(doc.to_dict()) for doc in fdb.collection("profile").stream()
+    ]
+    LOGGER.info(f"Loaded {len(profiles)} compact profiles")
+    return profiles
+
+
+def _rebuild_eligibility_buckets():
+    global _ELIGIBILITY_BUCKETS, _BUCKETS_CHANGES
+    try:
+        buckets = EligibilityBuckets(get_all_profiles())
+        with _BUCKETS_LOCK:
+            for user_id, profile in _BUCKETS_CHANGES.items():
+                if profile:
+                    buckets.add(profile)
+                else:
+                    buckets.remove(user_id)
+            _ELIGIBILITY_BUCKETS = buckets
+        LOGGER.info(f"Built eligibility buckets for {len(buckets)} profiles")
+    except Exception as e:
+        LOGGER.error(f"Failed to build eligibility buckets: {e}")
+    finally:
+        with _BUCKETS_LOCK:
+            _BUCKETS_CHANGES = None
+
+
+def refresh_eligibility_buckets() -> threading.Thread:
+    """Rebuild the eligibility index from Firestore on a background thread, unless one is running."""
+    global _BUCKETS_CHANGES, _BUCKETS_THREAD
+    with _BUCKETS_LOCK:
+        if _BUCKETS_CHANGES is None:
+            _BUCKETS_CHANGES = {}
+            _BUCKETS_THREAD = threading.Thread(
+                target=_rebuild_eligibility_buckets, daemon=True
+            )
+            _BUCKETS_THREAD.start()
+        return _BUCKETS_THREAD
+
+
+def get_eligibility_buckets() -> EligibilityBuckets:
+    """Return the process-wide eligibility index, refreshing it in the background when stale.
+
+    A stale index keeps serving requests while it is rebuilt, only a process
+    without one yet (the API warms it on startup) waits for the build.
+    """
+    buckets = _ELIGIBILITY_BUCKETS
+    if buckets is None:
+        refresh_eligibility_buckets().join()
+        if _ELIGIBILITY_BUCKETS is None:
+            raise RuntimeError("Could not build the eligibility buckets")
+        return _ELIGIBILITY_BUCKETS
+    if buckets.is_stale():
+        refresh_eligibility_buckets()
+    return buckets
+
+
 def apply_preference_filters(
-    user_profile: Profile, all_new_profiles: list[Profile]
+    user_profile: Profile,
+    all_new_profiles: list[Profile],
+    spatial_index: SpatialIndex | None = None,
 ) -> list[Profile]:
+    """Return the profiles mutually compatible with the user's preferences.
+
+    When a `spatial_index` built over `all_new_profiles` is given and the user
+    has a distance limit, only profiles inside that radius are checked.
+    """
+    if spatial_index and user_profile.location and user_profile.distance_range_km:
+        all_new_profiles = spatial_index.query(
+            user_profile.location, user_profile.distance_range_km
+        )
     filtered_profiles = []
     for profile in all_new_profiles:
+        if profile.user_id == user_profile.user_id:
+            continue
         # if child mismatch
         if (user_profile.is_child and not profile.is_child) or (
             profile.is_child and not user_profile.is_child
@@ -85,13 +232,13 @@ def apply_preference_filters(
             continue
         # if location mismatch
         if profile.location and profile.distance_range_km:
-            if not user_profile.location or profile.distance_range_km < distance_km(
-                user_profile.location, profile.location
+            if not user_profile.location or not within_km(
+                user_profile.location, profile.location, profile.distance_range_km
             ):
                 continue
         if user_profile.location and user_profile.distance_range_km:
-            if not profile.location or user_profile.distance_range_km < distance_km(
-                user_profile.location, profile.location
+            if not profile.location or not within_km(
+                user_profile.location, profile.location, user_profile.distance_range_km
             ):
                 continue
         filtered_profiles.append(profile)
@@ -105,6 +252,40 @@ def distance_km(location: Location, location2: Location) -> float:
     ).km
 
 
+GET_ALL_CHUNK_SIZE = 300
+BATCH_WRITE_LIMIT = 500
+BATCH_COMMIT_WORKERS = int(os.getenv("BATCH_COMMIT_WORKERS", 8))
+BATCH_COMMIT_RETRIES = 5
+RETRYABLE_ERRORS = (
+    gexc.Aborted,
+    gexc.DeadlineExceeded,
+    gexc.InternalServerError,
+    gexc.ResourceExhausted,
+    gexc.ServiceUnavailable,
+)
+
+
+def get_documents(collection: str, user_ids: list[str] | None = None):
+    """Stream a whole collection, or fetch the given documents with batched `get_all` calls."""
+    if user_ids is None:
+        yield from fdb.collection(collection).stream()
+        return
+    user_ids = list(dict.fromkeys(user_ids))
+    for i in range(0, len(user_ids), GET_ALL_CHUNK_SIZE):
+        refs = [
+            fdb.collection(collection).document(user_id)
+            for user_id in user_ids[i : i + GET_ALL_CHUNK_SIZE]
+        ]
+        for doc in fdb.get_all(refs):
+            if doc.exists:
+                yield doc
+
+
+def stored_matches_from_dict(details: dict) -> StoredMatches:
+    matches = [RecordedMatch(**match) for match in details.get("matches", [])]
+    return StoredMatches(matches=matches, last_updated=details.get("last_updated"))
+
+
 def get_matches(user_id: str) -> StoredMatches:
     matches_ref = fdb.collection("matches").document(user_id)
     matches_doc = matches_ref.get()
@@ -113,9 +294,19 @@ def get_matches(user_id: str) -> StoredMatches:
         LOGGER.debug(f"No matches found for {user_id=}")
         return StoredMatches(matches=[])
 
-    details = matches_doc.to_dict()
-    matches = [RecordedMatch(**match) for match in details.get("matches", [])]
-    return StoredMatches(matches=matches, last_updated=details.get("last_updated"))
+    return stored_matches_from_dict(matches_doc.to_dict())
+
+
+def get_all_matches(user_ids: list[str] | None = None) -> dict[str, StoredMatches]:
+    """Load stored matches for the given users (or everyone) into memory in one pass."""
+    all_matches = {
+        doc.id: stored_matches_from_dict(doc.to_dict())
+        for doc in get_documents("matches", user_ids)
+    }
+    for user_id in user_ids or []:
+        all_matches.setdefault(user_id, StoredMatches(matches=[]))
+    LOGGER.info(f"Loaded stored matches for {len(all_matches)} users")
+    return all_matches
 
 
 def save_matches(
@@ -132,19 +323,138 @@ def save_matches(
     )
 
 
-def batch_save_matches(user_matches: dict[str, list[RecordedMatch]]):
-    batch = fdb.batch()
+def get_match_pairs(user_id: str, matched_user_ids: list[str]) -> dict[str, MatchPair]:
+    """Load the pair records of a user's matches in one batched read, keyed by the other user."""
+    other_user_ids = {
+        create_canonical_match_id(user_id, other): other for other in matched_user_ids
+    }
+    return {
+        other_user_ids[doc.id]: MatchPair(**doc.to_dict())
+        for doc in get_documents("match_pair", list(other_user_ids))
+    }
+
+
+def save_match_interest(user_id: str, matched_user_id: str, show_interest: bool):
+    """Set only this user's interest in the pair record, leaving the other user's untouched."""
+    match_id = create_canonical_match_id(user_id, matched_user_id)
+    fdb.collection("match_pair").document(match_id).set(
+        {"interest": {user_id: {"showed_interest": True, "interested": show_interest}}},
+        merge=True,
+    )
+    LOGGER.info(f"Saved interest of {user_id=} in match {match_id}")
+
+
+def _new_match_pairs(
+    user_matches: dict[str, list[RecordedMatch]],
+    stored_matches: dict[str, StoredMatches],
+) -> dict[str, dict]:
+    """Fresh pair records for the matches not already in `stored_matches`."""
+    pairs = {}
     for user_id, matches in user_matches.items():
-        matches_ref = fdb.collection("matches").document(user_id)
-        batch.set(
-            matches_ref,
-            {
-                "matches": [match.dict() for match in matches],
-                "last_updated": datetime.datetime.now(pytz.utc).isoformat(),
-            },
+        stored = stored_matches.get(user_id, StoredMatches(matches=[]))
+        known = {(m.user_id, m.date_matched) for m in stored.matches}
+        for match in matches:
+            if (match.user_id, match.date_matched) not in known:
+                pairs[create_canonical_match_id(user_id, match.user_id)] = {
+                    "interest": {
+                        uid: PairInterest().dict() for uid in (user_id, match.user_id)
+                    }
+                }
+    return pairs
+
+
+def backfill_match_pairs() -> dict[str, str]:
+    """Fill pair records from the interest flags in every user's current matches.
+
+    Only users missing from a pair record are written, merged into it, so
+    interest recorded through /matches/update is never overwritten and the
+    backfill can be rerun safely.
+    """
+    pairs: dict[str, dict] = {}
+    for doc in get_documents("matches"):
+        for match in stored_matches_from_dict(doc.to_dict()).matches:
+            match_id = create_canonical_match_id(doc.id, match.user_id)
+            pairs.setdefault(match_id, {"interest": {}})["interest"][doc.id] = {
+                "showed_interest": match.you_showed_interest,
+                "interested": match.your_interested,
+            }
+    for doc in get_documents("match_pair", list(pairs)):
+        recorded = MatchPair(**doc.to_dict()).interest
+        interest = pairs[doc.id]["interest"]
+        for user_id in recorded:
+            interest.pop(user_id, None)
+        if not interest:
+            del pairs[doc.id]
+    batch_set("match_pair", pairs, merge=True)
+    LOGGER.info(f"Backfilled {len(pairs)} match pair records")
+    return {"message": f"Backfilled {len(pairs)} match pair records"}
+
+
+def _commit_with_retry(
+    collection: str, docs: list[tuple[str, dict]], merge: bool = False
+):
+    """Commit one batch, backing off with jitter on contention or transient errors."""
+    for attempt in range(BATCH_COMMIT_RETRIES):
+        batch = fdb.batch()
+        for doc_id, data in docs:
+            batch.set(fdb.collection(collection).document(doc_id), data, merge=merge)
+        try:
+            batch.commit()
+            return
+        except RETRYABLE_ERRORS as e:
+            if attempt == BATCH_COMMIT_RETRIES - 1:
+                raise
+            delay = 0.5 * 2**attempt * (1 + random.random())
+            LOGGER.warning(
+                f"Retrying batch of {len(docs)} {collection} writes in {delay:.1f}s: {e}"
+            )
+            time.sleep(delay)
+
+
+def batch_set(collection: str, docs: dict[str, dict], merge: bool = False):
+    """Set many documents in chunks of BATCH_WRITE_LIMIT, committing the chunks concurrently."""
+    items = list(docs.items())
+    chunks = [
+        items[i : i + BATCH_WRITE_LIMIT]
+        for i in range(0, len(items), BATCH_WRITE_LIMIT)
+    ]
+    if len(chunks) <= 1:
+        for chunk in chunks:
+            _commit_with_retry(collection, chunk, merge)
+        return
+    with ThreadPoolExecutor(max_workers=BATCH_COMMIT_WORKERS) as executor:
+        # list() re-raises the first failed commit
+        list(
+            executor.map(
+                lambda chunk: _commit_with_retry(collection, chunk, merge), chunks
+            )
         )
-    batch.commit()
-    LOGGER.info(f"Batch saved {len(user_matches)} user matches")
+
+
+def batch_save_matches(
+    user_matches: dict[str, list[RecordedMatch]],
+    stored_matches: dict[str, StoredMatches],
+):
+    """Save each user's match list, skipping users whose list equals their `stored_matches`.
+
+    Users missing from `stored_matches` are compared with an empty list. New
+    matches get a fresh pair record, so a repeat match starts without interest.
+    `stored_matches` must hold every saved user's matches as read, or their
+    existing matches would count as new and lose their interest.
+    """
+    now = datetime.datetime.now(pytz.utc).isoformat()
+    docs = {}
+    for user_id, matches in user_matches.items():
+        match_dicts = [match.dict() for match in matches]
+        stored = stored_matches.get(user_id, StoredMatches(matches=[]))
+        if match_dicts == [match.dict() for match in stored.matches]:
+            continue
+        docs[user_id] = {"matches": match_dicts, "last_updated": now}
+    batch_set("matches", docs)
+    batch_set("match_pair", _new_match_pairs(user_matches, stored_matches))
+    LOGGER.info(
+        f"Batch saved {len(docs)} user matches ({len(user_matches) - len(docs)} unchanged)"
+    )
 
 
 def get_matchmaking_status() -> MatchmakingStatus:
@@ -175,20 +485,72 @@ def get_persona(user_id: str) -> Persona | None:
     return Persona(**persona_doc.to_dict(), user_id=user_id)
 
 
+def get_all_personas(user_ids: list[str] | None = None) -> dict[str, Persona]:
+    """Load personas for the given users (or everyone) into memory in one pass."""
+    personas = {
+        doc.id: Persona(**doc.to_dict(), user_id=doc.id)
+        for doc in get_documents("persona", user_ids)
+    }
+    LOGGER.info(f"Loaded {len(personas)} personas")
+    return personas
+
+
+def get_persona_embeddings(user_ids: list[str] | None = None) -> dict[str, dict]:
+    return {
+        doc.id: doc.to_dict() for doc in get_documents("persona_embedding", user_ids)
+    }
+
+
+def save_persona_embeddings(embeddings: dict[str, dict]):
+    batch_set("persona_embedding", embeddings)
+    LOGGER.info(f"Saved {len(embeddings)} persona embeddings")
+
+
+def change_marker() -> dict:
+    """A `change_marker` document recording that a user's matchmaking inputs changed now."""
+    return {"updated_at": datetime.datetime.now(pytz.utc)}
+
+
+def _mark_changed(user_id: str):
+    """Record when a user's matchmaking inputs last changed, for incremental matchmaking."""
+    fdb.collection("change_marker").document(user_id).set(change_marker())
+
+
+def get_change_markers(
+    user_ids: list[str] | None = None,
+) -> dict[str, datetime.datetime]:
+    return {
+        doc.id: doc.to_dict().get("updated_at")
+        for doc in get_documents("change_marker", user_ids)
+    }
+
+
+def get_matchmaking_watermarks(user_ids: list[str] | None = None) -> dict[str, dict]:
+    return {
+        doc.id: doc.to_dict() for doc in get_documents("matchmaking_state", user_ids)
+    }
+
+
+def save_matchmaking_watermarks(watermarks: dict[str, dict]):
+    batch_set("matchmaking_state", watermarks)
+    LOGGER.info(f"Saved matchmaking watermarks for {len(watermarks)} users")
+
+
 def save_persona(
-    user_id: str,
-    persona_description: str,
-    new_scores: dict[str, int] | None = None
+    user_id: str, persona_description: str, new_scores: dict[str, int] | None = None
 ):
     persona_ref = fdb.collection("persona").document(user_id)
     update_props = {"description": persona_description}
     if new_scores:
         update_props["profile_category_scores"] = new_scores
     persona_ref.set(update_props, merge=True)
+    _mark_changed(user_id)
     LOGGER.info(f"Persona successfully saved/updated for {user_id=}")
 
 
 def save_profile(user_id: str, profile: Profile):
     profiles_ref = fdb.collection("profile").document(user_id)
     profiles_ref.set(profile.dict(), merge=True)
+    _mark_changed(user_id)
+    _update_eligible(user_id, profile)
     LOGGER.info(f"Profile successfully saved/updated for {user_id=}")
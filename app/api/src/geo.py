@@ -0,0 +1,100 @@
+import math
+import geopy.distance as geodist
+from src.models import Location, Profile
+
+EARTH_RADIUS_KM = 6371.0088
+# haversine on a sphere is within ~0.6% of the WGS-84 geodesic distance
+HAVERSINE_ERROR = 0.006
+CELL_DEG = 1.0
+# a slight underestimate, so the grid search never undershoots the radius
+KM_PER_DEG = 110.0
+
+
+def haversine_km(location: Location, location2: Location) -> float:
+    lat1, lat2 = math.radians(location.latitude), math.radians(location2.latitude)
+    dlat = lat2 - lat1
+    dlon = math.radians(location2.longitude - location.longitude)
+    a = (
+        math.sin(dlat / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def within_km(location: Location, location2: Location, max_km: float) -> bool:
+    """Check if two locations are within `max_km`, only computing the geodesic near the boundary."""
+    approx_km = haversine_km(location, location2)
+    if approx_km <= max_km * (1 - HAVERSINE_ERROR):
+        return True
+    if approx_km > max_km * (1 + HAVERSINE_ERROR):
+        return False
+    return (
+        geodist.distance(
+            (location.latitude, location.longitude),
+            (location2.latitude, location2.longitude),
+        ).km
+        <= max_km
+    )
+
+
+NUM_LON_CELLS = round(360 / CELL_DEG)
+
+
+def _wrap_lon_cell(lon_cell: int) -> int:
+    return (lon_cell + NUM_LON_CELLS // 2) % NUM_LON_CELLS - NUM_LON_CELLS // 2
+
+
+def _cell(latitude: float, longitude: float) -> tuple[int, int]:
+    return (
+        math.floor(latitude / CELL_DEG),
+        _wrap_lon_cell(math.floor(longitude / CELL_DEG)),
+    )
+
+
+class SpatialIndex:
+    """A lat/lon grid over profile locations for finding candidates within a radius.
+
+    Profiles without a location are not indexed. Query results keep the order
+    the profiles were given in, so downstream subsetting is unchanged.
+    """
+
+    def __init__(self, profiles: list[Profile]):
+        self._profiles = profiles
+        self._cells: dict[tuple[int, int], list[tuple[int, Profile]]] = {}
+        for position, profile in enumerate(profiles):
+            if profile.location:
+                cell = _cell(profile.location.latitude, profile.location.longitude)
+                self._cells.setdefault(cell, []).append((position, profile))
+
+    def query(self, location: Location, radius_km: float) -> list[Profile]:
+        """Return located profiles that may be within `radius_km`, using a haversine pre-check."""
+        return [self._profiles[i] for i in self.query_positions(location, radius_km)]
+
+    def query_positions(self, location: Location, radius_km: float) -> list[int]:
+        """Like `query`, but return the positions of the profiles in the indexed list."""
+        lat_span = radius_km / KM_PER_DEG
+        min_lat = max(-90.0, location.latitude - lat_span)
+        max_lat = min(90.0, location.latitude + lat_span)
+        # widen the longitude span at the band's highest latitude, covering everything near poles
+        max_abs_lat = max(abs(min_lat), abs(max_lat))
+        cos_lat = math.cos(math.radians(max_abs_lat))
+        if max_abs_lat >= 89.0 or radius_km / (KM_PER_DEG * cos_lat) >= 180.0:
+            lon_cells = set(range(-NUM_LON_CELLS // 2, NUM_LON_CELLS // 2))
+        else:
+            lon_span = radius_km / (KM_PER_DEG * cos_lat)
+            lon_cells = {
+                _wrap_lon_cell(c)
+                for c in range(
+                    math.floor((location.longitude - lon_span) / CELL_DEG),
+                    math.floor((location.longitude + lon_span) / CELL_DEG) + 1,
+                )
+            }
+
+        candidates = []
+        max_approx_km = radius_km * (1 + HAVERSINE_ERROR)
+        for lat_cell in range(_cell(min_lat, 0)[0], _cell(max_lat, 0)[0] + 1):
+            for lon_cell in lon_cells:
+                for position, profile in self._cells.get((lat_cell, lon_cell), []):
+                    if haversine_km(location, profile.location) <= max_approx_km:
+                        candidates.append((position, profile))
+        return sorted(position for position, _ in candidates)
@@ -0,0 +1,78 @@
+import datetime
+import hashlib
+import json
+import pytz
+from src import LOGGER, fire_utils
+from src.models import Persona, Profile
+
+# re-evaluate unchanged users this often, so they get new matches as old ones
+# expire (their unchanged pairs are then served by the ranking cache, which
+# incremental mode turns on by default)
+REEVALUATE_AFTER_DAYS = 7
+
+
+def user_fingerprint(profile: Profile, persona: Persona | None) -> str:
+    """Hash the data matchmaking reads about a user, to catch writes made outside the API."""
+    data = [profile.to_string(), persona.description if persona else None]
+    return hashlib.sha256(json.dumps(data).encode()).hexdigest()
+
+
+def _as_datetime(value) -> datetime.datetime | None:
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.fromisoformat(value)
+
+
+def find_changed_users(
+    profiles: list[Profile], personas: dict[str, Persona]
+) -> list[Profile]:
+    """Return the users that are new, or whose profile or persona changed since their last evaluation.
+
+    A user has changed if a change marker written by `save_profile` or
+    `save_persona` is newer than their watermark, or if their fingerprint no
+    longer matches the one recorded at that evaluation. Users not evaluated
+    for REEVALUATE_AFTER_DAYS are also returned.
+    """
+    now = datetime.datetime.now(pytz.utc)
+    user_ids = [p.user_id for p in profiles]
+    watermarks = fire_utils.get_matchmaking_watermarks(user_ids)
+    markers = fire_utils.get_change_markers(user_ids)
+
+    changed = []
+    for profile in profiles:
+        watermark = watermarks.get(profile.user_id)
+        if not watermark:
+            changed.append(profile)
+            continue
+        last_evaluated = _as_datetime(watermark["last_evaluated"])
+        last_changed = _as_datetime(markers.get(profile.user_id))
+        fingerprint = user_fingerprint(profile, personas.get(profile.user_id))
+        if (
+            (last_changed and last_changed > last_evaluated)
+            or fingerprint != watermark.get("fingerprint")
+            or (now - last_evaluated).days >= REEVALUATE_AFTER_DAYS
+        ):
+            changed.append(profile)
+    LOGGER.info(f"Found {len(changed)} new or changed users out of {len(profiles)}")
+    return changed
+
+
+def user_fingerprints(
+    profiles: list[Profile], personas: dict[str, Persona]
+) -> dict[str, str]:
+    """Fingerprint the users as they are evaluated, to be recorded by `mark_evaluated`."""
+    return {p.user_id: user_fingerprint(p, personas.get(p.user_id)) for p in profiles}
+
+
+def mark_evaluated(
+    fingerprints: dict[str, str],
+    evaluated_at: datetime.datetime | None = None,
+):
+    """Record the users as evaluated at `evaluated_at` with the fingerprints they were evaluated with."""
+    evaluated_at = evaluated_at or datetime.datetime.now(pytz.utc)
+    fire_utils.save_matchmaking_watermarks(
+        {
+            user_id: {"last_evaluated": evaluated_at, "fingerprint": fingerprint}
+            for user_id, fingerprint in fingerprints.items()
+        }
+    )
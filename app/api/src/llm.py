@@ -0,0 +1,144 @@
+import asyncio
+import os
+import threading
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+from src import LOGGER
+
+# The clients read OPENAI_API_KEY, and OPENAI_BASE_URL to point them at a local stub server.
+# They do not retry, ratelimit retries the calls made through ai.GENERATOR
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", 100))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", 20))
+OPENAI_KEEPALIVE_S = float(os.getenv("OPENAI_KEEPALIVE_S", 60))
+
+_CLIENT: OpenAI | None = None
+_ASYNC_CLIENT: AsyncOpenAI | None = None
+_LOCK = threading.Lock()
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+        keepalive_expiry=OPENAI_KEEPALIVE_S,
+    )
+
+
+def get_client() -> OpenAI:
+    """Return the process-wide OpenAI client, whose connection pool every thread shares."""
+    global _CLIENT
+    with _LOCK:
+        if _CLIENT is None:
+            _CLIENT = OpenAI(
+                max_retries=0, http_client=DefaultHttpxClient(limits=_limits())
+            )
+            LOGGER.info(f"Created OpenAI client for {_CLIENT.base_url}")
+        return _CLIENT
+
+
+def get_async_client() -> AsyncOpenAI:
+    """Return the process-wide async OpenAI client, for use on the API's event loop."""
+    global _ASYNC_CLIENT
+    with _LOCK:
+        if _ASYNC_CLIENT is None:
+            _ASYNC_CLIENT = AsyncOpenAI(
+                max_retries=0, http_client=DefaultAsyncHttpxClient(limits=_limits())
+            )
+            LOGGER.info(f"Created async OpenAI client for {_ASYNC_CLIENT.base_url}")
+        return _ASYNC_CLIENT
+
+
+class UsageStats:
+    """Token usage and latency of LLM calls per label, read from the API's usage fields.
+
+    Cached tokens are the part of the prompt served from the API's prompt
+    cache, so `cached_share` and the latency of calls with and without a cache
+    hit show how much each endpoint gains from its static prompt prefix.
+    """
+
+    def __init__(self):
+        self._stats: dict[str, dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, label: str, usage, latency_s: float | None = None):
+        """Add a completion's usage, an SDK usage object or a Batch API usage dict."""
+        if usage is None:
+            return
+        if isinstance(usage, dict):
+            details = usage.get("prompt_tokens_details") or {}
+            prompt_tokens = usage.get("prompt_tokens") or 0
+            completion_tokens = usage.get("completion_tokens") or 0
+            cached_tokens = details.get("cached_tokens") or 0
+        else:
+            details = getattr(usage, "prompt_tokens_details", None)
+            prompt_tokens = usage.prompt_tokens or 0
+            completion_tokens = usage.completion_tokens or 0
+            cached_tokens = getattr(details, "cached_tokens", None) or 0
+        with self._lock:
+            stats = self._stats.setdefault(
+                label,
+                {
+                    "calls": 0,
+                    "prompt_tokens": 0,
+                    "cached_tokens": 0,
+                    "completion_tokens": 0,
+                    "cached_calls": 0,
+                    "cached_latency_s": 0.0,
+                    "uncached_calls": 0,
+                    "uncached_latency_s": 0.0,
+                },
+            )
+            stats["calls"] += 1
+            stats["prompt_tokens"] += prompt_tokens
+            stats["cached_tokens"] += cached_tokens
+            stats["completion_tokens"] += completion_tokens
+            if latency_s is not None:
+                hit = "cached" if cached_tokens else "uncached"
+                stats[f"{hit}_calls"] += 1
+                stats[f"{hit}_latency_s"] += latency_s
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    @property
+    def stats(self) -> dict[str, dict[str, float]]:
+        with self._lock:
+            return {
+                label: {
+                    "calls": s["calls"],
+                    "prompt_tokens": s["prompt_tokens"],
+                    "cached_tokens": s["cached_tokens"],
+                    "completion_tokens": s["completion_tokens"],
+                    "cached_share": round(s["cached_tokens"] / s["prompt_tokens"], 3)
+                    if s["prompt_tokens"]
+                    else 0.0,
+                    "mean_cached_latency_s": round(
+                        s["cached_latency_s"] / s["cached_calls"], 3
+                    )
+                    if s["cached_calls"]
+                    else None,
+                    "mean_uncached_latency_s": round(
+                        s["uncached_latency_s"] / s["uncached_calls"], 3
+                    )
+                    if s["uncached_calls"]
+                    else None,
+                }
+                for label, s in self._stats.items()
+            }
+
+
+USAGE = UsageStats()
+
+
+async def close_clients():
+    """Close both clients' connection pools, the next `get_*` call creates a new client."""
+    global _CLIENT, _ASYNC_CLIENT
+    with _LOCK:
+        client, async_client = _CLIENT, _ASYNC_CLIENT
+        _CLIENT, _ASYNC_CLIENT = None, None
+    if client:
+        await asyncio.to_thread(client.close)
+    if async_client:
+        await async_client.close()
+    LOGGER.info("Closed OpenAI clients")
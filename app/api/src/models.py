@@ -1,12 +1,18 @@
-from pydantic import BaseModel, constr
+from pydantic import BaseModel, PrivateAttr, constr
+import functools
 import pytz
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from faker import Faker
 import random
 
 faker = Faker()
 
 
+def create_canonical_match_id(user1: str, user2: str) -> str:
+    """Create a consistent match ID regardless of user order."""
+    return "_".join(sorted([user1, user2]))
+
+
 class MatchResult(BaseModel):
     compatibility_rating: int  # 1-10
     rationale1: str  # explanation of the rating to person 1
@@ -14,6 +20,14 @@ class MatchResult(BaseModel):
     highlighted_themes: list[str] | None = None
 
 
+class CandidateMatchResult(MatchResult):
+    candidate: int  # the candidate's number in a group ranking prompt
+
+
+class GroupMatchResult(BaseModel):
+    results: list[CandidateMatchResult]
+
+
 class Chat(BaseModel):
     role: str
     content: str
@@ -102,6 +116,41 @@ class RecordedMatch(BaseModel):
         )
 
 
+class PairInterest(BaseModel):
+    showed_interest: bool = False
+    interested: bool = False
+
+
+class MatchPair(BaseModel):
+    """Both users' interest in a match, stored once per pair under its canonical match ID."""
+
+    interest: dict[str, PairInterest] = {}  # by user ID
+
+    def of(self, user_id: str) -> PairInterest:
+        return self.interest.get(user_id, PairInterest())
+
+    @classmethod
+    def from_recorded(
+        cls,
+        user_id: str,
+        match: "RecordedMatch",
+        their_match: "RecordedMatch | None" = None,
+    ) -> "MatchPair":
+        """A pair built from the RecordedMatch interest flags, for matches without a pair record."""
+        interest = {
+            user_id: PairInterest(
+                showed_interest=match.you_showed_interest,
+                interested=match.your_interested,
+            )
+        }
+        if their_match:
+            interest[match.user_id] = PairInterest(
+                showed_interest=their_match.you_showed_interest,
+                interested=their_match.your_interested,
+            )
+        return cls(interest=interest)
+
+
 class DisplayMatch(BaseModel):
     name: str
     matched_user_id: str
@@ -160,22 +209,48 @@ class PhoneNumber(BaseModel):
         return f"{self.countryCode} {self.number}"
 
 
-def age_from_dob(dob: str) -> int | None:
-    if dob is None:
-        return None  # No date of birth provided
+@functools.lru_cache(maxsize=100_000)
+def parse_dob(dob: str) -> date:
+    """Parse a 'DD/MM/YYYY' date of birth, cached as the same dates are parsed on every run."""
     try:
-        birth_date = datetime.strptime(dob, "%d/%m/%Y")
-        today = datetime.today()
-        age = (
-            today.year
-            - birth_date.year
-            - ((today.month, today.day) < (birth_date.month, birth_date.day))
-        )
-        return age
+        return datetime.strptime(dob, "%d/%m/%Y").date()
     except ValueError:
         raise ValueError("Date of birth must be in 'DD/MM/YYYY' format")
 
 
+def age_from_dob(dob: str, today: datetime | None = None) -> int | None:
+    if dob is None:
+        return None  # No date of birth provided
+    birth_date = parse_dob(dob)
+    today = today or datetime.today()
+    age = (
+        today.year
+        - birth_date.year
+        - ((today.month, today.day) < (birth_date.month, birth_date.day))
+    )
+    return age
+
+
+def cached_age(profile: "Profile") -> int | None:
+    """Return the profile's age, computed at most once a day or fixed by `compute_ages`."""
+    cached = profile._age_cache
+    if cached and cached[0] == profile.dob and cached[1] in (None, date.today()):
+        return cached[2]
+    age = age_from_dob(profile.dob)
+    profile._age_cache = (profile.dob, date.today(), age)
+    return age
+
+
+def compute_ages(profiles: list["Profile"], today: datetime | None = None):
+    """Fix every profile's age relative to a single `today`, for the length of a job run."""
+    today = today or datetime.today()
+    for profile in profiles:
+        try:
+            profile._age_cache = (profile.dob, None, age_from_dob(profile.dob, today))
+        except ValueError:
+            pass  # left to raise when the age is read
+
+
 class Profile(BaseModel):
     user_id: str
     name: constr(max_length=100) | None = None  # type: ignore
@@ -188,6 +263,10 @@ class Profile(BaseModel):
     location: Location | None = None
     distance_range_km: int | None = None
     never_refreshed_matches: bool = True
+    # (dob, day computed on or None if fixed by `compute_ages`, age)
+    _age_cache: tuple[str | None, date | None, int | None] | None = PrivateAttr(
+        default=None
+    )
 
     @property
     def is_child(self) -> bool:
@@ -195,7 +274,7 @@ class Profile(BaseModel):
 
     @property
     def age(self) -> int | None:
-        return age_from_dob(self.dob)
+        return cached_age(self)
 
     @classmethod
     def generate_random(cls, gender: str | None = None) -> "Profile":
@@ -242,7 +321,7 @@ class Profile(BaseModel):
             "distance_range_km": "Preferred Min. Distance (KM)",
             "orientation": "Interested in",
         }
-        custom_functions = {"dob": lambda x: f"{x} ({age_from_dob(x)})"}
+        custom_functions = {"dob": lambda x: f"{x} ({self.age})"}
 
         context_items = []
         for k, v in dict(self).items():
@@ -0,0 +1,92 @@
+from typing import NamedTuple
+from src.models import Location, Profile, cached_age
+
+
+class Point(NamedTuple):
+    latitude: float
+    longitude: float
+
+
+class CompactProfile:
+    """A slotted, unvalidated stand-in for `Profile` holding only what the matcher reads.
+
+    The job filters, buckets and plans pairs over these. Besides the filtering
+    fields it keeps the few that the ranking prompt shows, so the raw document
+    is not kept, and `to_profile` validates a `Profile` from them once needed.
+    The phone number and image, which no prompt reads, are left out.
+    """
+
+    __slots__ = (
+        "user_id",
+        "dob",
+        "gender",
+        "orientation",
+        "age_range",
+        "location",
+        "distance_range_km",
+        "name",
+        "location_name",
+        "location_consent",
+        "never_refreshed_matches",
+        "_age_cache",
+        "_string",
+    )
+
+    def __init__(self, doc: dict):
+        location = doc.get("location")
+        self.user_id: str = doc["user_id"]
+        self.dob: str | None = doc.get("dob")
+        self.gender: str | None = doc.get("gender")
+        self.orientation = tuple(doc["orientation"]) if doc.get("orientation") else None
+        self.age_range = tuple(doc["age_range"]) if doc.get("age_range") else None
+        self.location = (
+            Point(float(location["latitude"]), float(location["longitude"]))
+            if location
+            else None
+        )
+        self.distance_range_km: int | None = doc.get("distance_range_km")
+        self.name: str | None = doc.get("name")
+        self.location_name: str | None = location.get("name") if location else None
+        self.location_consent: bool | None = (
+            location.get("consent") if location else None
+        )
+        self.never_refreshed_matches: bool = doc.get("never_refreshed_matches", True)
+        self._age_cache = None
+        self._string: str | None = None
+
+    def __repr__(self) -> str:
+        return f"CompactProfile(user_id={self.user_id!r})"
+
+    @property
+    def age(self) -> int | None:
+        return cached_age(self)
+
+    @property
+    def is_child(self) -> bool:
+        return self.age < 18
+
+    def to_profile(self) -> Profile:
+        return Profile(
+            user_id=self.user_id,
+            name=self.name,
+            dob=self.dob,
+            age_range=self.age_range,
+            gender=self.gender,
+            orientation=list(self.orientation) if self.orientation else None,
+            location=Location(
+                latitude=self.location.latitude,
+                longitude=self.location.longitude,
+                consent=self.location_consent,
+                name=self.location_name,
+            )
+            if self.location
+            else None,
+            distance_range_km=self.distance_range_km,
+            never_refreshed_matches=self.never_refreshed_matches,
+        )
+
+    def to_string(self) -> str:
+        # rendered for every pair a user is in, so kept once built
+        if self._string is None:
+            self._string = self.to_profile().to_string()
+        return self._string
@@ -0,0 +1,174 @@
+import asyncio
+import functools
+import os
+import random
+import threading
+import time
+import openai
+from src import LOGGER
+
+# Set these to the organisation's limits for MODEL_NAME. They are paced per
+# process, every GENERATOR call in it shares them and a sharded job's shards
+# split them
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", 500))
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", 200_000))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 6))
+BACKOFF_BASE_S = 1.0
+BACKOFF_MAX_S = 60.0
+COMPLETION_TOKENS_ESTIMATE = 500  # reserved per call for the response
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+
+def estimate_tokens(messages: list[dict]) -> int:
+    """Roughly count a request's tokens, at four characters a token plus the response."""
+    prompt_chars = sum(len(str(message.get("content", ""))) for message in messages)
+    return prompt_chars // 4 + COMPLETION_TOKENS_ESTIMATE
+
+
+class TokenBucket:
+    """A bucket refilling `per_minute` units a minute, up to one minute's worth.
+
+    Units are reserved rather than waited for, so the bucket may go into debt.
+    Each caller is told how long to wait for its share, and concurrent callers
+    are served in the order they reserved.
+    """
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= amount
+        return max(0.0, -self.level / self.rate)
+
+
+class RateLimiter:
+    """Paces LLM calls under requests and tokens per minute limits, retrying retryable errors.
+
+    A rate limit error pauses every caller for the backoff, so a burst of 429s
+    slows the whole process down instead of each caller retrying into it.
+    """
+
+    def __init__(
+        self,
+        rpm: float = OPENAI_RPM,
+        tpm: float = OPENAI_TPM,
+        max_retries: int = LLM_MAX_RETRIES,
+    ):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_retries = max_retries
+        self.paused_until = 0.0
+        self.attempts = 0
+        self.retries = 0
+        self.failures = 0
+        self.wait_s = 0.0
+        self.max_wait_s = 0.0
+        self._lock = threading.Lock()
+
+    def set_limits(self, rpm: float, tpm: float):
+        """Pace calls under new limits, e.g. this process's share of the organisation's."""
+        with self._lock:
+            self.requests = TokenBucket(rpm)
+            self.tokens = TokenBucket(tpm)
+
+    def _reserve(self, num_tokens: int) -> float:
+        with self._lock:
+            now = time.monotonic()
+            wait = max(
+                self.requests.reserve(1, now),
+                self.tokens.reserve(num_tokens, now),
+                self.paused_until - now,
+                0.0,
+            )
+            self.attempts += 1
+            self.wait_s += wait
+            self.max_wait_s = max(self.max_wait_s, wait)
+            return wait
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        """Return how long to wait before retrying `error`, or raise it if it should not be retried."""
+        if (
+            attempt >= self.max_retries
+            or getattr(error, "code", None) == "insufficient_quota"
+        ):
+            with self._lock:
+                self.failures += 1
+            raise error
+        delay = min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2**attempt) * (
+            0.5 + random.random() / 2
+        )
+        response = getattr(error, "response", None)
+        retry_after = (
+            response.headers.get("retry-after") if response is not None else None
+        )
+        if retry_after and retry_after.replace(".", "", 1).isdigit():
+            delay = max(delay, float(retry_after))
+        with self._lock:
+            self.retries += 1
+            if isinstance(error, openai.RateLimitError):
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        LOGGER.warning(
+            f"Retrying LLM call in {delay:.1f}s (attempt {attempt + 1}/{self.max_retries}): {error}"
+        )
+        return delay
+
+    def call(self, generator, messages: list[dict], *args, **kwargs):
+        num_tokens = estimate_tokens(messages)
+        for attempt in range(self.max_retries + 1):
+            time.sleep(self._reserve(num_tokens))
+            try:
+                return generator(messages, *args, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                time.sleep(self._backoff(attempt, e))
+
+    async def acall(self, generator, messages: list[dict], *args, **kwargs):
+        num_tokens = estimate_tokens(messages)
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(self._reserve(num_tokens))
+            try:
+                return await generator(messages, *args, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                await asyncio.sleep(self._backoff(attempt, e))
+
+    @property
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            return {
+                "attempts": self.attempts,
+                "retries": self.retries,
+                "failures": self.failures,
+                "mean_wait_s": round(self.wait_s / self.attempts, 3)
+                if self.attempts
+                else 0.0,
+                "max_wait_s": round(self.max_wait_s, 3),
+            }
+
+
+LIMITER = RateLimiter()
+
+
+def rate_limited(generator):
+    """Wrap a sync or async generator so its calls go through the shared LIMITER."""
+    if asyncio.iscoroutinefunction(generator):
+
+        @functools.wraps(generator)
+        async def async_wrapper(messages: list[dict], *args, **kwargs):
+            return await LIMITER.acall(generator, messages, *args, **kwargs)
+
+        return async_wrapper
+
+    @functools.wraps(generator)
+    def wrapper(messages: list[dict], *args, **kwargs):
+        return LIMITER.call(generator, messages, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,434 @@
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import uuid
+import pytz
+from src import LOGGER, algo, batch, cache, fire_utils, ratelimit
+from src.incremental import find_changed_users, mark_evaluated, user_fingerprints
+from src.models import MatchResult, compute_ages
+from src.profile_store import CompactProfile
+
+# Cloud Run sets these for each task of a job execution
+SHARD_INDEX = int(os.getenv("CLOUD_RUN_TASK_INDEX", 0))
+SHARD_COUNT = int(os.getenv("CLOUD_RUN_TASK_COUNT", 1))
+# The prepare step, shard tasks, their retries and the reduce step of a run
+# share its checkpoints under this ID, so each of them must be given the same value
+RUN_ID = os.getenv("MATCHMAKING_RUN_ID", "")
+# where the run's checkpoints are kept, "" (firestore) or a directory
+MATCHMAKING_CHECKPOINT = os.getenv("MATCHMAKING_CHECKPOINT", "")
+CHECKPOINT_EVERY = 200  # ranked pairs per checkpoint
+MATCHEES_PER_DOCUMENT = 5_000  # matchee fingerprints per Firestore document
+
+RankedPairs = dict[str, tuple[str, str, MatchResult]]
+
+
+def shard_of(key: str, shard_count: int) -> int:
+    """Place a key (e.g. a canonical match ID) in one of `shard_count` equal ranges of a stable hash."""
+    value = int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big")
+    return (value * shard_count) >> 64
+
+
+def _serialise(pairs: RankedPairs) -> dict[str, dict]:
+    return {
+        match_id: {"user1": user1, "user2": user2, "result": result.dict()}
+        for match_id, (user1, user2, result) in pairs.items()
+    }
+
+
+def _deserialise(pairs: dict[str, dict]) -> RankedPairs:
+    return {
+        match_id: (pair["user1"], pair["user2"], MatchResult(**pair["result"]))
+        for match_id, pair in pairs.items()
+    }
+
+
+class FileCheckpointStore:
+    """Checkpoints as JSON files under a local directory, for running shards as local processes."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _dir(self, run_id: str) -> str:
+        path = os.path.join(self.root, run_id)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def _write(self, path: str, data: dict):
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(f"{path}.tmp", path)
+
+    def save_pairs(self, run_id: str, shard: int, pairs: dict[str, dict]):
+        name = f"pairs-{shard}-{uuid.uuid4().hex}.json"
+        self._write(os.path.join(self._dir(run_id), name), pairs)
+
+    def load_pairs(self, run_id: str, shard: int | None = None) -> dict[str, dict]:
+        prefix = "pairs-" if shard is None else f"pairs-{shard}-"
+        pairs = {}
+        for name in sorted(os.listdir(self._dir(run_id))):
+            if name.startswith(prefix) and name.endswith(".json"):
+                with open(os.path.join(self._dir(run_id), name)) as f:
+                    pairs.update(json.load(f))
+        return pairs
+
+    def save_batch_id(self, run_id: str, shard: int, name: str, batch_id: str):
+        self._write(
+            os.path.join(self._dir(run_id), f"batch-{shard}-{name}"),
+            {"batch_id": batch_id},
+        )
+
+    def load_batch_id(self, run_id: str, shard: int, name: str) -> str | None:
+        path = os.path.join(self._dir(run_id), f"batch-{shard}-{name}")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)["batch_id"]
+
+    def delete_batch_id(self, run_id: str, shard: int, name: str):
+        path = os.path.join(self._dir(run_id), f"batch-{shard}-{name}")
+        if os.path.exists(path):
+            os.remove(path)
+
+    def save_matchees(self, run_id: str, fingerprints: dict[str, str]):
+        self._write(os.path.join(self._dir(run_id), "matchees.json"), fingerprints)
+
+    def load_matchees(self, run_id: str) -> dict[str, str] | None:
+        path = os.path.join(self._dir(run_id), "matchees.json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def mark_done(self, run_id: str, step: str):
+        self._write(os.path.join(self._dir(run_id), f"done-{step}"), {})
+
+    def done_steps(self, run_id: str) -> set[str]:
+        return {
+            name.removeprefix("done-")
+            for name in os.listdir(self._dir(run_id))
+            if name.startswith("done-") and not name.endswith(".tmp")
+        }
+
+    def clear(self, run_id: str):
+        shutil.rmtree(os.path.join(self.root, run_id), ignore_errors=True)
+
+
+class FirestoreCheckpointStore:
+    """Checkpoints under `matchmaking_run/{run_id}`, shared by every task of a Cloud Run job."""
+
+    def __init__(self):
+        self._collection = fire_utils.fdb.collection("matchmaking_run")
+
+    def save_pairs(self, run_id: str, shard: int, pairs: dict[str, dict]):
+        self._collection.document(run_id).collection("pairs").document().set(
+            {"shard": shard, "pairs": pairs}
+        )
+
+    def load_pairs(self, run_id: str, shard: int | None = None) -> dict[str, dict]:
+        query = self._collection.document(run_id).collection("pairs")
+        if shard is not None:
+            query = query.where("shard", "==", shard)
+        pairs = {}
+        for doc in query.stream():
+            pairs.update(doc.to_dict()["pairs"])
+        return pairs
+
+    def save_batch_id(self, run_id: str, shard: int, name: str, batch_id: str):
+        self._collection.document(run_id).collection("batches").document(
+            f"{shard}-{name}"
+        ).set({"batch_id": batch_id})
+
+    def load_batch_id(self, run_id: str, shard: int, name: str) -> str | None:
+        doc = (
+            self._collection.document(run_id)
+            .collection("batches")
+            .document(f"{shard}-{name}")
+            .get()
+        )
+        return doc.to_dict()["batch_id"] if doc.exists else None
+
+    def delete_batch_id(self, run_id: str, shard: int, name: str):
+        self._collection.document(run_id).collection("batches").document(
+            f"{shard}-{name}"
+        ).delete()
+
+    def save_matchees(self, run_id: str, fingerprints: dict[str, str]):
+        # split to stay under Firestore's document size limit
+        items = sorted(fingerprints.items())
+        matchees = self._collection.document(run_id).collection("matchees")
+        for i in range(0, len(items), MATCHEES_PER_DOCUMENT):
+            matchees.document(str(i // MATCHEES_PER_DOCUMENT)).set(
+                {"fingerprints": dict(items[i : i + MATCHEES_PER_DOCUMENT])}
+            )
+        self._collection.document(run_id).set({"num_matchees": len(items)})
+
+    def load_matchees(self, run_id: str) -> dict[str, str] | None:
+        if not self._collection.document(run_id).get().exists:
+            return None
+        fingerprints = {}
+        for doc in self._collection.document(run_id).collection("matchees").stream():
+            fingerprints.update(doc.to_dict()["fingerprints"])
+        return fingerprints
+
+    def mark_done(self, run_id: str, step: str):
+        self._collection.document(run_id).collection("done").document(step).set(
+            {"finished_at": datetime.datetime.now(pytz.utc)}
+        )
+
+    def done_steps(self, run_id: str) -> set[str]:
+        return {
+            doc.id
+            for doc in self._collection.document(run_id).collection("done").stream()
+        }
+
+    def clear(self, run_id: str):
+        fire_utils.fdb.recursive_delete(self._collection.document(run_id))
+
+
+CheckpointStore = FileCheckpointStore | FirestoreCheckpointStore
+
+
+def get_checkpoint_store() -> CheckpointStore:
+    if MATCHMAKING_CHECKPOINT:
+        return FileCheckpointStore(MATCHMAKING_CHECKPOINT)
+    return FirestoreCheckpointStore()
+
+
+class ShardBatchIds:
+    """Keeps a shard's batch IDs in the run's checkpoints, for `batch.rank_pairs`.
+
+    A retried task starts on a fresh filesystem, so the IDs live with the
+    checkpoints. A batch whose results were read is only deleted by `release`
+    once the shard has checkpointed them, so a task that failed while
+    checkpointing resumes that batch rather than submitting the pairs left
+    again.
+    """
+
+    def __init__(self, store: CheckpointStore, run_id: str, shard: int):
+        self.store = store
+        self.run_id = run_id
+        self.shard = shard
+        self._finished: list[str] = []
+
+    def get(self, name: str) -> str | None:
+        return self.store.load_batch_id(self.run_id, self.shard, name)
+
+    def put(self, name: str, batch_id: str):
+        self.store.save_batch_id(self.run_id, self.shard, name, batch_id)
+
+    def delete(self, name: str):
+        self._finished.append(name)
+
+    def release(self):
+        """Delete the IDs of the finished batches, once their results are checkpointed."""
+        for name in self._finished:
+            self.store.delete_batch_id(self.run_id, self.shard, name)
+        self._finished.clear()
+
+
+def prepare_shards(run_id: str = RUN_ID, incremental: bool = False):
+    """Start a sharded run, embedding new or changed personas before any shard runs.
+
+    Shards run concurrently, so embedding in each of them would pay for every
+    stale persona once per shard and race on its stored vector. They are
+    embedded and the saved ANN index synced here once, and the shards only
+    read both. In `incremental` mode the users to evaluate are also chosen
+    here, with the fingerprints they are evaluated with, so every shard works
+    on the same users and `reduce_shards` records exactly what was read.
+    """
+    assert run_id, "Set MATCHMAKING_RUN_ID, shared by every step of the run"
+    store = get_checkpoint_store()
+    if "prepare" in store.done_steps(run_id):
+        LOGGER.info(f"Run {run_id=} already prepared")
+        return {"message": "Run already prepared"}
+
+    current_status = fire_utils.get_matchmaking_status()
+    current_status.start()
+    fire_utils.save_matchmaking_status(current_status)
+    source = algo.get_job_source()
+    personas = None
+    if incremental:
+        personas = source.get_all_personas()
+        changed = find_changed_users(source.get_compact_profiles(), personas)
+        store.save_matchees(run_id, user_fingerprints(changed, personas))
+    if algo.EMBEDDING_PRERANK:
+        algo.embed_personas(personas or source.get_all_personas(), sync_index=True)
+    store.mark_done(run_id, "prepare")
+    return {"message": f"Prepared {run_id=}"}
+
+
+def run_shard(
+    run_id: str = RUN_ID,
+    shard_index: int = SHARD_INDEX,
+    shard_count: int = SHARD_COUNT,
+    incremental: bool = False,
+):
+    """Rank the planned pairs owned by one shard, checkpointing as it goes.
+
+    Needs `prepare_shards` to have run. Every shard plans the pairs of all
+    matchees, which is cheap next to ranking, and keeps those whose canonical
+    match ID hashes to it. A pair surfaced from both sides is then ranked by
+    exactly one shard. A rerun with the same `run_id` skips pairs already
+    ranked, and a finished shard is a no-op. Nothing is saved to `matches`
+    until `reduce_shards`.
+    """
+    assert run_id, "Set MATCHMAKING_RUN_ID, shared by every step of the run"
+    store = get_checkpoint_store()
+    step = f"shard-{shard_index}"
+    done_steps = store.done_steps(run_id)
+    if step in done_steps:
+        LOGGER.info(f"Shard {shard_index} of {run_id=} already done")
+        return {"message": f"Shard {shard_index} already done"}
+    if "prepare" not in done_steps:
+        LOGGER.error(f"Cannot run shard {shard_index}, {run_id=} is not prepared")
+        return {"message": "Run is not prepared"}
+
+    # Each shard process paces its own LLM calls, so it takes its share of
+    # the organisation's limits
+    ratelimit.LIMITER.set_limits(
+        ratelimit.OPENAI_RPM / shard_count, ratelimit.OPENAI_TPM / shard_count
+    )
+    source = algo.get_job_source()
+    all_user_profiles = source.get_compact_profiles()
+    compute_ages(all_user_profiles)
+    matchee_profiles: list[CompactProfile] = list(all_user_profiles)
+    personas = source.get_all_personas()
+    if incremental:
+        matchees = store.load_matchees(run_id)
+        if matchees is None:
+            LOGGER.error(f"Cannot run shard {shard_index}, {run_id=} has no matchees")
+            return {"message": "Run was not prepared in incremental mode"}
+        matchee_profiles = [p for p in matchee_profiles if p.user_id in matchees]
+
+    all_stored_matches = source.get_all_matches(
+        [profile.user_id for profile in matchee_profiles] if incremental else None
+    )
+    existing_match_ids = algo.get_existing_match_ids(
+        {
+            user_id: algo.current_valid_matches(stored_matches)
+            for user_id, stored_matches in all_stored_matches.items()
+        }
+    )
+
+    # Shards run concurrently, so they only read the embeddings and the saved
+    # ANN index, which prepare_shards brought up to date
+    persona_vectors, persona_index = None, None
+    if algo.EMBEDDING_PRERANK:
+        persona_vectors, persona_index = algo.embed_personas(
+            personas, embed_stale=False
+        )
+
+    planned_pairs = {
+        match_id: pair
+        for match_id, pair in algo.plan_match_pairs(
+            matchee_profiles,
+            all_user_profiles,
+            existing_match_ids,
+            persona_vectors,
+            persona_index,
+            algo.get_profile_columns(source),
+        ).items()
+        if shard_of(match_id, shard_count) == shard_index
+    }
+    LOGGER.info(
+        f"Shard {shard_index}/{shard_count} of {run_id=} owns {len(planned_pairs)} planned pairs"
+    )
+    ranked = store.load_pairs(run_id, shard_index)
+    remaining = [(k, v) for k, v in planned_pairs.items() if k not in ranked]
+    LOGGER.info(
+        f"Resuming shard {shard_index} with {len(planned_pairs) - len(remaining)} of {len(planned_pairs)} pairs ranked"
+    )
+    if batch.RANKING_BACKEND == "online":
+        for i in range(0, len(remaining), CHECKPOINT_EVERY):
+            ranked_pairs = algo.rank_planned_pairs(
+                dict(remaining[i : i + CHECKPOINT_EVERY]), personas, offline=True
+            )
+            store.save_pairs(run_id, shard_index, _serialise(ranked_pairs))
+            LOGGER.info(
+                f"Checkpointed {min(i + CHECKPOINT_EVERY, len(remaining))} of {len(remaining)} pairs in shard {shard_index}"
+            )
+    elif remaining:
+        # One batch for the shard, its results checkpointed in slices that
+        # stay under Firestore's document size limit
+        batch_ids = ShardBatchIds(store, run_id, shard_index)
+        ranked_pairs = list(
+            batch.rank_pairs(dict(remaining), personas, batch_ids).items()
+        )
+        for i in range(0, len(ranked_pairs), CHECKPOINT_EVERY):
+            store.save_pairs(
+                run_id,
+                shard_index,
+                _serialise(dict(ranked_pairs[i : i + CHECKPOINT_EVERY])),
+            )
+        batch_ids.release()
+        LOGGER.info(
+            f"Checkpointed {len(ranked_pairs)} of {len(remaining)} pairs in shard {shard_index}"
+        )
+
+    store.mark_done(run_id, step)
+    return {"message": f"Ranked {len(planned_pairs)} pairs in shard {shard_index}"}
+
+
+def reduce_shards(
+    run_id: str = RUN_ID, shard_count: int = SHARD_COUNT, incremental: bool = False
+):
+    """Allocate and save matches from every shard's ranked pairs once all shards are done.
+
+    The MAX_MATCHES_PER_USER allocation is global, so pairs ranked by
+    different shards compete as in a single process run. In incremental mode
+    the users' evaluation watermarks are updated here, once every shard has
+    read them, with the fingerprints `prepare_shards` recorded. Once the
+    matches are saved the run's checkpoints are cleared, so a later run given
+    the same ID starts afresh.
+    """
+    assert run_id, "Set MATCHMAKING_RUN_ID, shared by every step of the run"
+    store = get_checkpoint_store()
+    done_steps = store.done_steps(run_id)
+    if "reduce" in done_steps:
+        LOGGER.info(f"Matches for {run_id=} already saved, clearing its checkpoints")
+        store.clear(run_id)
+        return {"message": "Matches already saved"}
+    missing = [i for i in range(shard_count) if f"shard-{i}" not in done_steps]
+    if missing:
+        LOGGER.error(f"Cannot reduce {run_id=}, shards {missing} have not finished")
+        return {"message": f"Shards {missing} have not finished"}
+
+    source = algo.get_job_source()
+    ranked_pairs = _deserialise(store.load_pairs(run_id))
+    LOGGER.info(f"Loaded {len(ranked_pairs)} ranked pairs from {shard_count} shards")
+    ranked_pairs = algo.drop_deleted_users(ranked_pairs, source)
+
+    user_ids = {uid for u1, u2, _ in ranked_pairs.values() for uid in (u1, u2)}
+    all_stored_matches = source.get_all_matches(list(user_ids))
+    user_current_valid_matches = {
+        user_id: algo.current_valid_matches(stored_matches)
+        for user_id, stored_matches in all_stored_matches.items()
+    }
+    num_new_matches = algo.allocate_matches(
+        ranked_pairs, user_current_valid_matches, all_stored_matches, source
+    )
+    if num_new_matches:
+        LOGGER.info(f"Saving {num_new_matches} new matches")
+        fire_utils.batch_save_matches(user_current_valid_matches, all_stored_matches)
+
+    if incremental:
+        # Users are recorded as prepare_shards read them, so a user changed or
+        # created since the run started is evaluated by the next one
+        current_status = fire_utils.get_matchmaking_status()
+        mark_evaluated(
+            store.load_matchees(run_id) or {},
+            evaluated_at=current_status.last_started,
+        )
+    store.mark_done(run_id, "reduce")
+
+    ranking_cache = cache.get_ranking_cache()
+    if ranking_cache:
+        LOGGER.info(f"Evicted {ranking_cache.store.evict()} ranking cache entries")
+
+    current_status = fire_utils.get_matchmaking_status()
+    current_status.stop()
+    fire_utils.save_matchmaking_status(current_status)
+    store.clear(run_id)
+    return {"message": f"Successfully created {num_new_matches} new matches"}
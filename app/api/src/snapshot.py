@@ -0,0 +1,332 @@
+import datetime
+import json
+import math
+import os
+import shutil
+from collections.abc import Iterator
+import numpy as np
+import pytz
+from src import LOGGER, fire_utils
+from src.columnar import profile_columns
+from src.models import Persona, Profile, StoredMatches
+from src.profile_store import CompactProfile
+
+MATCHMAKING_SNAPSHOT = os.getenv(
+    "MATCHMAKING_SNAPSHOT", ""
+)  # snapshot directory, if any
+# Stored matches are not snapshotted, the job rewrites each user's matches
+# document from what it reads, so they are always read from Firestore
+SNAPSHOT_COLLECTIONS = ("profile", "persona")
+SNAPSHOT_VERSION = 2  # bumped when the layout changes, forcing a full refresh
+# Profile fields stored as string columns, so compact profiles are rebuilt
+# without decoding the JSON documents
+PROFILE_STRING_FIELDS = ("dob", "gender", "orientation", "name", "location_name")
+ORIENTATION_SEPARATOR = "\x1f"
+
+
+def _distance_range_km(distance_km: float) -> int | float | None:
+    if math.isnan(distance_km):
+        return None
+    return int(distance_km) if distance_km.is_integer() else distance_km
+
+
+def _json_default(value):
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+
+class StringTable:
+    """Strings stored as one UTF-8 blob plus an int64 offsets array and a null mask, all memory-mapped."""
+
+    def __init__(self, path: str, name: str):
+        self.offsets = np.load(os.path.join(path, f"{name}.offsets.npy"), mmap_mode="r")
+        self.nulls = np.load(os.path.join(path, f"{name}.nulls.npy"), mmap_mode="r")
+        blob_path = os.path.join(path, f"{name}.blob")
+        self.blob = (
+            np.memmap(blob_path, dtype=np.uint8, mode="r")
+            if os.path.getsize(blob_path)
+            else np.empty(0, dtype=np.uint8)
+        )
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str | None:
+        if self.nulls[i]:
+            return None
+        return self.blob[self.offsets[i] : self.offsets[i + 1]].tobytes().decode()
+
+    def tolist(self) -> list[str | None]:
+        """Decode every string, reading the blob once."""
+        blob = self.blob.tobytes()
+        offsets = self.offsets.tolist()
+        return [
+            None if null else blob[offsets[i] : offsets[i + 1]].decode()
+            for i, null in enumerate(self.nulls.tolist())
+        ]
+
+    @staticmethod
+    def write(path: str, name: str, strings: list[str | None]):
+        offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+        with open(os.path.join(path, f"{name}.blob"), "wb") as f:
+            for i, string in enumerate(strings):
+                data = (string or "").encode()
+                f.write(data)
+                offsets[i + 1] = offsets[i] + len(data)
+        np.save(os.path.join(path, f"{name}.offsets.npy"), offsets)
+        np.save(
+            os.path.join(path, f"{name}.nulls.npy"),
+            np.array([string is None for string in strings], dtype=bool),
+        )
+
+
+class Snapshot:
+    """A memory-mapped copy of the collections the matchmaking job reads.
+
+    Each collection is stored as a table of document IDs, a table of JSON
+    documents and an array of Firestore update times, so opening a snapshot
+    only maps the files and documents are decoded when read. Profiles are
+    also stored as the NumPy columns a `ProfileTable` filters on, plus string
+    columns for the rest of a `CompactProfile`, so the job never decodes a
+    profile's JSON. It offers the same loaders as `fire_utils`, so the job can
+    run from it unchanged, with `get_all_matches` reading the live `matches`
+    collection.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(
+                f"Snapshot at {path} has version {self.meta.get('version')}, expected {SNAPSHOT_VERSION}"
+            )
+        self._ids: dict[str, list[str]] = {}
+        self._index: dict[str, dict[str, int]] = {}
+        self._docs: dict[str, StringTable] = {}
+        self._update_times: dict[str, np.ndarray] = {}
+        for collection in SNAPSHOT_COLLECTIONS:
+            ids = StringTable(path, f"{collection}.ids")
+            self._ids[collection] = [ids[i] for i in range(len(ids))]
+            self._index[collection] = {
+                doc_id: i for i, doc_id in enumerate(self._ids[collection])
+            }
+            self._docs[collection] = StringTable(path, f"{collection}.docs")
+            self._update_times[collection] = np.load(
+                os.path.join(path, f"{collection}.update_times.npy"), mmap_mode="r"
+            )
+
+    def update_time(self, collection: str, doc_id: str) -> float | None:
+        i = self._index[collection].get(doc_id)
+        return None if i is None else float(self._update_times[collection][i])
+
+    def raw_document(self, collection: str, doc_id: str) -> str | None:
+        i = self._index[collection].get(doc_id)
+        return None if i is None else self._docs[collection][i]
+
+    def _documents(
+        self, collection: str, user_ids: list[str] | None = None
+    ) -> Iterator[tuple[str, dict]]:
+        index = self._index[collection]
+        positions = (
+            range(len(self._ids[collection]))
+            if user_ids is None
+            else [index[u] for u in dict.fromkeys(user_ids) if u in index]
+        )
+        for i in positions:
+            yield self._ids[collection][i], json.loads(self._docs[collection][i])
+
+    def get_all_profiles(self) -> list[Profile]:
+        return [Profile(**doc) for _, doc in self._documents("profile")]
+
+    def _profile_column(self, name: str) -> np.ndarray:
+        return np.load(os.path.join(self.path, f"profile.{name}.npy"), mmap_mode="r")
+
+    def get_profile_columns(self) -> dict[str, np.ndarray]:
+        """Return the filtering columns of the profiles, in `get_compact_profiles` order."""
+        return {
+            name: self._profile_column(name) for name in self.meta["profile_columns"]
+        }
+
+    def get_compact_profiles(self) -> list[CompactProfile]:
+        strings = {
+            field: StringTable(self.path, f"profile.{field}").tolist()
+            for field in PROFILE_STRING_FIELDS
+        }
+        columns = {
+            name: self._profile_column(name).tolist()
+            for name in (
+                "age_min",
+                "age_max",
+                "latitude",
+                "longitude",
+                "distance_km",
+                "location_consent",
+                "never_refreshed_matches",
+            )
+        }
+        profiles = []
+        for i, user_id in enumerate(self._ids["profile"]):
+            orientation = strings["orientation"][i]
+            latitude = columns["latitude"][i]
+            distance_km = columns["distance_km"][i]
+            consent = columns["location_consent"][i]
+            doc = {
+                "user_id": user_id,
+                "dob": strings["dob"][i],
+                "gender": strings["gender"][i],
+                "orientation": orientation.split(ORIENTATION_SEPARATOR)
+                if orientation
+                else None,
+                "age_range": [columns["age_min"][i], columns["age_max"][i]]
+                if columns["age_min"][i] >= 0
+                else None,
+                "location": {
+                    "latitude": latitude,
+                    "longitude": columns["longitude"][i],
+                    "name": strings["location_name"][i],
+                    "consent": None if consent < 0 else bool(consent),
+                }
+                if not math.isnan(latitude)
+                else None,
+                "distance_range_km": _distance_range_km(distance_km),
+                "name": strings["name"][i],
+                "never_refreshed_matches": columns["never_refreshed_matches"][i],
+            }
+            profiles.append(CompactProfile(doc))
+        LOGGER.info(f"Loaded {len(profiles)} compact profiles from snapshot")
+        return profiles
+
+    def get_all_personas(self, user_ids: list[str] | None = None) -> dict[str, Persona]:
+        personas = {
+            doc_id: Persona(**doc, user_id=doc_id)
+            for doc_id, doc in self._documents("persona", user_ids)
+        }
+        LOGGER.info(f"Loaded {len(personas)} personas from snapshot")
+        return personas
+
+    def get_all_matches(
+        self, user_ids: list[str] | None = None
+    ) -> dict[str, StoredMatches]:
+        # A match saved after the snapshot, e.g. by /matches/create, would be
+        # dropped when the job overwrites the user's matches document
+        return fire_utils.get_all_matches(user_ids)
+
+
+def _write_profile_columns(
+    path: str,
+    ids: list[str],
+    docs: dict[str, str],
+    changed: set[str],
+    previous: Snapshot | None,
+) -> list[str]:
+    """Write the profiles' columns, decoding only the changed documents, and return the filtering column names."""
+    unchanged = (
+        {p.user_id: p for p in previous.get_compact_profiles()} if previous else {}
+    )
+    profiles = [
+        unchanged[doc_id]
+        if doc_id not in changed and doc_id in unchanged
+        else CompactProfile({**json.loads(docs[doc_id]), "user_id": doc_id})
+        for doc_id in ids
+    ]
+    columns = profile_columns(profiles)
+    for name, column in columns.items():
+        np.save(os.path.join(path, f"profile.{name}.npy"), column)
+    np.save(
+        os.path.join(path, "profile.location_consent.npy"),
+        np.array(
+            [
+                -1 if p.location_consent is None else p.location_consent
+                for p in profiles
+            ],
+            dtype=np.int8,
+        ),
+    )
+    np.save(
+        os.path.join(path, "profile.never_refreshed_matches.npy"),
+        np.array([bool(p.never_refreshed_matches) for p in profiles], dtype=bool),
+    )
+    for field in PROFILE_STRING_FIELDS:
+        values = [getattr(p, field) for p in profiles]
+        if field == "orientation":
+            values = [ORIENTATION_SEPARATOR.join(v) if v else None for v in values]
+        StringTable.write(path, f"profile.{field}", values)
+    return list(columns)
+
+
+def refresh_snapshot(path: str | None = None) -> dict[str, int]:
+    """Write a snapshot of Firestore to `path`, only fetching documents changed since the last one.
+
+    Changes are found by listing document names and update times, which
+    skips the document contents. The new snapshot atomically replaces the
+    old one. Returns the number of documents fetched per collection.
+    """
+    path = path or MATCHMAKING_SNAPSHOT
+    previous = None
+    if os.path.exists(os.path.join(path, "meta.json")):
+        try:
+            previous = Snapshot(path)
+        except ValueError as e:
+            LOGGER.warning(f"{e}, fetching every document")
+    tmp_path = f"{path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    num_fetched = {}
+    for collection in SNAPSHOT_COLLECTIONS:
+        update_times = {
+            doc.id: doc.update_time.timestamp()
+            for doc in fire_utils.fdb.collection(collection)
+            .select(["__name__"])
+            .stream()
+        }
+        changed = {
+            doc_id
+            for doc_id, update_time in update_times.items()
+            if previous is None
+            or previous.update_time(collection, doc_id) != update_time
+        }
+        docs = {
+            doc_id: previous.raw_document(collection, doc_id)
+            for doc_id in update_times
+            if doc_id not in changed
+        }
+        for doc in fire_utils.get_documents(collection, list(changed)):
+            docs[doc.id] = json.dumps(doc.to_dict(), default=_json_default)
+            update_times[doc.id] = doc.update_time.timestamp()
+        # a document deleted between listing and fetching is left out
+        ids = sorted(doc_id for doc_id in update_times if docs.get(doc_id) is not None)
+        StringTable.write(tmp_path, f"{collection}.ids", ids)
+        StringTable.write(tmp_path, f"{collection}.docs", [docs[i] for i in ids])
+        np.save(
+            os.path.join(tmp_path, f"{collection}.update_times.npy"),
+            np.array([update_times[i] for i in ids], dtype=np.float64),
+        )
+        if collection == "profile":
+            profile_column_names = _write_profile_columns(
+                tmp_path, ids, docs, changed, previous
+            )
+        num_fetched[collection] = len(changed)
+        LOGGER.info(
+            f"Snapshot of {collection} has {len(ids)} documents, {len(changed)} fetched"
+        )
+
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "version": SNAPSHOT_VERSION,
+                "created_at": datetime.datetime.now(pytz.utc).isoformat(),
+                "profile_columns": profile_column_names,
+            },
+            f,
+        )
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+    return num_fetched
+
+
+def load_snapshot(path: str | None = None) -> Snapshot:
+    path = path or MATCHMAKING_SNAPSHOT
+    snapshot = Snapshot(path)
+    LOGGER.info(f"Loaded snapshot taken at {snapshot.meta['created_at']} from {path}")
+    return snapshot
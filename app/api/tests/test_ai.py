@@ -0,0 +1,115 @@
+import pytest
+from src import ai, cache
+from src.models import CandidateMatchResult, GroupMatchResult, MatchResult, Persona
+
+
+class FakeGenerator:
+    """Answers group calls with `group_results` and single rankings with a rating of 5."""
+
+    def __init__(self, group_results=None, fail_for: str | None = None):
+        self.group_results = group_results
+        self.fail_for = fail_for
+        self.group_calls = 0
+        self.single_calls = []
+
+    def __call__(self, messages, response_format, timeout, label):
+        prompt = messages[0]["content"]
+        if response_format is GroupMatchResult:
+            self.group_calls += 1
+            if isinstance(self.group_results, Exception):
+                raise self.group_results
+            return GroupMatchResult(results=self.group_results)
+        self.single_calls.append(prompt)
+        if self.fail_for and self.fail_for in prompt:
+            raise RuntimeError("ranking failed")
+        return MatchResult(compatibility_rating=5, rationale1="one", rationale2="two")
+
+
+def candidate(number: int, rating: int) -> CandidateMatchResult:
+    return CandidateMatchResult(
+        candidate=number,
+        compatibility_rating=rating,
+        rationale1=f"one {number}",
+        rationale2=f"two {number}",
+    )
+
+
+@pytest.fixture
+def matchee(monkeypatch, profiles):
+    monkeypatch.setattr(cache, "get_ranking_cache", lambda: None)
+    user, *others = profiles[:4]
+    personas = {
+        p.user_id: Persona(description=f"Persona of {p.user_id}", user_id=p.user_id)
+        for p in profiles[:4]
+    }
+    return user, others, personas
+
+
+def rank_group(monkeypatch, matchee, generator):
+    monkeypatch.setattr(ai, "GENERATOR", generator)
+    user, others, personas = matchee
+    results = ai.rank_group(user, others, personas)
+    return {
+        other.user_id: results[other.user_id].compatibility_rating
+        for other in others
+        if other.user_id in results
+    }
+
+
+def test_one_call_ranks_the_whole_group(monkeypatch, matchee):
+    generator = FakeGenerator([candidate(1, 7), candidate(2, 8), candidate(3, 9)])
+    ratings = rank_group(monkeypatch, matchee, generator)
+
+    assert list(ratings.values()) == [7, 8, 9]
+    assert generator.group_calls == 1
+    assert generator.single_calls == []
+
+
+def test_failed_group_call_ranks_each_prospect(monkeypatch, matchee):
+    generator = FakeGenerator(RuntimeError("timed out"))
+    ratings = rank_group(monkeypatch, matchee, generator)
+
+    assert list(ratings.values()) == [5, 5, 5]
+    assert len(generator.single_calls) == 3
+
+
+@pytest.mark.parametrize(
+    "group_results, expected",
+    [
+        # candidate 3 missing
+        ([candidate(1, 7), candidate(2, 8)], [7, 8, 5]),
+        # candidate 2 scored twice
+        ([candidate(1, 7), candidate(2, 8), candidate(2, 9)], [7, 5, 5]),
+        # candidate 3 given an invalid rating
+        ([candidate(1, 7), candidate(2, 8), candidate(3, 0)], [7, 8, 5]),
+        # a candidate that does not exist
+        ([candidate(1, 7), candidate(2, 8), candidate(4, 9)], [7, 8, 5]),
+    ],
+)
+def test_prospects_the_group_response_misses_are_ranked_alone(
+    monkeypatch, matchee, group_results, expected
+):
+    generator = FakeGenerator(group_results)
+    ratings = rank_group(monkeypatch, matchee, generator)
+
+    # single rankings are rated 5
+    assert list(ratings.values()) == expected
+    assert len(generator.single_calls) == expected.count(5)
+
+
+def test_prospects_whose_own_ranking_fails_are_left_out(monkeypatch, matchee):
+    user, others, _ = matchee
+    generator = FakeGenerator(RuntimeError("timed out"), fail_for=others[1].to_string())
+    ratings = rank_group(monkeypatch, matchee, generator)
+
+    assert list(ratings) == [others[0].user_id, others[2].user_id]
+
+
+def test_prospects_without_a_persona_are_not_sent_to_the_llm(monkeypatch, matchee):
+    user, others, personas = matchee
+    del personas[others[0].user_id]
+    generator = FakeGenerator([candidate(1, 8), candidate(2, 9)])
+    ratings = rank_group(monkeypatch, matchee, generator)
+
+    assert list(ratings.values()) == [0, 8, 9]
+    assert generator.single_calls == []
@@ -0,0 +1,50 @@
+import random
+from collections import Counter
+import pytest
+from src import allocation
+
+
+def random_edges(seed: int, num_users: int = 40, num_edges: int = 200):
+    rng = random.Random(seed)
+    users = [f"u{i}" for i in range(num_users)]
+    pairs = set()
+    while len(pairs) < num_edges:
+        u, v = rng.sample(users, 2)
+        pairs.add((min(u, v), max(u, v)))
+    return [(u, v, rng.randint(0, 100)) for u, v in sorted(pairs)]
+
+
+def total_score(edges, chosen):
+    return sum(edges[i][2] for i in chosen)
+
+
+def degrees(edges, chosen):
+    return Counter(x for i in chosen for x in edges[i][:2])
+
+
+def test_bmatching_beats_greedy_on_an_augmenting_path():
+    edges = [("a", "b", 10), ("a", "c", 9), ("b", "d", 9)]
+    assert total_score(edges, allocation.greedy(edges, 1)) == 10
+    assert sorted(allocation.bmatching(edges, 1)) == [1, 2]
+
+
+@pytest.mark.parametrize("capacity", [1, 2, 5])
+@pytest.mark.parametrize("seed", range(5))
+def test_bmatching_respects_capacity_and_never_loses_to_greedy(seed, capacity):
+    edges = random_edges(seed)
+    greedy = allocation.greedy(edges, capacity)
+    chosen = allocation.bmatching(edges, capacity)
+
+    assert len(set(chosen)) == len(chosen)
+    assert max(degrees(edges, chosen).values()) <= capacity
+    assert max(degrees(edges, greedy).values()) <= capacity
+    assert total_score(edges, chosen) >= total_score(edges, greedy)
+
+
+def test_allocate_reports_the_chosen_edges():
+    edges = [("a", "b", 10), ("a", "c", 9), ("b", "d", 9), ("e", "f", 1)]
+    chosen, report = allocation.allocate(edges, 1, "bmatching")
+
+    assert report.total_score == total_score(edges, chosen) == 19
+    assert report.num_matches == 3
+    assert report.coverage == 1.0
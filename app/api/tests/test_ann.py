@@ -0,0 +1,160 @@
+import numpy as np
+import pytest
+from src import ann
+from src.ann import IVFIndex
+
+
+@pytest.fixture
+def vectors() -> dict[str, np.ndarray]:
+    rng = np.random.default_rng(0)
+    # clustered unit vectors, as persona embeddings are
+    centres = rng.normal(size=(8, 32))
+    points = centres[rng.integers(0, 8, 500)] + rng.normal(scale=0.5, size=(500, 32))
+    points /= np.linalg.norm(points, axis=1, keepdims=True)
+    return {f"user{i}": v.astype(np.float32) for i, v in enumerate(points)}
+
+
+def brute_force(vectors, query, k, exclude=()):
+    ids = [uid for uid in vectors if uid not in exclude]
+    scores = np.stack([vectors[uid] for uid in ids]) @ query
+    return [ids[i] for i in np.argsort(-scores, kind="stable")[:k]]
+
+
+def build(vectors, nlist=None) -> IVFIndex:
+    return IVFIndex.build(list(vectors), np.stack(list(vectors.values())), nlist)
+
+
+def test_probing_every_list_is_exact(vectors):
+    index = build(vectors, nlist=10)
+    for uid in list(vectors)[:20]:
+        found = [u for u, _ in index.search(vectors[uid], 10, nprobe=10)]
+        assert found == brute_force(vectors, vectors[uid], 10)
+
+
+def test_probing_some_lists_keeps_most_neighbours(vectors):
+    index = build(vectors)
+    recalls = [
+        len(
+            {u for u, _ in index.search(vectors[uid], 10, nprobe=3)}
+            & set(brute_force(vectors, vectors[uid], 10))
+        )
+        / 10
+        for uid in vectors
+    ]
+    assert np.mean(recalls) >= 0.9
+
+
+def test_search_returns_similarities_and_honours_exclude(vectors):
+    index = build(vectors, nlist=4)
+    query = vectors["user0"]
+    results = index.search(query, 5, nprobe=4, exclude={"user0"})
+
+    assert "user0" not in dict(results)
+    assert [u for u, _ in results] == brute_force(vectors, query, 5, {"user0"})
+    for uid, score in results:
+        assert score == pytest.approx(float(vectors[uid] @ query), abs=1e-5)
+
+
+def test_insert_and_delete_apply_in_place(vectors):
+    index = build(vectors, nlist=4)
+    query = -vectors["user1"]
+    index.insert("new", query)
+    assert index.search(query, 1, nprobe=4)[0][0] == "new"
+    assert len(index) == len(vectors) + 1
+
+    index.delete("new")
+    index.delete("user2")
+    found = [u for u, _ in index.search(query, len(vectors), nprobe=4)]
+    assert "new" not in found and "user2" not in found
+    assert len(index) == len(vectors) - 1
+
+
+def test_save_and_load_keep_inserts_and_drop_deletes(vectors, tmp_path):
+    index = build(vectors, nlist=4)
+    index.insert("new", vectors["user3"])
+    index.delete("user3")
+    index.save(str(tmp_path / "index"))
+
+    loaded = IVFIndex.load(str(tmp_path / "index"))
+    assert sorted(loaded.user_ids) == sorted(index.user_ids)
+    np.testing.assert_array_equal(loaded.get_vector("new"), vectors["user3"])
+    for uid in list(vectors)[:20]:
+        assert loaded.search(vectors[uid], 10) == index.search(vectors[uid], 10)
+
+
+def test_search_among_allowed_users_probes_until_k_are_found(vectors):
+    index = build(vectors)
+    rng = np.random.default_rng(1)
+    ids = list(vectors)
+    for uid in ids[:20]:
+        allowed = [ids[i] for i in rng.choice(len(ids), 30, replace=False)]
+        found = index.search(vectors[uid], 5, nprobe=1, exclude={uid}, allowed=allowed)
+        assert len(found) == 5
+        assert {u for u, _ in found} <= set(allowed) - {uid}
+
+
+def test_search_among_allowed_users_probing_every_list_is_exact(vectors):
+    index = build(vectors, nlist=10)
+    allowed = list(vectors)[::7]
+    for uid in list(vectors)[:20]:
+        found = [
+            u for u, _ in index.search(vectors[uid], 5, nprobe=10, allowed=allowed)
+        ]
+        assert found == brute_force({u: vectors[u] for u in allowed}, vectors[uid], 5)
+
+
+class FakeBlob:
+    def __init__(self, blobs: dict[str, bytes], name: str):
+        self.blobs = blobs
+        self.name = name
+
+    def exists(self) -> bool:
+        return self.name in self.blobs
+
+    def upload_from_filename(self, filename: str):
+        with open(filename, "rb") as f:
+            self.blobs[self.name] = f.read()
+
+    def upload_from_string(self, data: str):
+        self.blobs[self.name] = data.encode()
+
+    def download_as_text(self) -> str:
+        return self.blobs[self.name].decode()
+
+    def download_to_filename(self, filename: str):
+        with open(filename, "wb") as f:
+            f.write(self.blobs[self.name])
+
+    def delete(self):
+        del self.blobs[self.name]
+
+
+class FakeBucket:
+    def __init__(self):
+        self.blobs: dict[str, bytes] = {}
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self.blobs, name)
+
+    def list_blobs(self, prefix: str) -> list[FakeBlob]:
+        return [self.blob(name) for name in self.blobs if name.startswith(prefix)]
+
+
+def test_the_index_is_shared_through_cloud_storage(vectors, tmp_path, monkeypatch):
+    bucket = FakeBucket()
+    monkeypatch.setattr(ann, "_gcs_location", lambda uri: (bucket, "index"))
+    monkeypatch.setattr(ann, "PERSONA_INDEX_URI", "gs://bucket/index")
+    monkeypatch.setattr(ann, "PERSONA_INDEX_PATH", str(tmp_path / "prepare"))
+    monkeypatch.setattr(ann, "_PERSONA_INDEX", None)
+    ann.sync_persona_index(vectors)
+    updated = {**vectors, "new": vectors["user0"]}
+    ann.sync_persona_index(updated)
+    # only the latest version is kept
+    assert len(bucket.blobs) == len(ann.INDEX_FILES) + 1
+
+    # a shard on another machine loads what prepare saved
+    monkeypatch.setattr(ann, "PERSONA_INDEX_PATH", str(tmp_path / "shard"))
+    monkeypatch.setattr(ann, "_PERSONA_INDEX", None)
+    index = ann.get_persona_index()
+    assert sorted(index.user_ids) == sorted(updated)
+    np.testing.assert_array_equal(index.get_vector("new"), vectors["user0"])
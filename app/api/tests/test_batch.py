@@ -0,0 +1,147 @@
+import hashlib
+from datetime import datetime
+from types import SimpleNamespace
+import pytest
+from src import ai, algo, batch, cache
+from src.models import MatchResult, Persona
+
+FAILING_PAIR = ["user2", "user3"]
+
+
+def fake_ranking(messages, response_format, label, timeout=None):
+    """Rate a pair by a hash of its two user IDs, failing for FAILING_PAIR."""
+    user_ids = sorted(messages[0]["content"].split())
+    if user_ids == FAILING_PAIR:
+        raise RuntimeError("model error")
+    rating = 1 + hashlib.sha256(" ".join(user_ids).encode()).digest()[0] % 10
+    return MatchResult(compatibility_rating=rating, rationale1="a", rationale2="b")
+
+
+@pytest.fixture
+def pairs(monkeypatch, tmp_path, profiles):
+    monkeypatch.setattr(batch, "RANKING_BATCH_DIR", str(tmp_path / "files"))
+    monkeypatch.setattr(
+        batch, "get_batch_backend", lambda: batch.LocalBatchBackend(str(tmp_path))
+    )
+    monkeypatch.setattr(cache, "get_ranking_cache", lambda: None)
+    monkeypatch.setattr(ai, "GENERATOR", fake_ranking)
+    monkeypatch.setattr(
+        ai, "ranking_prompt", lambda user, other, *_: f"{user.user_id} {other.user_id}"
+    )
+    personas = {
+        p.user_id: Persona(description=f"Persona of {p.user_id}", user_id=p.user_id)
+        for p in profiles[1:]
+    }
+    planned_pairs = {
+        f"{profiles[i].user_id}_{profiles[i + 1].user_id}": (
+            profiles[i],
+            profiles[i + 1],
+        )
+        for i in range(0, 40, 2)
+    }
+    return SimpleNamespace(planned=planned_pairs, personas=personas)
+
+
+def lines(sizes: list[int]) -> list[str]:
+    return [str(i) * size for i, size in enumerate(sizes)]
+
+
+def test_chunks_stay_under_the_request_limit(monkeypatch):
+    monkeypatch.setattr(batch, "BATCH_MAX_REQUESTS", 3)
+    chunks = batch.chunk_requests(lines([1] * 7))
+    assert [len(c) for c in chunks] == [3, 3, 1]
+    assert sum(chunks, []) == lines([1] * 7)
+
+
+def test_chunks_stay_under_the_size_limit(monkeypatch):
+    monkeypatch.setattr(batch, "BATCH_MAX_BYTES", 10)
+    # each line takes its length plus a newline
+    chunks = batch.chunk_requests(lines([4, 4, 3, 9, 20, 1]))
+    assert [[len(line) for line in c] for c in chunks] == [[4, 4], [3], [9], [20], [1]]
+
+
+def test_batch_ranking_matches_online_ranking(pairs):
+    online = algo.rank_planned_pairs(pairs.planned, pairs.personas)
+    offline = batch.rank_pairs(
+        pairs.planned, pairs.personas, batch.FileBatchIds(batch.RANKING_BATCH_DIR)
+    )
+
+    assert offline == online
+    # the pair without a persona is resolved without a request, failures left out
+    assert pairs.planned.keys() - offline.keys() == {"user2_user3"}
+    assert offline[next(iter(pairs.planned))][2].compatibility_rating == 0
+
+
+class Crash(Exception):
+    pass
+
+
+def crash(*args):
+    raise Crash()
+
+
+def test_a_rerun_resumes_the_submitted_batch(pairs, monkeypatch):
+    batch_ids = batch.FileBatchIds(batch.RANKING_BATCH_DIR)
+    backend = batch.get_batch_backend()
+    submitted = []
+    submit, status = backend.submit, backend.status
+    monkeypatch.setattr(batch, "get_batch_backend", lambda: backend)
+    monkeypatch.setattr(
+        backend, "submit", lambda path: submitted.append(path) or submit(path)
+    )
+
+    # the job dies while waiting for its batch
+    monkeypatch.setattr(backend, "status", lambda batch_id: "in_progress")
+    monkeypatch.setattr(batch.time, "sleep", crash)
+    with pytest.raises(Crash):
+        batch.rank_pairs(pairs.planned, pairs.personas, batch_ids)
+    assert len(submitted) == 1
+    assert batch_ids.get("chunk-0")
+
+    monkeypatch.setattr(backend, "status", status)
+    ranked = batch.rank_pairs(pairs.planned, pairs.personas, batch_ids)
+    assert len(submitted) == 1
+    assert ranked == algo.rank_planned_pairs(pairs.planned, pairs.personas)
+    assert batch_ids.get("chunk-0") is None
+
+
+def test_a_rerun_after_the_plan_changed_submits_only_the_new_pairs(pairs, monkeypatch):
+    batch_ids = batch.RunBatchIds(
+        datetime(2024, 5, 1, 3), batch.FileBatchIds(batch.RANKING_BATCH_DIR)
+    )
+    backend = batch.get_batch_backend()
+    submitted = []
+    submit, status = backend.submit, backend.status
+    monkeypatch.setattr(batch, "get_batch_backend", lambda: backend)
+    monkeypatch.setattr(
+        backend,
+        "submit",
+        lambda path: submitted.append(open(path).read().count("\n")) or submit(path),
+    )
+    planned = list(pairs.planned.items())
+
+    monkeypatch.setattr(backend, "status", lambda batch_id: "in_progress")
+    monkeypatch.setattr(batch.time, "sleep", crash)
+    with pytest.raises(Crash):
+        batch.rank_pairs(dict(planned[:15]), pairs.personas, batch_ids)
+
+    # the rerun plans some pairs the interrupted batch has and some it lacks
+    monkeypatch.setattr(backend, "status", status)
+    replanned = dict(planned[5:])
+    ranked = batch.rank_pairs(replanned, pairs.personas, batch_ids)
+    assert submitted == [14, 5]  # less the pair without a persona
+    assert ranked == algo.rank_planned_pairs(replanned, pairs.personas)
+
+    # the ID is kept until the run has saved its matches
+    assert batch_ids.get("chunk-0")
+    batch_ids.release()
+    assert batch_ids.get("chunk-0") is None
+
+
+def test_runs_keep_their_batch_ids_apart(tmp_path):
+    store = batch.FileBatchIds(str(tmp_path))
+    interrupted = batch.RunBatchIds(datetime(2024, 5, 1, 3), store)
+    interrupted.put("chunk-0", "batch-1")
+
+    assert batch.RunBatchIds(datetime(2024, 5, 2, 3), store).get("chunk-0") is None
+    assert batch.RunBatchIds(datetime(2024, 5, 1, 3), store).get("chunk-0") == "batch-1"
@@ -0,0 +1,45 @@
+from src.buckets import EligibilityBuckets
+from src.columnar import ProfileTable
+from src.fire_utils import apply_preference_filters
+
+
+def user_ids(profiles):
+    return sorted(p.user_id for p in profiles)
+
+
+def test_bucket_candidates_keep_every_eligible_profile(profiles):
+    buckets = EligibilityBuckets(profiles)
+    table = ProfileTable(profiles)
+    for profile in profiles:
+        candidates = buckets.candidates(profile)
+        expected = user_ids(apply_preference_filters(profile, profiles))
+        assert set(expected) <= set(user_ids(candidates))
+        assert user_ids(apply_preference_filters(profile, candidates)) == expected
+        assert user_ids(table.filter(profile, candidates)) == expected
+
+
+def test_bucket_candidates_skip_incompatible_buckets(profiles):
+    buckets = EligibilityBuckets(profiles)
+    assert sum(len(buckets.candidates(p)) for p in profiles) < len(profiles) ** 2 / 2
+
+
+def test_add_and_remove_update_candidates(profiles):
+    buckets = EligibilityBuckets(profiles)
+    profile, match = next(
+        (p, matches[0])
+        for p in profiles
+        if (matches := apply_preference_filters(p, profiles))
+    )
+
+    buckets.remove(match.user_id)
+    assert match.user_id not in user_ids(buckets.candidates(profile))
+    assert len(buckets) == len(profiles) - 1
+    buckets.add(match)
+    assert match.user_id in user_ids(buckets.candidates(profile))
+
+
+def test_profiles_without_a_valid_dob_are_not_indexed(profiles):
+    profile = profiles[0].model_copy(update={"user_id": "no-dob", "dob": None})
+    buckets = EligibilityBuckets(profiles + [profile])
+    assert len(buckets) == len(profiles)
+    assert buckets.candidates(profile) == []
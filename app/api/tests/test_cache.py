@@ -0,0 +1,84 @@
+import pytest
+from src import cache
+from src.models import MatchResult, Persona
+
+DAY_S = 24 * 60 * 60
+
+
+class Clock:
+    def __init__(self, now: float = 1_000_000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "time", clock)
+    return clock
+
+
+def make_store(tmp_path, ttl_s: float = DAY_S, max_entries: int = 100):
+    return cache.SqliteRankingStore(str(tmp_path / "cache.db"), ttl_s, max_entries)
+
+
+def test_entries_expire_after_the_ttl(tmp_path, clock):
+    store = make_store(tmp_path)
+    store.put("a_b", "fp", {"rating": 1}, ["a", "b"])
+
+    clock.now += DAY_S - 1
+    assert store.get("a_b", "fp") == {"rating": 1}
+    clock.now += 2
+    assert store.get("a_b", "fp") is None
+    assert store.evict() == 1
+
+
+def test_reads_do_not_extend_the_ttl(tmp_path, clock):
+    store = make_store(tmp_path)
+    store.put("a_b", "fp", {"rating": 1}, ["a", "b"])
+    for _ in range(3):
+        clock.now += DAY_S / 2
+        store.get("a_b", "fp")
+    assert store.get("a_b", "fp") is None
+
+
+def test_a_changed_fingerprint_misses(tmp_path, clock):
+    store = make_store(tmp_path)
+    store.put("a_b", "fp", {"rating": 1}, ["a", "b"])
+    assert store.get("a_b", "other") is None
+
+
+def test_evict_keeps_the_most_recently_used_entries(tmp_path, clock):
+    store = make_store(tmp_path, max_entries=2)
+    for match_id in ("a_b", "a_c", "a_d"):
+        clock.now += 1
+        store.put(match_id, "fp", {}, [])
+    clock.now += 1
+    assert store.get("a_b", "fp") == {}
+
+    assert store.evict() == 1
+    assert store.get("a_b", "fp") == {}
+    assert store.get("a_c", "fp") is None
+    assert store.get("a_d", "fp") == {}
+
+
+def test_ranking_cache_orients_results_and_counts_hits(tmp_path, clock, profiles):
+    ranking_cache = cache.RankingCache(make_store(tmp_path))
+    profile1, profile2 = sorted(profiles[:2], key=lambda p: p.user_id)
+    persona1 = Persona(description="Likes hiking", user_id=profile1.user_id)
+    persona2 = Persona(description="Likes chess", user_id=profile2.user_id)
+    result = MatchResult(
+        compatibility_rating=7, rationale1="For one", rationale2="For two"
+    )
+
+    assert ranking_cache.get(profile1, persona1, profile2, persona2) is None
+    ranking_cache.put(profile1, persona1, profile2, persona2, result)
+    assert ranking_cache.get(profile1, persona1, profile2, persona2) == result
+    flipped = ranking_cache.get(profile2, persona2, profile1, persona1)
+    assert (flipped.rationale1, flipped.rationale2) == ("For two", "For one")
+
+    changed = Persona(description="Likes sailing", user_id=profile2.user_id)
+    assert ranking_cache.get(profile1, persona1, profile2, changed) is None
+    assert ranking_cache.stats == {"hits": 2, "misses": 2}
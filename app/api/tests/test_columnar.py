@@ -0,0 +1,42 @@
+from src.columnar import ProfileTable
+from src.fire_utils import apply_preference_filters
+from src.geo import SpatialIndex
+
+
+def user_ids(profiles):
+    return sorted(p.user_id for p in profiles)
+
+
+def test_filter_matches_apply_preference_filters(profiles):
+    table = ProfileTable(profiles)
+    for profile in profiles:
+        assert user_ids(table.filter(profile)) == user_ids(
+            apply_preference_filters(profile, profiles)
+        )
+
+
+def test_filter_with_spatial_index_matches_apply_preference_filters(profiles):
+    table = ProfileTable(profiles, spatial_index=SpatialIndex(profiles))
+    for profile in profiles:
+        assert user_ids(table.filter(profile)) == user_ids(
+            apply_preference_filters(profile, profiles)
+        )
+
+
+def test_filter_keeps_to_the_given_candidates(profiles):
+    table = ProfileTable(profiles)
+    candidates = profiles[::3]
+    for profile in profiles[:50]:
+        assert user_ids(table.filter(profile, candidates)) == user_ids(
+            apply_preference_filters(profile, candidates)
+        )
+
+
+def test_eligibility_matrix_is_symmetric_and_matches_filter(profiles):
+    table = ProfileTable(profiles)
+    matrix = table.eligibility_matrix()
+    assert (matrix == matrix.T).all()
+    for row, profile in enumerate(profiles[:50]):
+        assert user_ids(profiles[i] for i in matrix[row].nonzero()[0]) == user_ids(
+            table.filter(profile)
+        )
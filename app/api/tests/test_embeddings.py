@@ -0,0 +1,66 @@
+import numpy as np
+from src.ann import IVFIndex
+from src.embeddings import HashingEmbedder, top_k_similar
+
+PERSONAS = [
+    "Loves hiking in the mountains and camping under the stars",
+    "Enjoys hiking mountains and camping outdoors every weekend",
+    "A chess player who reads philosophy and plays the piano",
+    "Plays the piano, reads philosophy books and enjoys chess",
+    "Bakes sourdough bread and cooks Italian food for friends",
+]
+
+
+def test_hashing_embedder_is_deterministic_and_normalised():
+    embedder = HashingEmbedder(dim=64)
+    vectors = embedder.embed(PERSONAS)
+
+    assert vectors.shape == (len(PERSONAS), 64)
+    np.testing.assert_allclose(np.linalg.norm(vectors, axis=1), 1.0, rtol=1e-6)
+    np.testing.assert_array_equal(vectors, HashingEmbedder(dim=64).embed(PERSONAS))
+    assert not embedder.embed([""]).any()
+
+
+def test_hashing_embedder_ranks_similar_personas_first():
+    vectors = HashingEmbedder().embed(PERSONAS)
+    similarities = vectors @ vectors.T
+    assert np.argsort(-similarities[0])[1] == 1
+    assert np.argsort(-similarities[2])[1] == 3
+
+
+def test_top_k_similar_with_and_without_an_index():
+    ids = [f"user{i}" for i in range(len(PERSONAS))]
+    vectors = dict(zip(ids, HashingEmbedder().embed(PERSONAS)))
+    index = IVFIndex.build(ids, np.stack(list(vectors.values())), nlist=2)
+    candidates = ids[1:] + ["no-vector"]
+
+    assert top_k_similar("user0", candidates, vectors, 1) == ["user1"]
+    assert top_k_similar("user0", candidates, vectors, 1, index) == ["user1"]
+    assert top_k_similar("user2", candidates, vectors, 2, index)[0] == "user3"
+    # candidates without a vector go last, and a user without one keeps the order
+    assert top_k_similar("user0", candidates, vectors, 5)[-1] == "no-vector"
+    assert top_k_similar("no-vector", candidates, vectors, 2) == candidates[:2]
+
+
+def test_top_k_similar_searches_the_index_among_the_candidates_only():
+    rng = np.random.default_rng(0)
+    ids = [f"user{i}" for i in range(400)]
+    centres = rng.normal(size=(8, 16))
+    points = centres[rng.integers(0, 8, 400)] + rng.normal(scale=0.5, size=(400, 16))
+    points /= np.linalg.norm(points, axis=1, keepdims=True)
+    vectors = dict(zip(ids, points.astype(np.float32)))
+    index = IVFIndex.build(ids[:-10], np.stack([vectors[u] for u in ids[:-10]]))
+    # candidates filtered down by preferences, some of them not yet indexed
+    candidates = ids[::9] + ids[-10:]
+
+    overlap = []
+    for user_id in ids[:50]:
+        expected = top_k_similar(user_id, candidates, vectors, 5)
+        found = top_k_similar(user_id, candidates, vectors, 5, index)
+        assert len(found) == 5 and set(found) <= set(candidates) - {user_id}
+        overlap.append(len(set(found) & set(expected)) / 5)
+    assert np.mean(overlap) >= 0.9
+
+    # a candidate missing from the index still wins when it is the closest
+    vectors[ids[-1]] = vectors[ids[1]]
+    assert top_k_similar(ids[1], candidates, vectors, 1, index) == [ids[-1]]
@@ -0,0 +1,98 @@
+import threading
+from types import SimpleNamespace
+import pytest
+from google.api_core import exceptions as gexc
+from src import fire_utils
+
+
+class FakeBatch:
+    def __init__(self, client):
+        self.client = client
+        self.writes = []
+
+    def set(self, ref, data, merge=False):
+        self.writes.append((ref, data, merge))
+
+    def commit(self):
+        self.client.commit(self.writes)
+
+
+class FakeClient:
+    """Commits write batches of at most 500 documents, failing the first commit of `fail_doc`'s batch."""
+
+    def __init__(self, fail_doc: str | None = None, error=gexc.Aborted("contention")):
+        self.fail_doc = fail_doc
+        self.error = error
+        self.docs: dict[str, dict] = {}
+        self.commits: list[int] = []
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def collection(self, name):
+        return SimpleNamespace(
+            document=lambda doc_id: SimpleNamespace(path=f"{name}/{doc_id}")
+        )
+
+    def commit(self, writes):
+        assert len(writes) <= 500, "Firestore rejects batches over 500 writes"
+        with self._lock:
+            if not self.failures and any(
+                ref.path.endswith(f"/{self.fail_doc}") for ref, _, _ in writes
+            ):
+                self.failures += 1
+                raise self.error
+            for ref, data, merge in writes:
+                self.docs[ref.path] = (
+                    {**self.docs.get(ref.path, {}), **data} if merge else data
+                )
+            self.commits.append(len(writes))
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(fire_utils.time, "sleep", lambda delay: None)
+
+    def use(**kwargs) -> FakeClient:
+        fake = FakeClient(**kwargs)
+        monkeypatch.setattr(fire_utils, "fdb", fake)
+        return fake
+
+    return use
+
+
+def test_batch_set_commits_every_doc_in_batches_under_the_limit(client):
+    fake = client()
+    docs = {f"user{i}": {"value": i} for i in range(1234)}
+
+    fire_utils.batch_set("matches", docs)
+
+    assert sorted(fake.commits) == [234, 500, 500]
+    assert fake.docs == {f"matches/{k}": v for k, v in docs.items()}
+
+
+def test_batch_set_retries_a_failed_commit(client):
+    fake = client(fail_doc="user700")
+    docs = {f"user{i}": {"value": i} for i in range(1234)}
+
+    fire_utils.batch_set("matches", docs, merge=True)
+
+    assert fake.failures == 1
+    assert sorted(fake.commits) == [234, 500, 500]
+    assert len(fake.docs) == len(docs)
+
+
+def test_batch_set_gives_up_on_errors_it_cannot_retry(client):
+    fake = client(fail_doc="user700", error=gexc.PermissionDenied("denied"))
+
+    with pytest.raises(gexc.PermissionDenied):
+        fire_utils.batch_set("matches", {f"user{i}": {} for i in range(1234)})
+    assert fake.failures == 1
+
+
+def test_batch_set_of_nothing_commits_nothing(client):
+    fake = client()
+    fire_utils.batch_set("matches", {})
+    assert fake.commits == []
@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+import pytest
+from src import fire_utils, incremental
+from src.models import Persona
+
+NOW = datetime.now(timezone.utc)
+
+
+@pytest.fixture
+def state(monkeypatch, profiles):
+    profiles = profiles[:10]
+    personas = {
+        p.user_id: Persona(description=f"Persona of {p.user_id}", user_id=p.user_id)
+        for p in profiles
+    }
+    watermarks, markers = {}, {}
+    monkeypatch.setattr(
+        fire_utils,
+        "get_matchmaking_watermarks",
+        lambda user_ids: {u: watermarks[u] for u in user_ids if u in watermarks},
+    )
+    monkeypatch.setattr(
+        fire_utils,
+        "get_change_markers",
+        lambda user_ids: {u: markers[u] for u in user_ids if u in markers},
+    )
+    monkeypatch.setattr(fire_utils, "save_matchmaking_watermarks", watermarks.update)
+    # every user evaluated an hour ago as they are now
+    incremental.mark_evaluated(
+        incremental.user_fingerprints(profiles, personas),
+        evaluated_at=NOW - timedelta(hours=1),
+    )
+    return SimpleNamespace(
+        profiles=profiles, personas=personas, watermarks=watermarks, markers=markers
+    )
+
+
+def changed_ids(state) -> list[str]:
+    return [
+        p.user_id
+        for p in incremental.find_changed_users(state.profiles, state.personas)
+    ]
+
+
+def test_users_evaluated_as_they_are_have_not_changed(state):
+    assert changed_ids(state) == []
+
+
+def test_a_user_without_a_watermark_is_new(state):
+    del state.watermarks["user3"]
+    assert changed_ids(state) == ["user3"]
+
+
+def test_a_change_marker_after_the_evaluation_marks_a_change(state):
+    state.markers["user1"] = NOW - timedelta(minutes=5)
+    state.markers["user2"] = NOW - timedelta(hours=2)
+    assert changed_ids(state) == ["user1"]
+
+
+def test_a_write_made_outside_the_api_changes_the_fingerprint(state):
+    state.profiles[4].gender = (
+        "female" if state.profiles[4].gender != "female" else "male"
+    )
+    state.personas["user6"].description = "A rewritten persona"
+    del state.personas["user7"]
+    assert changed_ids(state) == ["user4", "user6", "user7"]
+
+
+def test_users_are_reevaluated_after_a_week(state):
+    days = incremental.REEVALUATE_AFTER_DAYS
+    state.watermarks["user5"]["last_evaluated"] = NOW - timedelta(days=days)
+    # watermarks read back from a snapshot or JSON hold ISO strings
+    state.watermarks["user8"]["last_evaluated"] = (
+        NOW - timedelta(days=days - 1)
+    ).isoformat()
+    assert changed_ids(state) == ["user5"]
+
+
+def test_mark_evaluated_records_the_fingerprints_it_was_given(state):
+    before = incremental.user_fingerprints(state.profiles, state.personas)
+    state.personas["user0"].description = "Edited while the run was ranking"
+    state.markers["user0"] = NOW
+
+    incremental.mark_evaluated(before)
+
+    assert state.watermarks["user0"]["last_evaluated"] >= NOW
+    assert state.watermarks["user0"]["fingerprint"] == before["user0"]
+    # the edit was not evaluated, so the next run picks it up
+    assert changed_ids(state) == ["user0"]
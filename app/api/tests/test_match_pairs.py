@@ -0,0 +1,186 @@
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+import pytest
+from routers import matches as matches_router
+from src import afire_utils, fire_utils
+from src.models import PhoneNumber, Profile, RecordedMatch, StoredMatches
+
+MATCHED = datetime(2024, 5, 1, tzinfo=timezone.utc)
+
+
+def recorded(
+    user_id: str,
+    showed_interest: bool = False,
+    interested: bool = False,
+    date_matched: datetime = MATCHED,
+) -> RecordedMatch:
+    return RecordedMatch(
+        user_id=user_id,
+        rationale=f"Rationale for {user_id}",
+        compatibility_rating=8,
+        highlighted_themes=[],
+        you_showed_interest=showed_interest,
+        your_interested=interested,
+        date_matched=date_matched,
+    )
+
+
+def docs(collection: dict[str, dict], ids=None) -> list:
+    return [
+        SimpleNamespace(id=doc_id, to_dict=lambda doc=doc: doc)
+        for doc_id, doc in collection.items()
+        if ids is None or doc_id in ids
+    ]
+
+
+def interest(showed_interest: bool, interested: bool) -> dict:
+    return {"showed_interest": showed_interest, "interested": interested}
+
+
+def test_only_new_matches_get_a_fresh_pair_record():
+    stored = {"a": StoredMatches(matches=[recorded("b"), recorded("c")])}
+    rematched = datetime(2024, 6, 1, tzinfo=timezone.utc)
+    user_matches = {
+        "a": [recorded("b"), recorded("c", date_matched=rematched), recorded("d")],
+        "d": [recorded("a")],
+    }
+
+    pairs = fire_utils._new_match_pairs(user_matches, stored)
+
+    assert set(pairs) == {
+        fire_utils.create_canonical_match_id("a", "c"),
+        fire_utils.create_canonical_match_id("a", "d"),
+    }
+    for pair in pairs.values():
+        assert all(
+            entry == interest(False, False) for entry in pair["interest"].values()
+        )
+        assert len(pair["interest"]) == 2
+
+
+def test_backfill_only_adds_users_missing_from_pair_records(monkeypatch):
+    match_ab = fire_utils.create_canonical_match_id("a", "b")
+    match_ac = fire_utils.create_canonical_match_id("a", "c")
+    match_bc = fire_utils.create_canonical_match_id("b", "c")
+    collections = {
+        "matches": {
+            "a": {"matches": [recorded("b", True, True).dict(), recorded("c").dict()]},
+            "b": {"matches": [recorded("a", True).dict(), recorded("c").dict()]},
+            "c": {"matches": [recorded("a").dict(), recorded("b").dict()]},
+        },
+        "match_pair": {
+            # "a" already tapped through /matches/update
+            match_ab: {"interest": {"a": interest(True, False)}},
+            match_bc: {
+                "interest": {"b": interest(False, False), "c": interest(False, False)}
+            },
+        },
+    }
+    written = {}
+    monkeypatch.setattr(
+        fire_utils, "get_documents", lambda name, ids=None: docs(collections[name], ids)
+    )
+    monkeypatch.setattr(
+        fire_utils,
+        "batch_set",
+        lambda name, pairs, merge=False: written.update(pairs) if merge else None,
+    )
+
+    fire_utils.backfill_match_pairs()
+
+    assert written == {
+        match_ab: {"interest": {"b": interest(True, False)}},
+        match_ac: {
+            "interest": {"a": interest(False, False), "c": interest(False, False)}
+        },
+    }
+
+
+def test_saving_matches_keeps_the_interest_in_existing_pairs(monkeypatch):
+    saved = {}
+    monkeypatch.setattr(
+        fire_utils, "batch_set", lambda name, docs: saved.setdefault(name, docs)
+    )
+    stored = {
+        "a": StoredMatches(matches=[recorded("b")]),
+        "b": StoredMatches(matches=[recorded("a")]),
+    }
+
+    fire_utils.batch_save_matches(
+        {
+            "a": [recorded("b"), recorded("c")],
+            "b": [recorded("a")],
+            "c": [recorded("a")],
+        },
+        stored,
+    )
+
+    assert set(saved["matches"]) == {"a", "c"}  # "b" is unchanged
+    assert set(saved["match_pair"]) == {fire_utils.create_canonical_match_id("a", "c")}
+
+
+@pytest.fixture
+def api(monkeypatch):
+    collections = {"matches": {}, "match_pair": {}}
+    profiles = {
+        uid: Profile(
+            user_id=uid,
+            name=uid.upper(),
+            profile_image=f"https://images/{uid}",
+            phone_number=PhoneNumber.generate_random(),
+        )
+        for uid in "abcde"
+    }
+
+    async def get_matches(user_id):
+        return fire_utils.stored_matches_from_dict(collections["matches"][user_id])
+
+    async def get_documents(name, ids):
+        return docs(collections[name], ids)
+
+    async def get_profiles(user_ids):
+        return {uid: profiles[uid] for uid in user_ids}
+
+    monkeypatch.setattr(afire_utils, "get_matches", get_matches)
+    monkeypatch.setattr(afire_utils, "get_documents", get_documents)
+    monkeypatch.setattr(afire_utils, "get_profiles", get_profiles)
+    return collections
+
+
+def test_get_matches_merges_pair_records_with_recorded_interest(api):
+    api["matches"] = {
+        "a": {"matches": [recorded(uid).dict() for uid in ["b", "c", "d", "e"]]},
+        "c": {"matches": [recorded("a", True, True).dict()]},
+        "d": {"matches": [recorded("a", True).dict()]},
+        "e": {"matches": []},
+    }
+    api["match_pair"] = {
+        # a full pair record
+        fire_utils.create_canonical_match_id("a", "b"): {
+            "interest": {"a": interest(True, True), "b": interest(True, False)}
+        },
+        # only "a" tapped since matching, "d" still has the flag in its match
+        fire_utils.create_canonical_match_id("a", "d"): {
+            "interest": {"a": interest(True, False)}
+        },
+    }
+
+    response = asyncio.run(matches_router.get_matches("a"))
+
+    shown = {
+        m.matched_user_id: (
+            m.you_showed_interest,
+            m.your_interested,
+            m.they_showed_interest,
+            m.they_interested,
+        )
+        for m in response.matches
+    }
+    assert shown == {
+        "b": (True, True, True, False),
+        # a match made before pair records, read from both match documents
+        "c": (False, False, True, True),
+        "d": (True, False, True, False),
+        # "e" lacks the reverse match, so it is skipped
+    }
@@ -0,0 +1,161 @@
+import asyncio
+import httpx
+import openai
+import pytest
+from src import ratelimit
+
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+MESSAGES = [{"role": "user", "content": "x" * 400}]  # 100 prompt tokens
+
+
+def rate_limit_error(retry_after: str | None = None, code: str | None = None):
+    headers = {"retry-after": retry_after} if retry_after else {}
+    return openai.RateLimitError(
+        "Rate limit reached",
+        response=httpx.Response(429, request=REQUEST, headers=headers),
+        body={"code": code} if code else None,
+    )
+
+
+class Clock:
+    """A monotonic clock that only moves when the code under test sleeps."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    async def asleep(self, seconds: float):
+        self.sleep(seconds)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(ratelimit.time, "sleep", clock.sleep)
+    monkeypatch.setattr(ratelimit.asyncio, "sleep", clock.asleep)
+    monkeypatch.setattr(ratelimit.random, "random", lambda: 1.0)  # no jitter
+    return clock
+
+
+def failing(errors: list[Exception], result="ok"):
+    calls = []
+
+    def generator(messages, *args, **kwargs):
+        calls.append(messages)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+
+    generator.calls = calls
+    return generator
+
+
+def test_token_bucket_starts_full_and_refills_at_its_rate():
+    bucket = ratelimit.TokenBucket(per_minute=60)
+    bucket.updated = 0.0
+
+    assert bucket.reserve(60, now=0.0) == 0.0
+    assert bucket.reserve(1, now=0.0) == pytest.approx(1.0)
+    assert bucket.reserve(1, now=0.0) == pytest.approx(2.0)
+    # waiting out the debt brings the bucket back to empty
+    assert bucket.reserve(0, now=2.0) == 0.0
+    assert bucket.level == pytest.approx(0.0)
+    # and it never refills past one minute's worth
+    assert bucket.reserve(0, now=1000.0) == 0.0
+    assert bucket.level == 60
+
+
+def test_calls_are_paced_under_the_token_limit(clock):
+    # each call reserves 100 prompt plus 500 response tokens, 60 calls a minute
+    limiter = ratelimit.RateLimiter(rpm=1000, tpm=60 * 600)
+    generator = failing([])
+    for _ in range(61):
+        limiter.call(generator, MESSAGES)
+
+    assert clock.sleeps[:60] == [0.0] * 60
+    assert clock.sleeps[60] == pytest.approx(1.0)
+
+
+def test_set_limits_replaces_the_buckets(clock):
+    limiter = ratelimit.RateLimiter(rpm=1000, tpm=1_000_000)
+    limiter.set_limits(rpm=60, tpm=1_000_000)
+    generator = failing([])
+    for _ in range(61):
+        limiter.call(generator, MESSAGES)
+    assert clock.sleeps[-1] == pytest.approx(1.0)
+
+
+def test_retries_with_exponential_backoff(clock):
+    limiter = ratelimit.RateLimiter(rpm=1000, tpm=1_000_000, max_retries=4)
+    error = openai.APIConnectionError(request=REQUEST)
+    generator = failing([error, error, error])
+
+    assert limiter.call(generator, MESSAGES) == "ok"
+    assert len(generator.calls) == 4
+    backoffs = [s for s in clock.sleeps if s]
+    assert backoffs == [1.0, 2.0, 4.0]
+    assert limiter.stats["retries"] == 3
+
+
+def test_rate_limit_errors_honour_retry_after_and_pause_every_caller(clock):
+    limiter = ratelimit.RateLimiter(rpm=1000, tpm=1_000_000)
+    generator = failing([rate_limit_error(retry_after="5")])
+
+    assert limiter.call(generator, MESSAGES) == "ok"
+    assert clock.sleeps[1] == 5.0
+    assert limiter.paused_until == 5.0
+
+    limiter.paused_until = clock.now + 3
+    limiter.call(failing([]), MESSAGES)
+    assert clock.sleeps[-1] == 3.0
+
+
+def test_gives_up_after_max_retries(clock):
+    limiter = ratelimit.RateLimiter(rpm=1000, tpm=1_000_000, max_retries=2)
+    generator = failing([rate_limit_error()] * 5)
+
+    with pytest.raises(openai.RateLimitError):
+        limiter.call(generator, MESSAGES)
+    assert len(generator.calls) == 3
+    assert limiter.stats["failures"] == 1
+
+
+def test_insufficient_quota_is_not_retried(clock):
+    limiter = ratelimit.RateLimiter(rpm=1000, tpm=1_000_000)
+    generator = failing([rate_limit_error(code="insufficient_quota")])
+
+    with pytest.raises(openai.RateLimitError):
+        limiter.call(generator, MESSAGES)
+    assert len(generator.calls) == 1
+
+
+def test_other_errors_are_raised_at_once(clock):
+    limiter = ratelimit.RateLimiter(rpm=1000, tpm=1_000_000)
+    generator = failing([ValueError("bad response")])
+
+    with pytest.raises(ValueError):
+        limiter.call(generator, MESSAGES)
+    assert len(generator.calls) == 1
+
+
+def test_rate_limited_wraps_async_generators(clock, monkeypatch):
+    limiter = ratelimit.RateLimiter(rpm=1000, tpm=1_000_000)
+    monkeypatch.setattr(ratelimit, "LIMITER", limiter)
+    errors = [openai.APIConnectionError(request=REQUEST)]
+
+    @ratelimit.rate_limited
+    async def generator(messages):
+        if errors:
+            raise errors.pop()
+        return "ok"
+
+    assert asyncio.run(generator(MESSAGES)) == "ok"
+    assert limiter.stats["retries"] == 1
@@ -0,0 +1,159 @@
+import hashlib
+import os
+from collections import Counter
+from types import SimpleNamespace
+import pytest
+from src import ai, algo, batch, cache, fire_utils, incremental, sharding
+from src.models import MatchmakingStatus, MatchResult, Persona
+
+
+def fake_ranking(messages, response_format, timeout, label):
+    """Rate a pair by a hash of its two user IDs, whichever side it is ranked from."""
+    user_ids = sorted(messages[0]["content"].split())
+    digest = hashlib.sha256(" ".join(user_ids).encode()).digest()
+    return MatchResult(
+        compatibility_rating=1 + digest[0] % 10,
+        rationale1="one",
+        rationale2="two",
+        highlighted_themes=[],
+    )
+
+
+@pytest.fixture
+def job(monkeypatch, tmp_path, profiles):
+    personas = {
+        p.user_id: Persona(description=f"Persona of {p.user_id}", user_id=p.user_id)
+        for p in profiles
+    }
+    source = SimpleNamespace(
+        get_compact_profiles=lambda: [p.model_copy() for p in profiles],
+        get_all_personas=lambda user_ids=None: {
+            user_id: persona
+            for user_id, persona in personas.items()
+            if user_ids is None or user_id in user_ids
+        },
+        get_all_matches=lambda user_ids=None: {},
+    )
+    saved, watermarks = [], {}
+    monkeypatch.setattr(algo, "get_job_source", lambda: source)
+    monkeypatch.setattr(algo, "EMBEDDING_PRERANK", False)
+    monkeypatch.setattr(batch, "RANKING_BACKEND", "online")
+    monkeypatch.setattr(cache, "get_ranking_cache", lambda: None)
+    monkeypatch.setattr(ai, "RANKING_GROUP_SIZE", 1)
+    monkeypatch.setattr(
+        ai, "ranking_prompt", lambda user, other, *_: f"{user.user_id} {other.user_id}"
+    )
+    monkeypatch.setattr(ai, "GENERATOR", fake_ranking)
+    monkeypatch.setattr(fire_utils, "get_matchmaking_status", MatchmakingStatus)
+    monkeypatch.setattr(fire_utils, "save_matchmaking_status", lambda status: None)
+    monkeypatch.setattr(
+        fire_utils,
+        "batch_save_matches",
+        lambda user_matches, stored_matches=None: saved.append(user_matches),
+    )
+    monkeypatch.setattr(
+        fire_utils,
+        "get_matchmaking_watermarks",
+        lambda user_ids=None: {u: w for u, w in watermarks.items() if u in user_ids},
+    )
+    monkeypatch.setattr(fire_utils, "get_change_markers", lambda user_ids: {})
+    monkeypatch.setattr(fire_utils, "save_matchmaking_watermarks", watermarks.update)
+    monkeypatch.setattr(sharding, "MATCHMAKING_CHECKPOINT", str(tmp_path))
+    monkeypatch.setattr(sharding, "CHECKPOINT_EVERY", 7)
+    return SimpleNamespace(
+        saved=saved,
+        watermarks=watermarks,
+        profiles=profiles,
+        personas=personas,
+        checkpoints=tmp_path,
+    )
+
+
+def saved_matches(job) -> dict[str, list[tuple[str, int]]]:
+    (user_matches,) = job.saved
+    return {
+        user_id: sorted((m.user_id, m.compatibility_rating) for m in matches)
+        for user_id, matches in user_matches.items()
+        if matches
+    }
+
+
+def test_shard_of_splits_keys_evenly():
+    counts = Counter(sharding.shard_of(f"key{i}", 4) for i in range(10_000))
+    assert set(counts) == {0, 1, 2, 3}
+    assert min(counts.values()) > 2_000
+
+
+@pytest.mark.parametrize("shard_count", [1, 3])
+def test_sharded_run_saves_the_same_matches_as_a_single_run(job, shard_count):
+    algo.matchmaking()
+    expected = saved_matches(job)
+    assert expected
+    job.saved.clear()
+
+    sharding.prepare_shards("run")
+    for shard_index in range(shard_count):
+        sharding.run_shard("run", shard_index, shard_count)
+    sharding.reduce_shards("run", shard_count)
+
+    assert saved_matches(job) == expected
+
+
+def test_each_pair_is_ranked_by_one_shard(job):
+    sharding.prepare_shards("run")
+    for shard_index in range(3):
+        sharding.run_shard("run", shard_index, 3)
+
+    store = sharding.get_checkpoint_store()
+    per_shard = [set(store.load_pairs("run", i)) for i in range(3)]
+    assert sum(map(len, per_shard)) == len(set().union(*per_shard))
+    for shard_index, match_ids in enumerate(per_shard):
+        assert all(sharding.shard_of(m, 3) == shard_index for m in match_ids)
+
+
+def test_shards_wait_for_prepare_and_reduce_waits_for_every_shard(job):
+    assert sharding.run_shard("run", 0, 2)["message"] == "Run is not prepared"
+    sharding.prepare_shards("run")
+    sharding.run_shard("run", 0, 2)
+    assert "have not finished" in sharding.reduce_shards("run", 2)["message"]
+    assert job.saved == []
+
+
+def test_a_finished_shard_is_not_ranked_again(job, monkeypatch):
+    sharding.prepare_shards("run")
+    sharding.run_shard("run", 0, 1)
+    monkeypatch.setattr(ai, "GENERATOR", None)  # any ranking call would fail
+
+    assert sharding.run_shard("run", 0, 1)["message"] == "Shard 0 already done"
+
+
+def test_reduce_clears_the_run_checkpoints(job):
+    sharding.prepare_shards("run")
+    sharding.run_shard("run", 0, 1)
+    sharding.reduce_shards("run", 1)
+
+    assert not os.path.exists(job.checkpoints / "run")
+
+
+def test_incremental_run_records_the_users_as_prepare_read_them(job):
+    sharding.prepare_shards("run", incremental=True)
+    prepared = incremental.user_fingerprints(job.profiles, job.personas)
+
+    # a profile edited and a user created while the shards run
+    edited = job.profiles[0]
+    job.profiles[0] = edited.model_copy(update={"name": "Renamed"})
+    job.profiles.append(edited.model_copy(update={"user_id": "late"}))
+    job.personas["late"] = Persona(description="Late signup", user_id="late")
+    for shard_index in range(2):
+        sharding.run_shard("run", shard_index, 2, incremental=True)
+    sharding.reduce_shards("run", 2, incremental=True)
+
+    assert {u: w["fingerprint"] for u, w in job.watermarks.items()} == prepared
+    changed = incremental.find_changed_users(job.profiles, job.personas)
+    assert [p.user_id for p in changed] == [edited.user_id, "late"]
+
+
+def test_incremental_shards_need_an_incremental_prepare(job):
+    sharding.prepare_shards("run")
+    message = sharding.run_shard("run", 0, 1, incremental=True)["message"]
+    assert message == "Run was not prepared in incremental mode"
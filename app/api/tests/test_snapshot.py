@@ -0,0 +1,152 @@
+import json
+from datetime import datetime, timezone
+from types import SimpleNamespace
+import pytest
+from src import algo, fire_utils, snapshot
+from src.models import MatchResult
+from src.columnar import ProfileTable
+from src.profile_store import CompactProfile
+
+
+class FakeCollection:
+    def __init__(self, docs: dict[str, dict]):
+        self.docs = docs
+
+    def select(self, fields):
+        return self
+
+    def stream(self):
+        return [self._doc(doc_id) for doc_id in self.docs]
+
+    def _doc(self, doc_id: str):
+        doc = self.docs[doc_id]
+        return SimpleNamespace(
+            id=doc_id,
+            update_time=datetime.fromtimestamp(doc["version"], timezone.utc),
+            to_dict=lambda: {k: v for k, v in doc.items() if k != "version"},
+        )
+
+
+@pytest.fixture
+def firestore(monkeypatch, profiles):
+    collections = {
+        "profile": {
+            p.user_id: {**p.model_dump(exclude={"phone_number"}), "version": 1}
+            for p in profiles
+        },
+        "persona": {
+            p.user_id: {"description": f"Persona of {p.user_id}", "version": 1}
+            for p in profiles
+        },
+    }
+    fetched = []
+
+    def get_documents(collection, user_ids):
+        fetched.extend(user_ids)
+        fake = FakeCollection(collections[collection])
+        return [fake._doc(doc_id) for doc_id in user_ids]
+
+    monkeypatch.setattr(
+        fire_utils,
+        "fdb",
+        SimpleNamespace(collection=lambda name: FakeCollection(collections[name])),
+    )
+    monkeypatch.setattr(fire_utils, "get_documents", get_documents)
+    return SimpleNamespace(collections=collections, fetched=fetched)
+
+
+def compact_fields(profile: CompactProfile) -> tuple:
+    return tuple(
+        getattr(profile, field)
+        for field in CompactProfile.__slots__
+        if not field.startswith("_")
+    )
+
+
+def expected_profiles(firestore) -> list[CompactProfile]:
+    return [
+        CompactProfile({**doc, "user_id": doc_id})
+        for doc_id, doc in sorted(firestore.collections["profile"].items())
+    ]
+
+
+def test_snapshot_rebuilds_compact_profiles_from_columns(tmp_path, firestore):
+    path = str(tmp_path / "snapshot")
+    snapshot.refresh_snapshot(path)
+    loaded = snapshot.load_snapshot(path)
+
+    assert [compact_fields(p) for p in loaded.get_compact_profiles()] == [
+        compact_fields(p) for p in expected_profiles(firestore)
+    ]
+    assert set(loaded.get_all_personas()) == set(firestore.collections["persona"])
+
+
+def test_snapshot_columns_filter_like_the_profiles(tmp_path, firestore):
+    path = str(tmp_path / "snapshot")
+    snapshot.refresh_snapshot(path)
+    loaded = snapshot.load_snapshot(path)
+    profiles = loaded.get_compact_profiles()
+
+    from_profiles = ProfileTable(profiles)
+    from_columns = ProfileTable(profiles, columns=loaded.get_profile_columns())
+    for profile in profiles:
+        assert [p.user_id for p in from_columns.filter(profile)] == [
+            p.user_id for p in from_profiles.filter(profile)
+        ]
+
+
+def test_refresh_only_fetches_changed_documents(tmp_path, firestore):
+    path = str(tmp_path / "snapshot")
+    snapshot.refresh_snapshot(path)
+    profiles = firestore.collections["profile"]
+    changed_id, deleted_id = sorted(profiles)[:2]
+    profiles[changed_id].update(gender="female", orientation=["male"], version=2)
+    del profiles[deleted_id]
+    firestore.fetched.clear()
+
+    num_fetched = snapshot.refresh_snapshot(path)
+
+    assert num_fetched == {"profile": 1, "persona": 0}
+    assert firestore.fetched == [changed_id]
+    loaded = snapshot.load_snapshot(path)
+    assert [compact_fields(p) for p in loaded.get_compact_profiles()] == [
+        compact_fields(p) for p in expected_profiles(firestore)
+    ]
+
+
+def test_refresh_rebuilds_a_snapshot_of_an_older_version(tmp_path, firestore):
+    path = str(tmp_path / "snapshot")
+    snapshot.refresh_snapshot(path)
+    loaded = snapshot.load_snapshot(path)
+    loaded.meta["version"] = snapshot.SNAPSHOT_VERSION - 1
+    with open(tmp_path / "snapshot" / "meta.json", "w") as f:
+        json.dump(loaded.meta, f)
+
+    with pytest.raises(ValueError):
+        snapshot.load_snapshot(path)
+    assert snapshot.refresh_snapshot(path)["profile"] == len(
+        firestore.collections["profile"]
+    )
+
+
+def test_pairs_of_users_deleted_since_the_snapshot_are_not_allocated(
+    tmp_path, firestore
+):
+    path = str(tmp_path / "snapshot")
+    snapshot.refresh_snapshot(path)
+    loaded = snapshot.load_snapshot(path)
+    user_ids = sorted(firestore.collections["profile"])
+    result = MatchResult(compatibility_rating=7, rationale1="a", rationale2="b")
+    ranked = {
+        f"{u1}_{u2}": (u1, u2, result) for u1, u2 in zip(user_ids[::2], user_ids[1::2])
+    }
+    deleted = user_ids[3]
+    del firestore.collections["profile"][deleted]
+
+    kept = algo.drop_deleted_users(ranked, loaded)
+    assert kept == {
+        match_id: pair for match_id, pair in ranked.items() if deleted not in pair
+    }
+    assert len(kept) == len(ranked) - 1
+    # profiles read live are current, so their pairs are not checked again
+    assert algo.drop_deleted_users(ranked, fire_utils) is ranked